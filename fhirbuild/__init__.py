@@ -4,102 +4,181 @@
 # da muessten wir mal suchen, https://www.google.com/search?q=python+fhir+frameworks  
 # vielleicht z.b. hier https://pypi.org/project/fhir.resources/
 
+# the tram types in the annotations aren't evaluated, so tram is only
+# imported when it's used, and importing fhirbuild stays quick.
+from __future__ import annotations
+
 from datetime import date, datetime
 
-from tram import Sample, Identifier, Patient, Amount, Finding
-from tram import Rec, BooleanRec, NumberRec, StringRec, DateRec, MultiRec, CatalogRec
 import os
 import math
 import json
 from fhirbuild.help import datestring, genfhirid
-
-
-def write_patients(pats:list, dir:str, batchsize:int, wrap:bool=False, should_print:bool=False, cxx:int=3):
-    """write_patients writes fhir resources of patients and returns a list containing the written directory."""
+from fhirbuild.serialize import get_serializer, serializer_indent, estimate_size, list_item_size
+from fhirbuild.templates import builder
+from fhirbuild.records import Ident, Ids
+from fhirbuild.validate import RejectedRow
+from fhirbuild.sinks import DirSink, BackgroundWriter, WriteError, open_archive, open_compressed, compressions
+
+# the tram classes that can be imported from fhirbuild
+_tram_names = ["Sample", "Identifier", "Patient", "Amount", "Finding", "Rec", "BooleanRec", "NumberRec", "StringRec", "DateRec", "MultiRec", "CatalogRec"]
+
+# the names of from fhirbuild import *: the functions, the tram classes, which a star import gets through __getattr__, and what fhirbuild exported before the tram classes were imported on use
+__all__ = _tram_names + [
+    "write_patients", "stream_patients", "patient_entries",
+    "write_samples", "stream_samples", "sample_entries", "index_fhirids", "report_fhirid_problems",
+    "write_observations", "stream_observations", "observation_entries",
+    "bundle", "iter_bundles", "report_family_problems", "writeout", "writeout_ndjson", "WriteError",
+    "fhir_identifier", "fhir_coding", "fhir_extension", "fhir_specimen", "fhir_quantity", "fhir_aliquotgroup", "fhir_bundle", "fhir_obs", "fhir_patient",
+    "date", "datetime", "datestring", "genfhirid", "help", "json", "math", "os"
+]
+
+def __getattr__(name:str):
+    """__getattr__ returns the tram classes from fhirbuild, importing tram when one is first asked for."""
+    if name in _tram_names:
+        import tram
+        return getattr(tram, name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def write_patients(pats:list, dir:str, batchsize:int, wrap:bool=False, should_print:bool=False, cxx:int=3, serializer:str="pretty", stats=None, max_bytes:int=None):
+    """write_patients writes fhir resources of patients and returns a list containing the written directory. stats, a stats.Stats, times the stages if given. max_bytes limits the size of the bundles, see iter_bundles."""
 
     # get the entries
-    entries = []
-    for pat in pats:
-        # make a fhirid that depends on the limspsn, the fhirid is  
-        entries.append(fhir_patient(pat))
+    entries = patient_entries(pats)
+    if stats is not None:
+        entries = stats.timed("build", entries)
+    entries = list(entries)
 
     # bundles the entries 
-    bundles = bundle(entries, batchsize, restype="Patient", cxx=cxx)
+    bundles = _bundle_timed(entries, batchsize, "Patient", cxx, stats, max_bytes, serializer)
 
     # if print is set, print
     if should_print:
         print(json.dumps(bundles, indent=4))    
 
     # write the bundles
-    return writeout(bundles, dir, "patient", wrap=wrap)
+    return writeout(bundles, dir, "patient", wrap=wrap, serializer=serializer, stats=stats)
 
-def write_samples(samples:list, dir:str, batchsize:int, wrap:bool=False, should_print:bool=False, cxx:int=3) -> list:
-    """write_samples writes fhir resources of Samples and returns a list containing the written directory. it fills in missing fhirids."""
+def stream_patients(pats, dir:str, batchsize:int, wrap:bool=False, cxx:int=3, serializer:str="pretty", stats=None, max_bytes:int=None) -> list:
+    """stream_patients is write_patients for iterables: it builds, bundles and writes one bundle at a time, so only the current bundle is held in memory."""
+    bundles = _iter_bundles_timed(patient_entries(pats), batchsize, "Patient", cxx, stats, max_bytes, serializer)
+    return writeout(bundles, dir, "patient", wrap=wrap, serializer=serializer, stats=stats)
 
-    # fill in fhirids, taking parent-child relations into account.
-    _fill_in_fhirids(samples)
+def patient_entries(pats):
+    """patient_entries yields a fhir entry for each patient."""
+    for pat in pats:
+        # make a fhirid that depends on the limspsn, the fhirid is  
+        yield fhir_patient(pat)
 
-    # collect the entries
-    entries = [ ]
-    for sample in samples:
-        # build aliquot group or standard sample
-        if sample.category == "ALIQUOTGROUP":
-            entry = fhir_aliquotgroup(sample)
-        elif sample.category == "MASTER" or sample.category == "DERIVED":
-            entry = fhir_specimen(sample)
-        else:
-            raise Exception(f"sample category {sample.category} is not allowed.")
+def write_samples(samples:list, dir:str, batchsize:int, wrap:bool=False, should_print:bool=False, cxx:int=3, serializer:str="pretty", stats=None, max_bytes:int=None, families:bool=False) -> list:
+    """write_samples writes fhir resources of Samples and returns a list containing the written directory. it fills in missing fhirids. stats, a stats.Stats, times the stages if given. max_bytes limits the size of the bundles, families keeps the specimen families in the same bundle, see iter_bundles."""
 
-        # append the entry
-        entries.append(entry)
+    # collect the entries, filling in fhirids and taking parent-child relations into account.
+    entries = sample_entries(samples, stats=stats)
+    if stats is not None:
+        entries = stats.timed("build", entries)
+    entries = list(entries)
 
     # bundles the entries
-    bundles = bundle(entries, batchsize, restype="Sample", cxx=cxx)
+    bundles = _bundle_timed(entries, batchsize, "Sample", cxx, stats, max_bytes, serializer, families)
 
     # if print is set, print
     if should_print:
         print(json.dumps(bundles, indent=4))
         
     # write the bundles
-    return writeout(bundles, dir, "sample", wrap=wrap)
+    return writeout(bundles, dir, "sample", wrap=wrap, serializer=serializer, stats=stats)
+
+def stream_samples(samples, dir:str, batchsize:int, wrap:bool=False, cxx:int=3, serializer:str="pretty", stats=None, max_bytes:int=None, families:bool=False) -> list:
+    """stream_samples is write_samples for iterables: it fills in fhirids, builds, bundles and writes one bundle at a time, so only the current bundle is held in memory. like write_samples it assumes parents come before children."""
+    bundles = _iter_bundles_timed(sample_entries(samples, stats=stats), batchsize, "Sample", cxx, stats, max_bytes, serializer, families)
+    return writeout(bundles, dir, "sample", wrap=wrap, serializer=serializer, stats=stats)
+
+def sample_entries(samples, fhirids:dict=None, start:int=0, problems:dict=None, stats=None):
+    """sample_entries yields a fhir entry for each Sample or SampleRecord, filling in missing fhirids on the way (see _iter_fill_in_fhirids for the arguments). the entries are the same as from fhir_aliquotgroup and fhir_specimen, standard samples are built with the compiled template of fhir_specimen. stats, a stats.Stats, times the filling in of fhirids if given. rejected rows (see validate.py) are passed through in their place."""
+    build_specimen = builder("Specimen")
+    filled = _iter_fill_in_fhirids(samples, fhirids=fhirids, start=start, problems=problems)
+    if stats is not None:
+        filled = stats.timed("fhirids", filled)
+    for sample in filled:
+        if isinstance(sample, RejectedRow):
+            yield sample
+        # build aliquot group or standard sample
+        elif sample.category == "ALIQUOTGROUP":
+            yield fhir_aliquotgroup(sample)
+        elif sample.category == "MASTER" or sample.category == "DERIVED":
+            yield build_specimen(sample)
+        else:
+            raise Exception(f"sample category {sample.category} is not allowed.")
 
 
 def _fill_in_fhirids(samples):
-    """_fill_in_fhirids fills in missing fhirids for Sample instances.  assumes sorted input, parents followed by children.  the fhirids are generated from each Sample's id.  for aliquotgroups, the fhirid is generated from the parent sampleid and the material of the aliquotgroup.  child samples should referenence their parents via the .parent:Idiable field.  for aliquotgroups .parent should contain an Identifier referencing the primary parent with either 'fhirid' or main idc code, for aliquots .parent should contain an Identifier referencing the parent aliquotgroup with either 'fhirid' or 'index' code, since aliquotgroups don't come with sampleids."""
-
-    # remember the fhirids by oid
-    fhiridbyoid = {}
-    # remember the fhirids by index
-    fhiridbyindex = {}
-
-    # collect the entries
-    i = 0
-    for sample in samples:
-        #print(f"i: {i}")
-        #print(jsonpickle.encode(sample, unpicklable=False, indent=4))
-        #print(sample.parent.ids[0].code + ", " + sample.parent.ids[1].code)
+    """_fill_in_fhirids fills in missing fhirids for a list of Sample instances, see _iter_fill_in_fhirids."""
+    for sample in _iter_fill_in_fhirids(samples):
+        pass
+
+def index_fhirids(samples, start:int=0) -> dict:
+    """index_fhirids is the first phase of the two-phase fhirid resolution. it returns the fhirids of the samples that can be referenced by their children, keyed by ("oid", oid) or ("index", index), each with the position of the sample. since genfhirid is deterministic, the fhirids can be collected up front, and the second phase, _iter_fill_in_fhirids with this index, can then run on chunks of samples in any order. for csv input see csvtofhir.prescan_fhirids."""
+    fhirids = {}
+    for i, sample in enumerate(samples, start):
+        if sample.id("oid") is None and sample.id("index") is None:
+            continue
+        fhirid = sample.id("fhirid")
+        if fhirid is None:
+            fhirid = _sample_fhirid(sample)
+        if sample.id("oid") is not None:
+            fhirids[("oid", sample.id("oid"))] = (fhirid, i)
+        if sample.id("index") is not None:
+            fhirids[("index", sample.id("index"))] = (fhirid, i)
+    return fhirids
+
+def _sample_fhirid(sample) -> str:
+    """_sample_fhirid generates the fhirid of a Sample. for aliquotgroups it is generated from the parent sampleid and the material of the aliquotgroup, for other samples from the sampleid."""
+    if sample.category == "ALIQUOTGROUP":
+        return genfhirid(sample.parent.id() + sample.type)
+    return genfhirid(sample.id())
+
+def _iter_fill_in_fhirids(samples, fhirids:dict=None, start:int=0, problems:dict=None):
+    """_iter_fill_in_fhirids fills in missing fhirids for Sample instances or SampleRecords.  the fhirids are generated from each Sample's id.  for aliquotgroups, the fhirid is generated from the parent sampleid and the material of the aliquotgroup.  child samples should referenence their parents via the .parent:Idiable field.  for aliquotgroups .parent should contain an Identifier referencing the primary parent with either 'fhirid' or main idc code, for aliquots .parent should contain an Identifier referencing the parent aliquotgroup with either 'fhirid' or 'index' code, since aliquotgroups don't come with sampleids. each sample is yielded as soon as its fhirids are filled in.
+
+    without fhirids, it assumes sorted input, parents followed by children, and remembers the fhirids by oid and index on the way. with fhirids, an index from index_fhirids or csvtofhir.prescan_fhirids, the parents are looked up there, so the samples can be a chunk of the input, start being the position of its first sample. aliquots that come before their parent are then still resolved, but reported.
+
+    problems are collected in the problems dict (see _new_fhirid_problems) and reported in bulk after the last sample. if a problems dict is passed, it is only filled, and the caller reports it."""
+
+    # remember the fhirids by oid and index, unless they were given
+    known = fhirids
+    if known is None:
+        known = {}
+
+    # report at the end if the caller doesn't collect the problems
+    report = problems is None
+    if problems is None:
+        problems = _new_fhirid_problems()
+
+    for i, sample in enumerate(samples, start):
+        # a rejected row keeps its place, without being remembered as a parent
+        if isinstance(sample, RejectedRow):
+            yield sample
+            continue
+
         # take the fhirid if passed
         fhirid = sample.id("fhirid")
         
         # if no fhirid, generate a fhirid
         if fhirid is None:
-            # if it's an aliquotgroup, generate a fhirid based on the parent id and aliquotgroup type.
-            if sample.category == "ALIQUOTGROUP":
-                fhirid = genfhirid(sample.parent.id() + sample.type)
-            else:
-                # else generate the fhirid from the sampleid
-                fhirid = genfhirid(sample.id())
-                
-            sample.ids.append( Identifier(code="fhirid", id=fhirid) )
+            fhirid = _sample_fhirid(sample)
+            _add_identifier(sample, "fhirid", fhirid)
 
         # remember the fhirid of this aliquotgroup for later use by its children to reference it.
         # if the sample comes with an oid, remember the fhirid by oid.
         # if the sample comes with an index, remember the fhirid by index.
         # if it comes with neither, we assume that the fhirid references are already complete and we don't need to set anything 
-        if sample.id("oid") is not None:
-            fhiridbyoid[sample.id("oid")] = fhirid
-        if sample.id("index") is not None:
-            fhiridbyindex[sample.id("index")] = fhirid
+        if fhirids is None:
+            if sample.id("oid") is not None:
+                known[("oid", sample.id("oid"))] = (fhirid, i)
+            if sample.id("index") is not None:
+                known[("index", sample.id("index"))] = (fhirid, i)
 
         # the references of aliquotgroups to primary samples should be ok, cause primaries can be referenced via sampleid.
 
@@ -109,84 +188,232 @@ def _fill_in_fhirids(samples):
         if sample.category == "DERIVED":
             parent = sample.parent
             if parent is None:
-                print(f"error: derived sample {sample.id()} has no parent.")
-                # abort?
+                problems["noparent"].append(sample.id())
 
             # do we need a fhirid of the parent?
-            if parent.id("fhirid") is None:
-                pfhirid = None
+            elif parent.id("fhirid") is None:
+                found = None
 
                 # get the remembered fhirid of the parent via oid or index
                 poid = parent.id("oid")
                 pindex = parent.id("index")
-                if poid is not None and poid in fhiridbyoid:
-                    pfhirid = fhiridbyoid[poid]
-                elif pindex is not None and pindex in fhiridbyindex:
-                    pfhirid = fhiridbyindex[pindex]
+                if poid is not None and ("oid", poid) in known:
+                    found = known[("oid", poid)]
+                elif pindex is not None and ("index", pindex) in known:
+                    found = known[("index", pindex)]
+
+                if found is None:
+                    problems["unresolved"].append(sample.id())
+                else:
+                    (pfhirid, ppos) = found
+                    # the parent comes after the aliquot
+                    if ppos > i:
+                        problems["forward"].append(sample.id())
+                    # add the remembered fhirid for the parent
+                    _add_identifier(sample.parent, "fhirid", pfhirid)
+
+        yield sample
+
+    if report:
+        report_fhirid_problems(problems)
+
+def _add_identifier(idable, code:str, id:str):
+    """_add_identifier adds an id to a record from records.py or to a tram Idable, as an Ident or a tram Identifier."""
+    if isinstance(idable, Ids):
+        idable.ids.append(Ident(code=code, id=id))
+    else:
+        from tram import Identifier
+        idable.ids.append(Identifier(code=code, id=id))
+
+def _new_fhirid_problems() -> dict:
+    """_new_fhirid_problems returns an empty collection of fhirid problems: the sampleids of derived samples without parent, of aliquots whose parent fhirid can't be found, and of aliquots that come before their parent."""
+    return {"noparent": [], "unresolved": [], "forward": []}
 
-                # error if we didn't find a fhirid
-                if pfhirid is None:
-                    print(f"error: can't find fhirid for parent aliquotgroup of aliquot {sample.id()}.  does it come before the sample and is it referenced properly via oid or index?")
-                    # abort?
+def report_fhirid_problems(problems:dict, show:int=10):
+    """report_fhirid_problems prints the collected fhirid problems, one line per kind of problem, showing at most show sampleids each."""
 
-            # add the remembered fhirid for the parent
-            if pfhirid is not None:
-                sample.parent.ids.append( Identifier(id=pfhirid, code="fhirid") )
+    def ids(a):
+        s = ", ".join(str(id) for id in a[:show])
+        if len(a) > show:
+            s += f" and {len(a) - show} more"
+        return s
 
-        # increase the index
-        i += 1
+    if len(problems["noparent"]) > 0:
+        print(f"error: {len(problems['noparent'])} derived samples have no parent: {ids(problems['noparent'])}")
+    if len(problems["unresolved"]) > 0:
+        print(f"error: can't find fhirid for parent aliquotgroup of {len(problems['unresolved'])} aliquots: {ids(problems['unresolved'])}. does the aliquotgroup come before its aliquots and is it referenced properly via oid or index?")
+    if len(problems["forward"]) > 0:
+        print(f"warning: {len(problems['forward'])} aliquots come before their parent aliquotgroup: {ids(problems['forward'])}")
 
 
-def write_observations(findings:list, dir:str, batchsize:int, wrap:bool=False, should_print:bool=False, cxx=3) -> list:
-    """write_observations writes fhir resources of observations and returns a list containing the written directory.""" 
+def write_observations(findings:list, dir:str, batchsize:int, wrap:bool=False, should_print:bool=False, cxx=3, serializer:str="pretty", stats=None, max_bytes:int=None) -> list:
+    """write_observations writes fhir resources of observations and returns a list containing the written directory. stats, a stats.Stats, times the stages if given. max_bytes limits the size of the bundles, see iter_bundles.""" 
 
     # get the entries
-    entries = []
-    i = 0
-    for finding in findings:
-        # make a fhirid from sampleid and method code
-        #print("sampleid: " + finding.sample.id())
-        #print("method: " + finding.method)
-        fhirid = genfhirid(finding.sample.id() + finding.method)
-        entries.append(fhir_obs(finding, fhirid=fhirid))
-        i += 1
+    entries = observation_entries(findings)
+    if stats is not None:
+        entries = stats.timed("build", entries)
+    entries = list(entries)
 
     # bundles the entries
-    bundles = bundle(entries, batchsize, restype="Observation", cxx=3)
+    bundles = _bundle_timed(entries, batchsize, "Observation", cxx, stats, max_bytes, serializer)
 
     # if print is set, print
     if should_print:
         print(json.dumps(bundles, indent=4))
 
     # write the bundles
-    return writeout(bundles, dir, "obs", wrap=wrap)
+    return writeout(bundles, dir, "obs", wrap=wrap, serializer=serializer, stats=stats)
 
+def stream_observations(findings, dir:str, batchsize:int, wrap:bool=False, cxx:int=3, serializer:str="pretty", stats=None, max_bytes:int=None) -> list:
+    """stream_observations is write_observations for iterables: it builds, bundles and writes one bundle at a time, so only the current bundle is held in memory."""
+    bundles = _iter_bundles_timed(observation_entries(findings), batchsize, "Observation", cxx, stats, max_bytes, serializer)
+    return writeout(bundles, dir, "obs", wrap=wrap, serializer=serializer, stats=stats)
 
-def bundle(entries, n, restype:str=None, cxx:int=None) -> list:
-    """bundle puts n entries in a bundle each."""
+def observation_entries(findings, fhirids:list=None):
+    """observation_entries yields a fhir entry for each Finding or FindingRecord. the entries are the same as from fhir_obs, built with its compiled template. fhirids are the fhirids of the findings in their order, if they are generated already, e.g. for a whole column with help.genfhirids, otherwise each is generated from sampleid and method code. rejected rows (see validate.py) are passed through in their place."""
+    build_obs = builder("Observation")
+    fhirids = iter(fhirids) if fhirids is not None else None
+    for finding in findings:
+        fhirid = next(fhirids) if fhirids is not None else None
+        if isinstance(finding, RejectedRow):
+            yield finding
+            continue
+        # make a fhirid from sampleid and method code
+        if fhirid is None:
+            fhirid = genfhirid(finding.sample.id() + finding.method)
+        yield build_obs(finding, fhirid=fhirid)
 
-    bundles = []
-    batch = []
 
-    for i, entry in enumerate(entries):
-        # after each n entries
-        if i > 0 and i % n == 0:
-            # append a bundle of the full batch
-            bundles.append(fhir_bundle(batch, restype=restype, cxx=cxx))
-            # reset the batch
-            batch = []
-        # add to the batch
-        batch.append(entry)
+def bundle(entries, n, restype:str=None, cxx:int=None, max_bytes:int=None, serializer:str="pretty", families:bool=False) -> list:
+    """bundle puts n entries in a bundle each, or fewer to keep the bundles under max_bytes or specimen families together, see iter_bundles."""
+    return list(iter_bundles(entries, n, restype=restype, cxx=cxx, max_bytes=max_bytes, serializer=serializer, families=families))
 
-    # append the last batch
-    bundles.append(fhir_bundle(batch, restype=restype, cxx=cxx))
+def iter_bundles(entries, n, restype:str=None, cxx:int=None, max_bytes:int=None, serializer:str="pretty", families:bool=False):
+    """iter_bundles is bundle as a generator: it yields each bundle of n entries as soon as it is full, so entries can be consumed from a generator. with max_bytes or families a bundle may be closed before it has n entries."""
 
-    return bundles
+    batch = []
+    yielded = False
+
+    # with max_bytes, a bundle is also closed before the entry that would make it bigger than max_bytes serialized by serializer (uncompressed), n can be None then.
+    # the size is estimated entry by entry with serialize.estimate_size, without serializing: the size of the bundle without entries, each entry adds its own size.
+    if max_bytes is not None:
+        indent = serializer_indent(serializer)
+        base = estimate_size(fhir_bundle([0], restype=restype, cxx=cxx), indent) - list_item_size(0, indent, 2)
+        size = base
+
+    # the entries that go into the same bundle. with families, those of a family, a sample with its aliquotgroups and aliquots, so that the references between them are resolved within one transaction, see _family_units.
+    problems = None
+    if families:
+        problems = {"apart": [], "split": 0}
+        units = _family_units(entries, problems)
+    else:
+        units = ((entry,) for entry in entries)
+
+    for unit in units:
+        if max_bytes is not None:
+            # the entries are at depth 2, in the entry list of the bundle
+            sizes = [list_item_size(entry, indent, 2) for entry in unit]
+        # close the bundle before this unit if it doesn't fit anymore
+        if len(batch) > 0 and ((n is not None and len(batch) + len(unit) > n) or (max_bytes is not None and size + sum(sizes) > max_bytes)):
+            yield fhir_bundle(batch, restype=restype, cxx=cxx)
+            yielded = True
+            batch = []
+            if max_bytes is not None:
+                size = base
+        # a unit that still doesn't fit is split, parents first. an entry that is bigger by itself gets a bundle of its own.
+        split = False
+        for (i, entry) in enumerate(unit):
+            if max_bytes is not None:
+                if len(batch) > 0 and size + sizes[i] > max_bytes:
+                    yield fhir_bundle(batch, restype=restype, cxx=cxx)
+                    yielded = True
+                    batch = []
+                    size = base
+                    split = True
+                size += sizes[i]
+            # add to the batch
+            batch.append(entry)
+            # after each n entries
+            if len(batch) == n:
+                # yield a bundle of the full batch
+                yield fhir_bundle(batch, restype=restype, cxx=cxx)
+                yielded = True
+                # reset the batch
+                batch = []
+                if max_bytes is not None:
+                    size = base
+                split = split or i < len(unit) - 1
+        if split and problems is not None:
+            problems["split"] += 1
+
+    # yield the last batch, or an empty bundle for no entries
+    if len(batch) > 0 or not yielded:
+        yield fhir_bundle(batch, restype=restype, cxx=cxx)
+
+    if problems is not None:
+        report_family_problems(problems)
+
+def _family_units(entries, problems:dict):
+    """_family_units yields the entries in tuples of specimen families: a sample without parent, followed by the samples that reference it or its children as parent, by fhirid or identifier. a family is only kept together if its samples come one after the other, the entries aren't reordered, so that the bundles keep the order of the rows. the samples that don't follow their parent start a tuple of their own, they are listed in problems["apart"]."""
+    unit = []
+    # the fullUrls and identifiers of the samples of the current family
+    keys = set()
+    for entry in entries:
+        resource = entry["resource"]
+        parents = [_reference_key(parent) for parent in resource.get("parent", [])]
+        if not any(key in keys for key in parents):
+            # a new family, or a sample apart from its parent
+            if len(unit) > 0:
+                yield tuple(unit)
+            unit = []
+            keys = set()
+            if len(parents) > 0:
+                problems["apart"].append(entry.get("fullUrl"))
+        unit.append(entry)
+        keys.add(("reference", entry.get("fullUrl")))
+        for identifier in resource.get("identifier", []):
+            keys.add(_identifier_key(identifier))
+    if len(unit) > 0:
+        yield tuple(unit)
+
+def _reference_key(reference:dict) -> tuple:
+    """_reference_key returns the key of a fhir reference to a specimen, by fhirid or by identifier."""
+    if "reference" in reference:
+        return ("reference", reference["reference"])
+    return _identifier_key(reference.get("identifier", {}))
+
+def _identifier_key(identifier:dict) -> tuple:
+    """_identifier_key returns the key of a fhir identifier, its code and value."""
+    codings = identifier.get("type", {}).get("coding", [])
+    code = codings[0].get("code") if len(codings) > 0 else None
+    return ("identifier", code, identifier.get("value"))
+
+def report_family_problems(problems:dict, show:int=10):
+    """report_family_problems prints how many specimens were put into another bundle than their parent, then the bundles need to be imported in order."""
+    if len(problems["apart"]) > 0:
+        print(f"warning: {len(problems['apart'])} specimens don't follow their parent or their family, they are bundled apart from their parent: {', '.join(str(url) for url in problems['apart'][:show])}{', ...' if len(problems['apart']) > show else ''}. import the bundles in order.")
+    if problems["split"] > 0:
+        print(f"warning: {problems['split']} specimen families are too big for one bundle and were split, parents first. import the bundles in order.")
+
+def _bundle_timed(entries:list, n:int, restype:str, cxx:int, stats=None, max_bytes:int=None, serializer:str="pretty", families:bool=False) -> list:
+    """_bundle_timed is bundle, timed by stats if given."""
+    if stats is None:
+        return bundle(entries, n, restype=restype, cxx=cxx, max_bytes=max_bytes, serializer=serializer, families=families)
+    return list(stats.timed("bundle", iter_bundles(entries, n, restype=restype, cxx=cxx, max_bytes=max_bytes, serializer=serializer, families=families)))
+
+def _iter_bundles_timed(entries, n:int, restype:str, cxx:int, stats=None, max_bytes:int=None, serializer:str="pretty", families:bool=False):
+    """_iter_bundles_timed is iter_bundles, with the building of the entries and the bundling timed by stats if given."""
+    if stats is None:
+        return iter_bundles(entries, n, restype=restype, cxx=cxx, max_bytes=max_bytes, serializer=serializer, families=families)
+    return stats.timed("bundle", iter_bundles(stats.timed("build", entries), n, restype=restype, cxx=cxx, max_bytes=max_bytes, serializer=serializer, families=families))
     
     
-def writeout(bundles:list, dir:str, type:str, wrap:bool=False):
-    """writeout writes fhir bundles into a directory as seperate files, wrapping them into a timestamped directory if wrap is True."""
-    timestamp = datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
+def writeout(bundles, dir:str, type:str, wrap:bool=False, serializer:str="pretty", compress:str=None, archive:str=None, background:bool=False, queue_size:int=8, fsync:bool=False, timestamp:str=None, start_page:int=0, checkpoint=None, stats=None, sink=None):
+    """writeout writes fhir bundles into a directory as seperate files, wrapping them into a timestamped directory if wrap is True. bundles can be a list or any iterable, e.g. from iter_bundles, iterables are written one bundle at a time."""
+    # a continued run (see manifest.py) passes the timestamp of its files and the number of its first page
+    if timestamp is None:
+        timestamp = datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
 
     # wrap the output into a timestamped directory if wished
     outdir = None
@@ -199,20 +426,127 @@ def writeout(bundles:list, dir:str, type:str, wrap:bool=False):
     os.makedirs(outdir, exist_ok=True)    
     
     # how broad should the zero-place holder for the pagenumber in the filenames be? (eg for 999 pages 3, for 1000 pages 4)
-    page_num_width = str(int(math.log10(len(bundles))) + 1)
+    # for a list we know it up front, for other iterables only after the last page, the first files are renamed then.
+    page_num_width = None
+    if isinstance(bundles, (list, tuple)):
+        page_num_width = _page_num_width(len(bundles))
+
+    # serializer names a serializer of serialize.get_serializer
+    serialize = get_serializer(serializer)
+
+    # where the pages go if no sink, e.g. a sinks.HttpSink, is given: an archive (tar or zip), compressed as a whole with compress (zip only with gzip, which becomes deflate), or files in dir, each compressed with compress.
+    # members of an archive can't be renamed, so the page numbers of iterables are padded to at least archive_page_width there.
+    if sink is None and archive is not None:
+        sink = open_archive(os.path.join(outdir, f"{timestamp}_{type}"), archive, compress=compress)
+        if page_num_width is None:
+            page_num_width = archive_page_width
+    elif sink is None:
+        sink = DirSink(outdir, compress=compress, fsync=fsync)
+
+    # time the serializing and writing, also in the background
+    if stats is not None:
+        serialize = stats.timed_call("serialize", serialize)
+        sink.write = stats.timed_write(sink.write)
+
+    # write in the background if wished, while the next bundles are built. at most queue_size bundles wait to be written.
+    writer = None
+    if background:
+        writer = BackgroundWriter(sink, serialize, maxsize=queue_size)
 
     # write each bundle in a seperate file, using the same timestamp and increasing page numbers.
-    for i, bundle in enumerate(bundles):
-        fstring = "%s_%s_p%0" + page_num_width + "d.json"
-        filename = fstring % (timestamp, type, i)
-        # filename = timestamp + "_" + type + "_p" + str(i) + ".json"
-        path = os.path.join(outdir, filename)
-        with open(path, 'w', encoding='utf-8') as outf:
-            json.dump(bundle, outf, indent=4, ensure_ascii=False)
+    n = 0
+    failures = []
+    try:
+        for i, bundle in enumerate(bundles, start_page):
+            name = _page_filename(timestamp, type, i, page_num_width)
+            # take the position in the input at the end of the page now, the checkpoint records it in the manifest once the page is written
+            written = checkpoint.page(i, name, bundle) if checkpoint is not None else None
+            if writer is not None:
+                writer.write(i, name, bundle, written)
+            else:
+                try:
+                    data = serialize(bundle)
+                    sink.write(name, data)
+                except OSError as e:
+                    raise WriteError([(i, name, e)]) from e
+                if written is not None:
+                    written(data)
+            n += 1
+    finally:
+        if writer is not None:
+            writer.close()
+            failures = writer.failures
+        else:
+            sink.close()
+    # the pages a sink failed to send after it took them
+    failures = failures + getattr(sink, "failures", [])
+
+    # pad the page numbers of the files that were written before the page count was known, including those of the run that is continued
+    total = start_page + n
+    if page_num_width is None and total > 0:
+        failed = set(page for (page, name, e) in failures)
+        width = _page_num_width(total)
+        for i in range(min(total, 10 ** (width - 1))):
+            if i not in failed:
+                sink.rename(_page_filename(timestamp, type, i), _page_filename(timestamp, type, i, width))
+
+    # the pages that failed are raised after the other pages are written, in the foreground the first failure is raised right away
+    if len(failures) > 0:
+        raise WriteError(failures)
+
+    if checkpoint is not None:
+        checkpoint.finish(total)
 
     # for now, only return the directory path, not the paths of the written files
     return [outdir]
 
+# the least width of the page numbers in archives of bundles from iterables
+archive_page_width = 4
+
+def writeout_ndjson(entries, dir:str, wrap:bool=False, serializer:str="compact", compress:str=None, stats=None):
+    """writeout_ndjson writes the resources of fhir entries as newline-delimited json (fhir bulk data format), one resource per line and one file per resource type, e.g. Specimen.ndjson, Observation.ndjson and Patient.ndjson. entries are what fhir_specimen, fhir_aliquotgroup, fhir_obs and fhir_patient return, they can come from a generator. the request part of the entries is not written. it wraps the files into a timestamped directory if wrap is True. the serializer must not put line breaks, so pretty is not allowed. compress (gzip or zstd) compresses the files while they are written. stats, a stats.Stats, times the serializing and writing and counts the bytes written if given."""
+    if serializer == "pretty":
+        raise ValueError("ndjson needs one resource per line, use the compact or fast serializer")
+    serialize = get_serializer(serializer)
+    if stats is not None:
+        serialize = stats.timed_call("serialize", serialize)
+
+    # wrap the output into a timestamped directory if wished
+    outdir = dir
+    if wrap:
+        outdir = os.path.join(dir, datetime.now().strftime("%Y-%m-%d_%H-%M-%S"))
+    os.makedirs(outdir, exist_ok=True)
+
+    # one open file per resource type
+    files = {}
+    try:
+        for entry in entries:
+            resource = entry["resource"]
+            restype = resource["resourceType"]
+            if restype not in files:
+                files[restype] = open_compressed(os.path.join(outdir, restype + ".ndjson" + compressions.get(compress, "")), compress)
+            line = serialize(resource) + b"\n"
+            if stats is not None:
+                with stats.stage("write"):
+                    files[restype].write(line)
+                stats.bytes_written += len(line)
+            else:
+                files[restype].write(line)
+    finally:
+        for f in files.values():
+            f.close()
+
+    return [outdir]
+
+def _page_num_width(n:int) -> int:
+    """_page_num_width returns the number of digits for the page numbers of n pages."""
+    return int(math.log10(n)) + 1
+
+def _page_filename(timestamp:str, type:str, i:int, width:int=None) -> str:
+    """_page_filename returns the filename of page i, with the page number zero-padded to width. a compression adds its suffix on writing."""
+    fstring = "%s_%s_p%0" + str(width or 1) + "d.json"
+    return fstring % (timestamp, type, i)
+
 
 
 def fhir_identifier(identifier:Identifier, system:str="urn:centraxx"):
@@ -260,7 +594,7 @@ def fhir_extension(url:str, d):
 
 def fhir_specimen(sample:Sample=None,
                 update_with_overwrite:bool=False ): 
-    """fhir_specimen builds a fhir specimen. pass the sample's fhirid as an Identifier with code 'fhirid' for the sample, and, for deriveds, the fhirid of its parent aliquotgroup as an Identifier with code 'fhirid' of sample.parent. by tying the fhirids directly to the sample, calling methods can receive fhirids for lists of Samples e.g. from csv without having to sneak them in via an extra argument."""
+    """fhir_specimen builds a fhir specimen from a Sample or SampleRecord. pass the sample's fhirid as an Identifier with code 'fhirid' for the sample, and, for deriveds, the fhirid of its parent aliquotgroup as an Identifier with code 'fhirid' of sample.parent. by tying the fhirids directly to the sample, calling methods can receive fhirids for lists of Samples e.g. from csv without having to sneak them in via an extra argument."""
 
     # todo also build aliquotgroups?
     
@@ -485,7 +819,7 @@ def fhir_aliquotgroup(
         parent_fhirid:str=None,
         update_with_overwrite:bool=False
 ):
-    """fhir_aliquotgroup builds a fhir aliquotgroup from a Sample. pass fhirids as Identifiers with code "fhirid" of sample and sample.parent."""
+    """fhir_aliquotgroup builds a fhir aliquotgroup from a Sample or SampleRecord. pass fhirids as Identifiers with code "fhirid" of sample and sample.parent."""
     entry = {
         "fullUrl": f"Specimen/{sample.id('fhirid')}",
         "resource": {
@@ -579,10 +913,12 @@ def fhir_obs(
         update_with_overwrite:bool=False,
         delete:bool=False        
 ):
-    """fhir_obs builds a fhir observation from Finding."""
+    """fhir_obs builds a fhir observation from a Finding or FindingRecord."""
+    # imported on use, components imports tram
+    from fhirbuild.components import emit_component
+
     if finding.sample is None:
-        print("error: no sample id")
-        exit()
+        raise ValueError("the finding has no sample id")
 
     # if no fhirid given, generate
     if fhirid is None:
@@ -647,50 +983,9 @@ def fhir_obs(
                 ]
             }
         }
-        # put something different depending on the type of the rec
-        if type(rec) is BooleanRec:
-            comp["valueBoolean"] = bool(rec.rec)
-        if type(rec) is NumberRec: # are numbers always turned to quantities? # todo
-            comp["valueQuantity"] = {
-                # shouldn't NumberRec.value already be a float?
-                "value": float(rec.rec) if rec.value is not None else 0 # todo setting 0 is not right actually, cause the db returns NULL, but None isn't accepted by fhirimporter 
-            }
-            # set the unit only if it is there
-            if rec.unit is not None and "valueQuantity" in comp:
-                comp["valueQuantity"]["unit"] = rec.unit # from laborvalue
-
-        if type(rec) is StringRec:
-            comp["valueString"] = str(rec.rec)
-            # somehow strings may not be empty or null, so don't add the component if that's the case? todo how to delete a string?
-            if str(rec.rec) is None or str(rec.rec) == "":
-                continue # continue without adding the component
-        if type(rec) is DateRec: 
-            comp["valueDateTime"] = datestring(rec.rec) 
-        if type(rec) is MultiRec:
-            # collect the values 
-            a = []
-            for val in rec.rec:
-                a.append({
-                    "system": "urn:centraxx:CodeSystem/UsageEntry-x", # sometimes the x is oid, but doesn't seem to need to be
-                    "code": str(val)
-                    })
-            # put the collected values into the coding field of a value codeable concept
-            comp["valueCodeableConcept"] = {
-                "coding": a
-            }
-        if type(rec) is CatalogRec:
-            # collect the values 
-            a = []
-            for val in rec.rec:
-                a.append({
-                    "system": f"urn:centraxx:CodeSystem/ValueList-{rec.catalog}", # here apparently the catalog code is needed
-                    "code": str(val)
-                    })
-            # put the collected values into the coding field of a value codeable concept
-            comp["valueCodeableConcept"] = {
-                "coding": a
-            }
-            
+        # put something different depending on the type of the rec, see components.py
+        if not emit_component(comp, rec):
+            continue # continue without adding the component
 
         entry["resource"]["component"].append(comp)
 
@@ -1,10 +1,14 @@
 # __main__.py is called on python -m fhirbuild
 
+import os
 import sys
 import argparse
-from fhirbuild.csvtofhir import csv_to_samples, csv_to_findings, csv_to_patient_fhir
-from fhirbuild import writeout, write_samples, write_observations, bundle
-import fhirbuild.help as fbh
+from contextlib import ExitStack, nullcontext
+from fhirbuild.serialize import serializers
+from fhirbuild.sinks import compressions, archives
+
+# the rest of fhirbuild is imported in run and only where an option needs
+# it, so that --help and argument errors don't wait for the imports.
 
 def parseargs():
     """parseargs parses command line arguments."""
@@ -18,39 +22,263 @@ def parseargs():
     parser.add_argument("--delete", help="delete these fhir resources")
     parser.add_argument("--cxx", help="cxx version. 3|4")
     parser.add_argument("--mainidc", help="the idcontainer from which the fhirid is built, can be left out if there is only one idcontainer given.")
+    parser.add_argument("--format", help="bundle (default): transaction bundles, one file per page. ndjson: one resource per line, one file per resource type (fhir bulk data)", choices=["bundle", "ndjson"], default="bundle")
+    parser.add_argument("--json", help="how the json is written: pretty (indented, default), compact (no whitespace) or fast (compact via orjson if installed)", choices=serializers, default="pretty")
+    parser.add_argument("--tz", help="the time zone of the dates without one: an offset like +01:00 (default), UTC, or a zone name like Europe/Berlin, which follows summer time. dates with an offset keep it.", metavar="ZONE")
+    parser.add_argument("--compress", help="compress each written file with gzip or zstd (zstd needs the zstandard package)", choices=list(compressions))
+    parser.add_argument("--archive", help="write all pages into one tar or zip archive instead of one file per page. with --compress a tar archive is compressed as a whole", choices=archives)
+    parser.add_argument("--background", help="write the pages in a background thread while the next pages are built", action="store_true")
+    parser.add_argument("--fsync", help="flush each written file to disk", action="store_true")
+    parser.add_argument("--workers", help="convert the csv rows in this many processes (default 1)", type=int, default=1)
+    parser.add_argument("--manifest", help="record the progress of the run in a manifest in outdir, so it can be resumed with --resume", action="store_true")
+    parser.add_argument("--resume", help="continue the run recorded in the manifest in outdir after its last complete page, with the same input and options. starts a new run with a manifest if there is none", action="store_true")
+    parser.add_argument("--changed-only", help="write only the resources that are new or changed since the last run with this store, a sqlite file that maps each resource to a hash of its entry. it is created if it doesn't exist and updated after the output is written", metavar="STORE")
+    parser.add_argument("--rejects", help="write the rows that don't pass the checks to this csv, with their row numbers and errors (default <name>_rejects.csv in outdir). it is only written if rows are rejected", metavar="FILE")
+    parser.add_argument("--fail-fast", help="stop at the first row that doesn't pass the checks, instead of rejecting it and going on", action="store_true")
+    parser.add_argument("--reader", help="how the csv is read: csv (default, row by row with csv.DictReader) or pandas (column-wise, in chunks). --workers reads with csv", choices=["csv", "pandas"], default="csv")
+    parser.add_argument("--batchsize", help="the most entries per bundle (default 10), 0 for no limit with --max-bytes", type=int, default=10)
+    parser.add_argument("--max-bytes", help="also close a bundle before it gets bigger than this many bytes serialized (before compression). the size is estimated entry by entry, an entry that is bigger by itself gets a bundle of its own", type=int)
+    parser.add_argument("--families", help="for specimens, keep each family, a sample with its aliquotgroups and aliquots, in the same bundle, if its rows come one after the other. a bundle then may have fewer entries than --batchsize, a family that doesn't fit into one bundle is split", action="store_true")
+    parser.add_argument("--upload", help="send each bundle as a transaction to the fhir server at this base url instead of writing it to a file. the result of each page goes to <type>_upload.ndjson in outdir", metavar="URL")
+    parser.add_argument("--upload-in-flight", help="send this many bundles at the same time (default 4)", type=int, default=4)
+    parser.add_argument("--upload-retries", help="send a bundle again this many times after a connection error or a 429 or 5xx status (default 3), waiting 1, 2, 4... seconds or as long as the server asks", type=int, default=3)
+    parser.add_argument("--upload-timeout", help="seconds to wait for the server (default 60)", type=float, default=60.0)
+    parser.add_argument("--upload-header", help="send this header with each bundle, like 'Authorization: Bearer ...'. can be given more than once", action="append", default=[])
+    parser.add_argument("--keep-files", help="with --upload, also write the bundles into files in outdir", action="store_true")
+    parser.add_argument("--stats", help="print how long each stage of the run took, the rows and entries per second, the bytes written and the peak memory", action="store_true")
+    parser.add_argument("--stats-json", help="write the stats of --stats to this json file", metavar="FILE")
+    parser.add_argument("--profile", help="profile the run with cProfile and write the stats to this file, for pstats, and the collapsed stacks to the file with the extension .folded, for flame graphs. the worker processes aren't profiled", metavar="FILE")
     args = parser.parse_args()
     return args
 
 
 
 
+def upload_headers(headers:list) -> dict:
+    """upload_headers turns 'Name: value' strings into a dict of headers."""
+    out = {}
+    for header in headers:
+        (key, sep, value) = header.partition(":")
+        if sep == "" or key.strip() == "":
+            raise ValueError(f"the header {header} needs to look like 'Name: value'")
+        out[key.strip()] = value.strip()
+    return out
+
 def main():
     """main turns csv from file to fhir for specimen, patient or observation."""
     args = parseargs()
 
+    # profile the run if asked
+    if args.profile is not None:
+        from fhirbuild.profiling import profiled
+        with profiled(args.profile):
+            return run(args)
+    return run(args)
+
+def run(args):
+    """run runs the conversion for the parsed command line arguments."""
+    from fhirbuild.csvtofhir import csv_to_entries, csv_file_entries, prescan_fhirids, restypes
+    from fhirbuild.schema import compile_schema, warn_unknown
+    from fhirbuild import writeout, writeout_ndjson, iter_bundles
+    from fhirbuild.sinks import WriteError
+    from fhirbuild.validate import Rejects, RowError
+    import fhirbuild.help as fbh
+
     delimiter = ";"
     if args.d != None:
         delimiter = args.d
 
-    # read the csv
-    dict_reader = fbh.open_csv_file(args.incsv, delimiter=delimiter, encoding=args.e)
-
-    # build what's needed
-    match args.type:
-        case "observation":
-            findings = csv_to_findings(dict_reader, args.delim_cmp)
-            write_observations(findings, dir=args.outdir, batchsize=10, cxx=3)
-        case "specimen":
-            samples = csv_to_samples(dict_reader, mainidc=args.mainidc)
-            write_samples(samples, dir=args.outdir, batchsize=10, cxx=3)
-        case "patient":
-            # at the moment don't make Patient instances, cause each csv row carries an updateWithOverwrite field that couldn't be saved directly to Patients at the moment (make a FhirPatient that inherits from Patient? maybe that's a bit overdone). could we pass a --update-with-overwrite flag for all rows, or does it make sense to keep this row-specific?
-            entries = csv_to_patient_fhir(dict_reader, mainidc=args.mainidc)
-            bundles = bundle(entries, 10, restype="Patient", cxx=3)
-            writeout(bundles, args.outdir, args.type)
-        case _:
-            print(f"Unknown type: {args.type}")
+    if args.type not in restypes:
+        print(f"Unknown type: {args.type}")
+        sys.exit(1)
+    (restype, name) = restypes[args.type]
+
+    if args.batchsize < 0 or (args.batchsize == 0 and args.max_bytes is None):
+        print("error: --batchsize needs to be positive, or 0 with --max-bytes")
+        sys.exit(1)
+    if args.max_bytes is not None and args.max_bytes <= 0:
+        print("error: --max-bytes needs to be positive")
+        sys.exit(1)
+    # no limit on the number of entries
+    if args.batchsize == 0:
+        args.batchsize = None
+
+    if args.upload is not None and (args.format != "bundle" or args.archive is not None or args.manifest or args.resume):
+        print("error: --upload sends bundles, it doesn't go with ndjson, archives, --manifest or --resume")
+        sys.exit(1)
+    if args.format == "ndjson" and (args.archive is not None or args.background or args.max_bytes is not None or args.families):
+        print("error: --format ndjson writes one file per resource type, it doesn't go with --archive, --background, --max-bytes or --families")
+        sys.exit(1)
+
+    # the zone of the dates without one
+    from fhirbuild.dates import set_timezone
+    try:
+        set_timezone(args.tz)
+    except ValueError as e:
+        print(f"error: {e}")
+        sys.exit(1)
+
+    # time the stages only if asked, else the pipeline isn't wrapped
+    stats = None
+    if args.stats or args.stats_json is not None:
+        from fhirbuild.stats import Stats
+        stats = Stats()
+
+    # compile the header once, checking the columns before any row is converted
+    try:
+        with fbh.csv_file(args.incsv, delimiter=delimiter, encoding=args.e) as header:
+            schema = compile_schema(header.fieldnames, args.type)
+    except ValueError as e:
+        print(f"error: {e}")
+        sys.exit(1)
+    warn_unknown(schema)
+
+    # record the progress in a manifest, or continue the run of a manifest, from a byte offset into the csv
+    checkpoint = None
+    (start_row, start_page, timestamp) = (0, 0, None)
+    if args.manifest or args.resume:
+        if args.format != "bundle" or args.archive is not None:
+            print("error: --manifest and --resume write bundles into files of their own, not ndjson or archives")
+            sys.exit(1)
+        # the options that shape the output, a resumed run needs the same
+        from fhirbuild.manifest import start_run
+        options = {"type": args.type, "delimiter": delimiter, "encoding": args.e, "mainidc": args.mainidc, "delim_cmp": args.delim_cmp, "json": args.json, "compress": args.compress, "cxx": 3, "batchsize": args.batchsize, "max_bytes": args.max_bytes, "families": args.families, "tz": args.tz}
+        try:
+            started = start_run(args.incsv, args.outdir, name, options, resume=args.resume, delimiter=delimiter, encoding=args.e)
+        except ValueError as e:
+            print(f"error: {e}")
+            sys.exit(1)
+        if started is None:
+            return 0
+        (checkpoint, dict_reader, start_row, start_page, timestamp) = started
+
+    # the rows are checked before they are converted, those that don't pass go to the rejects csv, or stop the run with --fail-fast. the rejected rows count as done for the manifest.
+    rejects = Rejects(None if args.fail_fast else (args.rejects or os.path.join(args.outdir, f"{name}_rejects.csv")), schema.fieldnames, delimiter=delimiter, encoding=args.e, fail_fast=args.fail_fast, on_reject=checkpoint.skip if checkpoint is not None else None, keep=start_row)
+
+    # in parallel, the workers read byte ranges of whole rows from the memory-mapped csv by themselves. the manifest takes the rows from this process.
+    mapped = None
+    (ranges, starts) = (None, None)
+    if args.workers > 1 and checkpoint is None:
+        from fhirbuild.reader import MappedCsv
+        try:
+            mapped = MappedCsv(args.incsv, delimiter=delimiter, encoding=args.e)
+        except ValueError as e:
+            print(f"error: {e}")
             sys.exit(1)
+        ranges = mapped.ranges()
+
+    # for converting specimens in parallel or from the middle of the csv, first collect the fhirids that aliquots reference, so the rows can be resolved without the rows before them
+    fhirids = None
+    if args.type == "specimen" and (args.workers > 1 or start_row > 0):
+        if mapped is not None:
+            # the row numbers of the ranges come along
+            starts = []
+            prescan = nullcontext(mapped.iter_ranges(ranges, starts))
+        else:
+            prescan = fbh.csv_file(args.incsv, delimiter=delimiter, encoding=args.e)
+        with prescan as prescan_reader:
+            if stats is not None:
+                with stats.stage("prescan"):
+                    fhirids = prescan_fhirids(prescan_reader, mainidc=args.mainidc, schema=schema, validate=True)
+            else:
+                fhirids = prescan_fhirids(prescan_reader, mainidc=args.mainidc, schema=schema, validate=True)
+
+    # the csv read row by row here is closed at the end
+    files = ExitStack()
+
+    # read the csv column-wise with pandas, or row by row. the worker processes and the manifest take rows.
+    reader = args.reader
+    if args.workers > 1 or checkpoint is not None:
+        reader = "csv"
+    if reader == "pandas":
+        # imported only here, pandas takes a while to import
+        import fhirbuild.columnar as columnar
+        if not columnar.available():
+            print("pandas isn't installed, reading the csv with csv.DictReader")
+            reader = "csv"
+
+    # build what's needed. the rows are streamed: each row (or chunk of rows) is read, converted and bundled, and each bundle is written as soon as it is full.
+    # for patients, at the moment don't make Patient instances, cause each csv row carries an updateWithOverwrite field that couldn't be saved directly to Patients at the moment (make a FhirPatient that inherits from Patient? maybe that's a bit overdone). could we pass a --update-with-overwrite flag for all rows, or does it make sense to keep this row-specific?
+    if reader == "pandas":
+        entries = columnar.columnar_entries(args.incsv, args.type, delimiter=delimiter, encoding=args.e, mainidc=args.mainidc, delim_cmp=args.delim_cmp, fhirids=fhirids, schema=schema, rejects=rejects)
+        if stats is not None:
+            # reading and converting happen together by chunk here
+            entries = stats.timed("build", entries)
+    elif mapped is not None:
+        entries = csv_file_entries(mapped, args.type, ranges=ranges, starts=starts, mainidc=args.mainidc, delim_cmp=args.delim_cmp, workers=args.workers, fhirids=fhirids, schema=schema, stats=stats, rejects=rejects)
+        if stats is not None:
+            entries = stats.timed("build", entries)
+    else:
+        if checkpoint is None:
+            dict_reader = files.enter_context(fbh.csv_file(args.incsv, delimiter=delimiter, encoding=args.e))
+        rows = dict_reader
+        if stats is not None:
+            rows = stats.timed("read", rows)
+        entries = csv_to_entries(rows, args.type, mainidc=args.mainidc, delim_cmp=args.delim_cmp, workers=args.workers, fhirids=fhirids, schema=schema, start=start_row, stats=stats, rejects=rejects)
+        if stats is not None:
+            entries = stats.timed("build", entries)
+        if checkpoint is not None:
+            entries = checkpoint.count(entries)
+
+    # leave out what didn't change since the last run
+    store = None
+    if args.changed_only is not None:
+        from fhirbuild.changes import ChangeStore
+        store = ChangeStore(args.changed_only)
+        entries = store.filter(entries)
+        if stats is not None:
+            entries = stats.timed("changes", entries)
+
+    # the checkpoint and the rejects are closed however the writing ends
+    try:
+        if args.format == "ndjson":
+            # ndjson can't be indented, take compact then
+            serializer = args.json if args.json != "pretty" else "compact"
+            writeout_ndjson(entries, args.outdir, serializer=serializer, compress=args.compress, stats=stats)
+        else:
+            bundles = iter_bundles(entries, args.batchsize, restype=restype, cxx=3, max_bytes=args.max_bytes, serializer=args.json, families=args.families and args.type == "specimen")
+            if stats is not None:
+                bundles = stats.timed("bundle", bundles)
+            # send the bundles to a fhir server, and write them into files if wished
+            sink = None
+            if args.upload is not None:
+                from fhirbuild.sinks import DirSink, HttpSink, TeeSink
+                os.makedirs(args.outdir, exist_ok=True)
+                try:
+                    headers = upload_headers(args.upload_header)
+                    sink = HttpSink(args.upload, log=os.path.join(args.outdir, f"{name}_upload.ndjson"), in_flight=args.upload_in_flight, retries=args.upload_retries, timeout=args.upload_timeout, headers=headers, compress=args.compress)
+                except ValueError as e:
+                    print(f"error: {e}")
+                    sys.exit(1)
+                if args.keep_files:
+                    sink = TeeSink([DirSink(args.outdir, compress=args.compress, fsync=args.fsync), sink])
+            writeout(bundles, args.outdir, name, serializer=args.json, compress=args.compress, archive=args.archive, background=args.background, fsync=args.fsync, timestamp=timestamp, start_page=start_page, checkpoint=checkpoint, stats=stats, sink=sink)
+    except (WriteError, RowError) as e:
+        print(f"error: {e}")
+        sys.exit(1)
+    finally:
+        if checkpoint is not None:
+            checkpoint.close()
+        rejects.close()
+
+    if mapped is not None:
+        mapped.close()
+    files.close()
+
+    rejects.report()
+
+    # the output is written, remember what was written for the next run
+    if store is not None:
+        store.commit()
+        store.close()
+        print(f"{store.changed} of {store.seen} resources are new or changed")
+
+    if stats is not None:
+        stats.done()
+        if args.stats:
+            stats.report()
+        if args.stats_json is not None:
+            stats.write_json(args.stats_json)
             
 
 # kick off program
@@ -0,0 +1,348 @@
+# bench.py benchmarks fhirbuild on synthetic csv files, stage by stage
+
+# python -m fhirbuild.bench generates a specimen, observation and patient
+# csv in the column layouts of readme.md, the same for the same seed, and
+# times each stage of the conversion on its own: reading the csv, the
+# row_to_* conversion, filling in the fhirids (specimens), building the
+# fhir entries, bundling and writing. each stage is run repeat times, the
+# results are written as json, to be compared between releases.
+
+# the startup is timed too, in new interpreters like from a cron job:
+# python -X importtime -m fhirbuild --help, and a run on 10 rows. it guards
+# the lazy imports, --help shouldn't load any of heavy_modules, and a plain
+# run only those of run_needs.
+
+import argparse
+import csv
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+# the columns of the csv files, as in readme.md
+specimen_columns = ["category", "sidc_SAMPLEID", "sidc_EXTSAMPLEID", "mainidc", "pidc_LIMSPSN", "fhirid", "index", "parent_fhirid", "parent_index", "parent_sampleid", "parent_idc", "collection_date", "derival_date", "received_date", "reposition_date", "initial_amount", "initial_unit", "rest_amount", "rest_unit", "location_path", "organization_unit", "receptacle", "type", "xpos", "ypos", "concentration", "concentration_unit"]
+observation_columns = ["sidc_SAMPLEID", "pidc_LIMSPSN", "effective_date_time", "methodname", "method", "sender"]
+patient_columns = ["pidc_LIMSPSN", "pidc_MPI", "mainidc", "fhirid", "organization_unit"]
+
+# the component types the observation components cycle through
+component_types = ["NUMBER", "STRING", "BOOLEAN", "DATE", "MULTI", "CATALOG"]
+
+# the stages that are timed
+stages = ["read", "row_to", "fill_in_fhirids", "build", "bundle", "writeout"]
+
+# the modules that --help shouldn't import, a run imports them when it needs them
+heavy_modules = ["tram", "dict_path", "pandas", "numpy", "orjson", "zstandard", "concurrent.futures", "multiprocessing", "http.client", "sqlite3", "tarfile", "zipfile", "mmap"]
+
+# the heavy modules a plain run of each type needs: observations make tram Recs of the components
+run_needs = {"specimen": [], "observation": ["tram"], "patient": []}
+
+# the rows of the csv files for the startup runs
+startup_rows = 10
+
+def generate_csv(path:str, type:str, rows:int, components:int=4, aliquots:int=2, nullish:float=0.1, seed:int=0, delimiter:str=";"):
+    """generate_csv writes a synthetic csv of type specimen, observation or patient with rows rows to path. components is the number of components of each observation. for specimens, each primary sample is followed by an aliquotgroup with aliquots aliquots, 0 leaves out aliquotgroups and aliquots. nullish is the share of optional cells that are left empty or NULL. the same arguments give the same file."""
+    rand = random.Random(seed)
+    with open(path, "w", encoding="utf-8", newline="") as f:
+        writer = csv.writer(f, delimiter=delimiter, lineterminator="\n")
+        match type:
+            case "specimen":
+                writer.writerow(specimen_columns)
+                for row in _specimen_rows(rand, rows, aliquots, nullish):
+                    writer.writerow([row.get(column, "") for column in specimen_columns])
+            case "observation":
+                codes = [f"C{i}" for i in range(components)]
+                header = observation_columns + [f"cmp_{tv}_{code}" for code in codes for tv in ["t", "v"]]
+                writer.writerow(header)
+                for i in range(rows):
+                    writer.writerow(_observation_row(rand, i, codes, nullish))
+            case "patient":
+                writer.writerow(patient_columns)
+                for i in range(rows):
+                    writer.writerow([f"lims_{i}", f"mpi_{i}", "LIMSPSN", "", _pick(rand, ["NUM_W", "NUM_G"])])
+            case _:
+                raise ValueError(f"unknown type: {type}, choose from specimen, observation, patient")
+
+def _specimen_rows(rand, rows:int, aliquots:int, nullish:float):
+    """_specimen_rows yields rows dicts of primary samples, each followed by its aliquotgroup and aliquots."""
+    n = 0
+    group = 0
+    while n < rows:
+        sampleid = f"{100000 + n}"
+        patient = f"lims_{rand.randrange(rows // 10 + 1)}"
+        collected = _date(rand)
+        material = _pick(rand, ["CIT", "EDTA", "SER"])
+        location = {"location_path": "NUM --> Freezer", "xpos": str(rand.randint(1, 12)), "ypos": str(rand.randint(1, 8))}
+        yield {"category": "MASTER", "sidc_SAMPLEID": sampleid, "sidc_EXTSAMPLEID": f"E{sampleid}", "mainidc": "SAMPLEID", "pidc_LIMSPSN": patient,
+               "collection_date": collected, "received_date": _nullish(rand, nullish, _date(rand)), "reposition_date": _nullish(rand, nullish, _date(rand)),
+               "initial_amount": _nullish(rand, nullish, "1", empty=""), "initial_unit": "PC", "rest_amount": _nullish(rand, nullish, "0", empty=""), "rest_unit": "PC",
+               "organization_unit": "NUM_W", "receptacle": "ORG", "type": material, **location}
+        n += 1
+        if aliquots == 0 or n >= rows:
+            continue
+        yield {"category": "ALIQUOTGROUP", "pidc_LIMSPSN": patient, "index": str(group), "parent_sampleid": sampleid, "parent_idc": "SAMPLEID",
+               "received_date": _nullish(rand, nullish, _date(rand)), "organization_unit": "NUM_W", "type": material, **location}
+        n += 1
+        for a in range(aliquots):
+            if n >= rows:
+                break
+            amount = _nullish(rand, nullish, f"{rand.randint(1, 500)}", empty="")
+            yield {"category": "DERIVED", "sidc_SAMPLEID": f"{sampleid}_{a}", "mainidc": "SAMPLEID", "pidc_LIMSPSN": patient, "parent_index": str(group),
+                   "collection_date": collected, "derival_date": _nullish(rand, nullish, _date(rand)), "reposition_date": _nullish(rand, nullish, _date(rand)),
+                   "initial_amount": amount, "initial_unit": "MICL", "rest_amount": amount, "rest_unit": "MICL",
+                   "organization_unit": "NUM_W", "receptacle": "ALI", "type": material, **location}
+            n += 1
+        group += 1
+
+def _observation_row(rand, i:int, codes:list, nullish:float) -> list:
+    """_observation_row returns the cells of observation row i."""
+    row = [f"{100000 + i}", f"lims_{rand.randrange(i // 10 + 1)}", _date(rand), "Profile", "PROF", _nullish(rand, nullish, "SENDER1", empty="")]
+    for (k, code) in enumerate(codes):
+        ctype = component_types[k % len(component_types)]
+        match ctype:
+            case "NUMBER":
+                value = _nullish(rand, nullish, f"{rand.uniform(0, 100):.2f}", empty="")
+            case "STRING":
+                value = _nullish(rand, nullish, _pick(rand, ["low", "high", "normal"]), empty="")
+            case "BOOLEAN":
+                value = _pick(rand, ["true", "false"])
+            case "DATE":
+                value = _nullish(rand, nullish, _date(rand)[:10])
+            case _:
+                value = ",".join(rand.sample(["a", "b", "c", "d"], rand.randint(1, 3)))
+        row += [ctype, value]
+    return row
+
+def _date(rand) -> str:
+    """_date returns a random iso date time string."""
+    return (datetime(2020, 1, 1) + timedelta(seconds=rand.randrange(5 * 365 * 24 * 3600))).isoformat()
+
+def _pick(rand, values:list) -> str:
+    """_pick returns one of values."""
+    return values[rand.randrange(len(values))]
+
+def _nullish(rand, ratio:float, value:str, empty:str=None) -> str:
+    """_nullish returns value, or with probability ratio an empty cell, either empty or, if empty isn't given, "" or NULL."""
+    if rand.random() >= ratio:
+        return value
+    if empty is not None:
+        return empty
+    return _pick(rand, ["", "NULL"])
+
+
+def bench_type(type:str, path:str, repeat:int=3, serializer:str="pretty", delimiter:str=";") -> dict:
+    """bench_type times the stages of converting the csv at path of type, each repeat times. it returns the seconds of each run per stage with the best of them, their total, and the rows and entries per second for that total."""
+    from fhirbuild import bundle, writeout, fhir_aliquotgroup, observation_entries, _iter_fill_in_fhirids
+    from fhirbuild.csvtofhir import restypes, row_to_sample, row_to_finding, row_to_patient_fhir
+    from fhirbuild.schema import compile_schema
+    from fhirbuild.templates import builder
+
+    (restype, name) = restypes[type]
+    runs = {stage: [] for stage in stages}
+    rows = entries = None
+    for r in range(repeat):
+        # read, like help.open_csv_file
+        t = time.perf_counter()
+        with open(path, "r", encoding="utf-8") as f:
+            reader = csv.DictReader(f, delimiter=delimiter)
+            rows = list(reader)
+        runs["read"].append(time.perf_counter() - t)
+        schema = compile_schema(reader.fieldnames, type)
+
+        # row_to_*, for patients this builds the entries already
+        t = time.perf_counter()
+        match type:
+            case "specimen":
+                converted = [row_to_sample(row, schema=schema) for row in rows]
+            case "observation":
+                converted = [row_to_finding(row, i, ",", schema=schema) for (i, row) in enumerate(rows)]
+            case "patient":
+                converted = [row_to_patient_fhir(row, schema=schema) for row in rows]
+        runs["row_to"].append(time.perf_counter() - t)
+
+        # fill in the fhirids of the samples
+        t = time.perf_counter()
+        if type == "specimen":
+            converted = list(_iter_fill_in_fhirids(converted))
+        runs["fill_in_fhirids"].append(time.perf_counter() - t)
+
+        # build the fhir entries
+        t = time.perf_counter()
+        match type:
+            case "specimen":
+                build = builder("Specimen")
+                entries = [fhir_aliquotgroup(s) if s.category == "ALIQUOTGROUP" else build(s) for s in converted]
+            case "observation":
+                entries = list(observation_entries(converted))
+            case "patient":
+                entries = converted
+        runs["build"].append(time.perf_counter() - t)
+
+        # bundle
+        t = time.perf_counter()
+        bundles = bundle(entries, 10, restype=restype, cxx=3)
+        runs["bundle"].append(time.perf_counter() - t)
+
+        # write into a temporary directory
+        outdir = tempfile.mkdtemp(prefix="fhirbuild-bench-")
+        try:
+            t = time.perf_counter()
+            writeout(bundles, outdir, name, serializer=serializer)
+            runs["writeout"].append(time.perf_counter() - t)
+        finally:
+            shutil.rmtree(outdir)
+
+    best = {stage: min(seconds) for (stage, seconds) in runs.items()}
+    total = sum(best.values())
+    return {
+        "rows": len(rows),
+        "entries": len(entries),
+        "stages": {stage: {"best": best[stage], "runs": runs[stage]} for stage in stages},
+        "total": total,
+        "rows_per_sec": len(rows) / total if total > 0 else None,
+        "entries_per_sec": len(entries) / total if total > 0 else None
+    }
+
+def bench_startup(types:list, csvdir:str, repeat:int=3, seed:int=0) -> dict:
+    """bench_startup times starting fhirbuild in a new python, repeat times each: python -X importtime -m fhirbuild --help, and converting a csv of startup_rows rows of each of types, generated into csvdir. it returns the wall seconds of the runs with the best of them, the microseconds of importing fhirbuild for --help, its ten slowest imports and the heavy_modules it imported, and for each type the heavy_modules the run imported that aren't in run_needs."""
+    help_runs = []
+    imports = None
+    for r in range(repeat):
+        t = time.perf_counter()
+        done = subprocess.run([sys.executable, "-X", "importtime", "-m", "fhirbuild", "--help"], capture_output=True, text=True, check=True)
+        help_runs.append(time.perf_counter() - t)
+        imports = _importtimes(done.stderr)
+    fhirbuild_micros = next((cumulative for (name, own, cumulative) in imports if name == "fhirbuild"), None)
+    imported = set(name for (name, own, cumulative) in imports)
+    heavy = [module for module in heavy_modules if module in imported]
+
+    runs = {}
+    run_heavy = {}
+    for type in types:
+        path = os.path.join(csvdir, f"{type}_{startup_rows}.csv")
+        generate_csv(path, type, startup_rows, seed=seed)
+        runs[type] = []
+        for r in range(repeat):
+            outdir = tempfile.mkdtemp(prefix="fhirbuild-bench-")
+            try:
+                t = time.perf_counter()
+                subprocess.run([sys.executable, "-m", "fhirbuild", type, path, outdir], capture_output=True, check=True)
+                runs[type].append(time.perf_counter() - t)
+            finally:
+                shutil.rmtree(outdir)
+        # once more with importtime, not timed
+        outdir = tempfile.mkdtemp(prefix="fhirbuild-bench-")
+        try:
+            done = subprocess.run([sys.executable, "-X", "importtime", "-m", "fhirbuild", type, path, outdir], capture_output=True, text=True, check=True)
+        finally:
+            shutil.rmtree(outdir)
+        imported = set(name for (name, own, cumulative) in _importtimes(done.stderr))
+        run_heavy[type] = [module for module in heavy_modules if module in imported and module not in run_needs.get(type, [])]
+
+    return {
+        "help": {"best": min(help_runs), "runs": help_runs},
+        "import_fhirbuild_us": fhirbuild_micros,
+        "slowest_imports": [{"module": name, "us": cumulative} for (name, own, cumulative) in sorted(imports, key=lambda i: -i[2]) if name != "fhirbuild"][:10],
+        "heavy_imports": heavy,
+        "run": {type: {"rows": startup_rows, "best": min(seconds), "runs": seconds, "heavy_imports": run_heavy[type]} for (type, seconds) in runs.items()}
+    }
+
+def _importtimes(out:str) -> list:
+    """_importtimes returns the imports from the output of python -X importtime as (module, own microseconds, cumulative microseconds) tuples."""
+    imports = []
+    for line in out.splitlines():
+        if not line.startswith("import time:"):
+            continue
+        parts = line[len("import time:"):].split("|")
+        if len(parts) != 3 or not parts[0].strip().isdigit():
+            # the header
+            continue
+        imports.append((parts[2].strip(), int(parts[0]), int(parts[1])))
+    return imports
+
+def run(types:list, rows:int=10000, components:int=4, aliquots:int=2, nullish:float=0.1, seed:int=0, repeat:int=3, serializer:str="pretty", keep:str=None, startup:bool=True, per_stage:bool=True) -> dict:
+    """run generates a csv for each of types and benchmarks it, see generate_csv and bench_type, and the startup, see bench_startup. startup or per_stage false leave out the startup or the stages. the csv files go to a temporary directory, or to keep if given. it returns the results with the parameters and the environment."""
+    results = {
+        "fhirbuild": _version(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "date": datetime.now().isoformat(timespec="seconds"),
+        "params": {"rows": rows, "components": components, "aliquots": aliquots, "nullish": nullish, "seed": seed, "repeat": repeat, "serializer": serializer},
+        "types": {}
+    }
+    csvdir = keep or tempfile.mkdtemp(prefix="fhirbuild-bench-csv-")
+    os.makedirs(csvdir, exist_ok=True)
+    try:
+        if startup:
+            results["startup"] = bench_startup(types, csvdir, repeat=repeat, seed=seed)
+        for type in types if per_stage else []:
+            path = os.path.join(csvdir, f"{type}.csv")
+            generate_csv(path, type, rows, components=components, aliquots=aliquots, nullish=nullish, seed=seed)
+            results["types"][type] = bench_type(type, path, repeat=repeat, serializer=serializer)
+    finally:
+        if keep is None:
+            shutil.rmtree(csvdir)
+    return results
+
+def _version():
+    """_version returns the installed version of fhirbuild, or None."""
+    try:
+        from importlib.metadata import version
+        return version("fhirbuild")
+    except Exception:
+        return None
+
+def parseargs():
+    """parseargs parses command line arguments."""
+    parser = argparse.ArgumentParser(prog="python -m fhirbuild.bench", description="benchmark fhirbuild stage by stage on synthetic csv files")
+    parser.add_argument("--types", help="the csv types to benchmark (default all)", nargs="+", choices=["specimen", "observation", "patient"], default=["specimen", "observation", "patient"])
+    parser.add_argument("--rows", help="rows per csv (default 10000)", type=int, default=10000)
+    parser.add_argument("--components", help="components per observation (default 4)", type=int, default=4)
+    parser.add_argument("--aliquots", help="aliquots per aliquotgroup, 0 for primary samples only (default 2)", type=int, default=2)
+    parser.add_argument("--nullish", help="share of optional cells that are empty or NULL (default 0.1)", type=float, default=0.1)
+    parser.add_argument("--seed", help="seed of the generated data (default 0)", type=int, default=0)
+    parser.add_argument("--repeat", help="runs per stage, the best is taken (default 3)", type=int, default=3)
+    parser.add_argument("--json", help="serializer for the writeout stage (default pretty)", choices=["pretty", "compact", "fast"], default="pretty")
+    parser.add_argument("--keep", help="keep the generated csv files in this directory")
+    parser.add_argument("--startup", help="benchmark only the startup, not the stages", action="store_true")
+    parser.add_argument("--no-startup", help="benchmark only the stages, not the startup", action="store_true")
+    parser.add_argument("--max-import-ms", help="fail if importing fhirbuild for --help takes longer than this many milliseconds", type=float)
+    parser.add_argument("-o", "--out", help="write the results to this json file instead of stdout")
+    return parser.parse_args()
+
+def main():
+    """main runs the benchmark and writes the results as json."""
+    args = parseargs()
+    if args.startup and args.no_startup:
+        print("error: --startup and --no-startup leave nothing to benchmark")
+        return 1
+    results = run(args.types, rows=args.rows, components=args.components, aliquots=args.aliquots, nullish=args.nullish, seed=args.seed, repeat=args.repeat, serializer=args.json, keep=args.keep, startup=not args.no_startup, per_stage=not args.startup)
+    out = json.dumps(results, indent=4)
+    if args.out is None:
+        print(out)
+    else:
+        with open(args.out, "w", encoding="utf-8") as f:
+            f.write(out + "\n")
+
+    # guard the startup
+    startup = results.get("startup")
+    if startup is not None:
+        if len(startup["heavy_imports"]) > 0:
+            print(f"error: fhirbuild --help imports {', '.join(startup['heavy_imports'])}", file=sys.stderr)
+            return 1
+        for (type, result) in startup["run"].items():
+            if len(result["heavy_imports"]) > 0:
+                print(f"error: fhirbuild {type} on {startup_rows} rows imports {', '.join(result['heavy_imports'])}", file=sys.stderr)
+                return 1
+        micros = startup["import_fhirbuild_us"]
+        if args.max_import_ms is not None and micros is not None and micros / 1000 > args.max_import_ms:
+            print(f"error: importing fhirbuild for --help takes {micros / 1000:.1f} ms, more than {args.max_import_ms} ms", file=sys.stderr)
+            return 1
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,50 @@
+# changes.py keeps track of what was built before, so that only new and changed resources are written
+
+# since fhirids are deterministic, a resource built from the same row
+# gets the same fullUrl each run. the store maps each fullUrl to a hash
+# of the entry built for it last time, in a small sqlite file. entries
+# whose hash didn't change are left out. the new hashes go into an open
+# transaction, on disk rather than in memory, which is only committed
+# once the run's output is written, so a run that fails leaves the store
+# as it was and its entries are emitted again next time.
+
+import hashlib
+import json
+import sqlite3
+
+class ChangeStore:
+    """ChangeStore is the store of entry hashes at path, a sqlite file that is created if it doesn't exist. filter lets only new and changed entries through, commit saves their hashes."""
+
+    def __init__(self, path:str):
+        self.path = path
+        self.db = sqlite3.connect(path)
+        with self.db:
+            self.db.execute("create table if not exists entries (url text primary key, hash blob not null) without rowid")
+        self.seen = 0
+        self.changed = 0
+
+    def filter(self, entries):
+        """filter yields the entries that are new or changed since the last commit, remembering their hashes for the next commit."""
+        for entry in entries:
+            self.seen += 1
+            url = entry["fullUrl"]
+            digest = entry_hash(entry)
+            row = self.db.execute("select hash from entries where url = ?", (url,)).fetchone()
+            if row is not None and row[0] == digest:
+                continue
+            self.changed += 1
+            self.db.execute("insert or replace into entries (url, hash) values (?, ?)", (url, digest))
+            yield entry
+
+    def commit(self):
+        """commit saves the hashes of the entries let through since the last commit."""
+        self.db.commit()
+
+    def close(self):
+        """close closes the store, what isn't committed is dropped."""
+        self.db.close()
+
+def entry_hash(entry:dict) -> bytes:
+    """entry_hash returns a hash of the content of a fhir entry, the same for equal entries regardless of key order."""
+    data = json.dumps(entry, sort_keys=True, separators=(",", ":"), ensure_ascii=False).encode("utf-8")
+    return hashlib.blake2b(data, digest_size=16).digest()
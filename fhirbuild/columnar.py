@@ -0,0 +1,196 @@
+# columnar.py reads csv files column-wise with pandas
+
+# the csv is read in chunks of rows by pandas' c parser. per chunk, the
+# values that need converting (dates, nullish references, amounts,
+# positions, the fhirids of observations) are converted for whole columns
+# at once, each distinct value of a column only once, and only then are
+# the sample and finding records built row by row, with the converted
+# values passed in. the entries are the
+# same as from the csv.DictReader path in csvtofhir, which stays the
+# fallback if pandas isn't installed.
+
+from itertools import chain, tee
+from fhirbuild import sample_entries, observation_entries
+from fhirbuild.csvtofhir import row_to_sample, row_to_finding, iter_patient_fhir, a01toxy, restypes
+from fhirbuild.help import intornone, is_nullish, genfhirids
+from fhirbuild.dates import parse_dates
+from fhirbuild.schema import Schema, schema_for
+from fhirbuild.components import parse_column
+from fhirbuild.validate import RejectedRow, RowError, Rejects, checked_rows, compile_checks
+
+# pandas is a dependency, but fhirbuild falls back to csv.DictReader without it
+try:
+    import pandas as pd
+except ImportError:
+    pd = None
+
+def available() -> bool:
+    """available says whether pandas is installed and the columnar reader can be used."""
+    return pd is not None
+
+def read_csv_chunks(path:str, delimiter:str=";", encoding:str="utf-8", chunksize:int=10000):
+    """read_csv_chunks yields the csv at path as DataFrames of chunksize rows. all values are kept as strings, empty cells as "", nothing is turned into NaN. a row with more values than columns raises a validate.RowError."""
+    if pd is None:
+        raise ValueError("the columnar reader needs pandas, pip install pandas")
+    try:
+        yield from pd.read_csv(path, sep=delimiter, encoding=encoding, dtype=str, keep_default_na=False, na_filter=False, chunksize=chunksize, engine="c")
+    except pd.errors.ParserError as e:
+        # the c parser stops at a row with more values than columns, it can't be rejected by itself
+        raise RowError("columns", f"{str(e).strip()}. rows with more values than columns are rejected by the csv reader, not by pandas") from e
+
+def nullish(col):
+    """nullish is is_nullish for a whole column, it returns a boolean Series."""
+    stripped = col.str.strip()
+    return (stripped == "") | (stripped.str.lower() == "null")
+
+def column(df, name:str) -> list:
+    """column returns the column name of df as a list, or a list of None if df has no such column."""
+    if name not in df.columns:
+        return [None] * len(df)
+    return df[name].tolist()
+
+def per_value(values:list, convert) -> list:
+    """per_value converts a column with convert, calling it once for each distinct value."""
+    converted = {value: convert(value) for value in set(values)}
+    return [converted[value] for value in values]
+
+def dates(df, name:str) -> list:
+    """dates parses the dates of column name, see dates.parse_dates."""
+    return parse_dates(column(df, name))
+
+def references(df, name:str) -> list:
+    """references returns the column name with nullish values set to None."""
+    if name not in df.columns:
+        return [None] * len(df)
+    # not with Series.where, the string columns would turn None into NaN
+    return [None if empty else value for (empty, value) in zip(nullish(df[name]).tolist(), df[name].tolist())]
+
+def amounts(df, name:str) -> list:
+    """amounts parses the amounts of column name to floats, empty cells give None."""
+    if name not in df.columns:
+        return [None] * len(df)
+    col = df[name]
+    # like float(), but for the whole column
+    parsed = col.mask(col == "").astype(float)
+    return [None if empty else value for (empty, value) in zip((col == "").tolist(), parsed.tolist())]
+
+def positions(df) -> (list, list):
+    """positions returns the x and the y positions of the samples in df, from the xpos and ypos columns or, where given, from yxpos."""
+    xpos = per_value(column(df, "xpos"), intornone)
+    ypos = per_value(column(df, "ypos"), intornone)
+    if "yxpos" in df.columns:
+        given = (~nullish(df["yxpos"])).tolist()
+        yx = per_value(df["yxpos"].tolist(), lambda v: None if is_nullish(v) else a01toxy(v))
+        for i in range(len(df)):
+            if given[i]:
+                (xpos[i], ypos[i]) = yx[i]
+    return (xpos, ypos)
+
+def sample_columns(df) -> list:
+    """sample_columns converts the columns of a specimen chunk that csvtofhir.sample_values converts row by row. it returns a dict of values for each row."""
+    cols = {
+        "received_date": dates(df, "received_date"),
+        "collection_date": dates(df, "collection_date"),
+        "derival_date": dates(df, "derival_date"),
+        "reposition_date": dates(df, "reposition_date"),
+        "initial_amount": amounts(df, "initial_amount"),
+        "rest_amount": amounts(df, "rest_amount")
+    }
+    (cols["xpos"], cols["ypos"]) = positions(df)
+    for name in ["fhirid", "index", "parent_fhirid", "parent_index", "parent_sampleid"]:
+        cols[name] = references(df, name)
+    names = list(cols)
+    return [dict(zip(names, values)) for values in zip(*cols.values())]
+
+def checked_chunk(df, check) -> tuple:
+    """checked_chunk checks the rows of a chunk with check, from validate.compile_checks. it returns the rows of the chunk, a RejectedRow in place of each rejected row, and the chunk without the rejected rows, so that their values aren't converted."""
+    rows = df.to_dict("records")
+    if check is None:
+        return (rows, df)
+    rejected = []
+    for (i, row) in enumerate(rows):
+        errors = check(row)
+        if errors is not None:
+            rows[i] = RejectedRow(errors, row)
+            rejected.append(i)
+    if len(rejected) > 0:
+        df = df.drop(df.index[rejected])
+    return (rows, df)
+
+def merged(rows:list, converted):
+    """merged yields the converted of the rows that passed, in the place of the rows, and the rejected rows in theirs."""
+    converted = iter(converted)
+    for row in rows:
+        yield row if isinstance(row, RejectedRow) else next(converted)
+
+def iter_samples_columnar(path:str, delimiter:str=";", encoding:str="utf-8", mainidc:str=None, chunksize:int=10000, schema:Schema=None, validate:bool=False):
+    """iter_samples_columnar is csvtofhir.iter_samples reading the csv at path column-wise. it yields a SampleRecord for each row. with validate, the rows are checked and a RejectedRow takes the place of each rejected row."""
+    check = None
+    for df in read_csv_chunks(path, delimiter=delimiter, encoding=encoding, chunksize=chunksize):
+        schema = schema or schema_for("specimen", tuple(df.columns))
+        if validate and check is None:
+            check = compile_checks("specimen", schema, mainidc=mainidc)
+        (rows, df) = checked_chunk(df, check)
+        passed = (row for row in rows if not isinstance(row, RejectedRow))
+        yield from merged(rows, (row_to_sample(row, mainidc=mainidc, values=values, schema=schema) for (row, values) in zip(passed, sample_columns(df))))
+
+def component_recs(df, schema:Schema, delim_cmp:str=",") -> list:
+    """component_recs parses the components of an observation chunk column by column. it returns a dict of Recs by component code for each row."""
+    codes = list(schema.components)
+    columns = [parse_column(df[tcol].tolist(), df[vcol].tolist(), delim_cmp) for (tcol, vcol) in schema.components.values()]
+    return [dict(zip(codes, recs)) for recs in zip(*columns)] if len(codes) > 0 else [{} for i in range(len(df))]
+
+def iter_findings_columnar(path:str, delimiter:str=";", encoding:str="utf-8", delim_cmp:str=",", chunksize:int=10000, schema:Schema=None, validate:bool=False):
+    """iter_findings_columnar is csvtofhir.iter_findings reading the csv at path column-wise. it yields a FindingRecord for each row. with validate, the rows are checked and a RejectedRow takes the place of each rejected row."""
+    for findings in finding_chunks(path, delimiter=delimiter, encoding=encoding, delim_cmp=delim_cmp, chunksize=chunksize, schema=schema, validate=validate):
+        yield from findings
+
+def finding_chunks(path:str, delimiter:str=";", encoding:str="utf-8", delim_cmp:str=",", chunksize:int=10000, schema:Schema=None, validate:bool=False):
+    """finding_chunks is iter_findings_columnar by chunk, it yields a list of the FindingRecords and RejectedRows of each chunk."""
+    i = 0
+    check = None
+    for df in read_csv_chunks(path, delimiter=delimiter, encoding=encoding, chunksize=chunksize):
+        schema = schema or schema_for("observation", tuple(df.columns))
+        if validate and check is None:
+            check = compile_checks("observation", schema, delim_cmp=delim_cmp)
+        (rows, df) = checked_chunk(df, check)
+        passed = (row for row in rows if not isinstance(row, RejectedRow))
+        yield list(merged(rows, (row_to_finding(row, i + j, delim_cmp, effectivedate=effectivedate, schema=schema, recs=recs) for (j, (row, effectivedate, recs)) in enumerate(zip(passed, dates(df, "effective_date_time"), component_recs(df, schema, delim_cmp))))))
+        i += len(rows)
+
+def observation_fhirids(findings:list) -> list:
+    """observation_fhirids returns the fhirids of a chunk of findings, made from sampleid and method code like observation_entries makes them, all at once with genfhirids. rejected rows get None."""
+    passed = [finding for finding in findings if not isinstance(finding, RejectedRow)]
+    generated = iter(genfhirids([finding.sample.id() + finding.method for finding in passed]))
+    return [None if isinstance(finding, RejectedRow) else next(generated) for finding in findings]
+
+def iter_rows_columnar(path:str, delimiter:str=";", encoding:str="utf-8", chunksize:int=10000):
+    """iter_rows_columnar yields the rows of the csv at path as dicts, like csv.DictReader."""
+    for df in read_csv_chunks(path, delimiter=delimiter, encoding=encoding, chunksize=chunksize):
+        yield from df.to_dict("records")
+
+def columnar_entries(path:str, type:str, delimiter:str=";", encoding:str="utf-8", mainidc:str=None, delim_cmp:str=",", chunksize:int=10000, fhirids:dict=None, schema:Schema=None, rejects:Rejects=None):
+    """columnar_entries is csvtofhir.csv_to_entries in one process, reading the csv at path column-wise. it yields the fhir entries for the rows of a csv of type specimen, observation or patient. schema is the compiled header, compiled from the columns of the first chunk if not given. rejects checks the rows like with csv_to_entries, the rejected rows are left out of the columns that are converted."""
+    if type not in restypes:
+        raise ValueError(f"unknown type: {type}, choose from {', '.join(restypes)}")
+    entries = _columnar_entries(path, type, delimiter, encoding, mainidc, delim_cmp, chunksize, fhirids, schema, rejects is not None)
+    if rejects is not None:
+        entries = rejects.take(entries)
+    yield from entries
+
+def _columnar_entries(path:str, type:str, delimiter:str, encoding:str, mainidc:str, delim_cmp:str, chunksize:int, fhirids:dict, schema:Schema, validate:bool):
+    """_columnar_entries is columnar_entries, with a RejectedRow in the place of each rejected row if validate is set."""
+    match type:
+        case "specimen":
+            yield from sample_entries(iter_samples_columnar(path, delimiter=delimiter, encoding=encoding, mainidc=mainidc, chunksize=chunksize, schema=schema, validate=validate), fhirids=fhirids)
+        case "observation":
+            # the fhirids of a chunk are generated at once, they are taken in step with the findings, so tee holds a chunk at most
+            (chunks, id_chunks) = tee(finding_chunks(path, delimiter=delimiter, encoding=encoding, delim_cmp=delim_cmp, chunksize=chunksize, schema=schema, validate=validate))
+            fhirids = chain.from_iterable(observation_fhirids(findings) for findings in id_chunks)
+            yield from observation_entries(chain.from_iterable(chunks), fhirids=fhirids)
+        case "patient":
+            # patients have no columns to convert
+            rows = iter_rows_columnar(path, delimiter=delimiter, encoding=encoding, chunksize=chunksize)
+            if validate:
+                rows = checked_rows(rows, "patient", schema, mainidc=mainidc)
+            yield from iter_patient_fhir(rows, mainidc=mainidc, schema=schema)
@@ -0,0 +1,164 @@
+# components.py is the registry of the component types of observations
+
+# each component type (the value of a cmp_t_ column) is registered once
+# with how its csv values are parsed to a Rec and how a Rec is written to
+# a fhir component. row_to_finding looks up the parser by type name and
+# fhir_obs and the compiled observation builder look up the writer by Rec
+# class, each a single dict lookup per component. parse_many converts a
+# whole column of values at once, each distinct value only once. sites
+# can add their own types with register_component_type.
+
+# the Recs are tram classes. the built-in types are registered with the
+# names of their Rec classes, tram is imported when the first value is
+# parsed or written, so runs without observations don't load it.
+
+from fhirbuild.help import datestring, fromisoornone, is_nullish
+
+class ComponentType:
+    """ComponentType is how the values of a component type are handled. rec is the Rec class the type parses to, or the name of a tram Rec class, which is imported on first use. parse(value, delim_cmp) makes a Rec of a csv value, or None to leave the component out. parse_many(values, delim_cmp) makes the Recs for a list of csv values, by default by calling parse for each. emit(comp, rec) puts the value of rec into the fhir component comp and returns False if the component is to be left out."""
+
+    def __init__(self, name:str, rec:type, parse, emit, parse_many=None):
+        self.name = name
+        self.rec = rec
+        self.parse = parse
+        self.emit = emit
+        self.parse_many = parse_many or (lambda values, delim_cmp: [parse(value, delim_cmp) for value in values])
+
+# the component types by name, as given in the cmp_t_ columns
+component_types = {}
+
+# the component types by Rec class, for writing to fhir
+_by_rec = {}
+
+# the component types registered with the name of a tram Rec class, by name, until tram is imported
+_by_rec_name = {}
+
+def register_component_type(name:str, rec:type, parse, emit, parse_many=None) -> ComponentType:
+    """register_component_type registers a component type by its name in the cmp_t_ columns and its Rec class, replacing a type registered before under the same name or Rec class. see ComponentType for the arguments."""
+    ctype = ComponentType(name, rec, parse, emit, parse_many)
+    component_types[name] = ctype
+    if isinstance(rec, str):
+        _by_rec_name[rec] = ctype
+    else:
+        _by_rec[rec] = ctype
+    return ctype
+
+def _resolve_rec_names():
+    """_resolve_rec_names imports tram and puts the component types registered with the name of a tram Rec class into _by_rec by their class."""
+    import tram
+    for (recname, ctype) in list(_by_rec_name.items()):
+        ctype.rec = getattr(tram, recname)
+        # a type registered later for the same class wins
+        _by_rec.setdefault(ctype.rec, ctype)
+        del _by_rec_name[recname]
+
+def parse_component(typename:str, value:str, delim_cmp:str=","):
+    """parse_component makes a Rec of the csv value of a component of type typename. unknown types give None, which leaves the component out."""
+    ctype = component_types.get(typename)
+    if ctype is None:
+        return None
+    return ctype.parse(value, delim_cmp)
+
+def parse_column(typenames:list, values:list, delim_cmp:str=",") -> list:
+    """parse_column makes the Recs for a whole component column, typenames are the rows' values of the cmp_t_ column, values those of the cmp_v_ column. the values of each type are parsed in one parse_many call."""
+    # collect the rows of each type
+    rows = {}
+    for i, typename in enumerate(typenames):
+        rows.setdefault(typename, []).append(i)
+    recs = [None] * len(values)
+    for typename, indices in rows.items():
+        ctype = component_types.get(typename)
+        if ctype is None:
+            continue
+        for i, rec in zip(indices, ctype.parse_many([values[i] for i in indices], delim_cmp)):
+            recs[i] = rec
+    return recs
+
+def emit_component(comp:dict, rec) -> bool:
+    """emit_component puts the value of rec into the fhir component comp. it returns False if the component is to be left out. Recs of unregistered classes are left without value."""
+    ctype = _by_rec.get(type(rec))
+    if ctype is None and _by_rec_name:
+        _resolve_rec_names()
+        ctype = _by_rec.get(type(rec))
+    if ctype is None:
+        return True
+    return ctype.emit(comp, rec)
+
+def _per_value(parse):
+    """_per_value returns a parse_many that calls parse once for each distinct value."""
+    def parse_many(values:list, delim_cmp:str=",") -> list:
+        parsed = {value: parse(value, delim_cmp) for value in set(values)}
+        return [parsed[value] for value in values]
+    return parse_many
+
+
+# the built-in component types, their parsers import tram on use
+
+def _recs():
+    """_recs returns the tram module with the Rec classes."""
+    import tram
+    return tram
+
+def _parse_boolean(value, delim_cmp):
+    return _recs().BooleanRec(rec=value)
+
+def _emit_boolean(comp, rec):
+    comp["valueBoolean"] = bool(rec.rec)
+    return True
+
+def _parse_number(value, delim_cmp):
+    # empty numbers are left out
+    if is_nullish(value):
+        return None
+    return _recs().NumberRec(rec=float(value))
+
+def _emit_number(comp, rec):
+    # are numbers always turned to quantities? # todo
+    # todo setting 0 is not right actually, cause the db returns NULL, but None isn't accepted by fhirimporter
+    comp["valueQuantity"] = {"value": float(rec.rec) if rec.value is not None else 0}
+    # set the unit only if it is there
+    if rec.unit is not None:
+        comp["valueQuantity"]["unit"] = rec.unit
+    return True
+
+def _parse_string(value, delim_cmp):
+    return _recs().StringRec(rec=value)
+
+def _emit_string(comp, rec):
+    comp["valueString"] = str(rec.rec)
+    # somehow strings may not be empty or null, so don't add the component if that's the case? todo how to delete a string?
+    return str(rec.rec) != ""
+
+def _parse_date(value, delim_cmp):
+    # empty dates are left out
+    date = fromisoornone(value)
+    if date is None:
+        return None
+    return _recs().DateRec(rec=date)
+
+def _emit_date(comp, rec):
+    comp["valueDateTime"] = datestring(rec.rec)
+    return True
+
+def _parse_multi(value, delim_cmp):
+    return _recs().MultiRec(rec=value.split(delim_cmp))
+
+def _emit_multi(comp, rec):
+    # sometimes the x is oid, but doesn't seem to need to be
+    comp["valueCodeableConcept"] = {"coding": [{"system": "urn:centraxx:CodeSystem/UsageEntry-x", "code": str(val)} for val in rec.rec]}
+    return True
+
+def _parse_catalog(value, delim_cmp):
+    return _recs().CatalogRec(rec=value.split(delim_cmp))
+
+def _emit_catalog(comp, rec):
+    # here apparently the catalog code is needed
+    comp["valueCodeableConcept"] = {"coding": [{"system": f"urn:centraxx:CodeSystem/ValueList-{rec.catalog}", "code": str(val)} for val in rec.rec]}
+    return True
+
+register_component_type("BOOLEAN", "BooleanRec", _parse_boolean, _emit_boolean)
+register_component_type("NUMBER", "NumberRec", _parse_number, _emit_number, _per_value(_parse_number))
+register_component_type("STRING", "StringRec", _parse_string, _emit_string)
+register_component_type("DATE", "DateRec", _parse_date, _emit_date, _per_value(_parse_date))
+register_component_type("MULTI", "MultiRec", _parse_multi, _emit_multi)
+register_component_type("CATALOG", "CatalogRec", _parse_catalog, _emit_catalog)
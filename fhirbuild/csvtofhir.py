@@ -2,158 +2,409 @@
 
 # for the column names for specimen and observation see readme.md
 
-from fhirbuild import *
+# the annotations aren't evaluated, so reader.MappedCsv is only imported
+# for the workers that read byte ranges, and components (with tram) only
+# for observations.
+from __future__ import annotations
+
+from fhirbuild import sample_entries, observation_entries, fhir_patient, report_fhirid_problems, _new_fhirid_problems
 from datetime import datetime
-from dict_path import DictPath
-from tram import Sample, Patient, Amount, Finding, Identifier, Idable
-from tram import Rec, BooleanRec, NumberRec, StringRec, DateRec, MultiRec, CatalogRec
 import csv
 import json
 import os
 import re
 import math
+import sys
+from collections import deque
+from itertools import islice
 import fhirbuild.help as fbh
-from fhirbuild.help import intornone, is_nullish
-
-def csv_to_samples(reader: csv.DictReader, mainidc:str=None):
-    """csv_to_samples turns a csv file into a list of Sample instances. mainidc can be given as argument or csv column. fhirids are taken if given, but not generated."""
-
-    samples = []
+from fhirbuild.help import intornone, is_nullish, genfhirid
+from fhirbuild.schema import Schema, schema_for
+from fhirbuild.dates import get_timezone, set_timezone
+from fhirbuild.records import Ident, Ids, AmountRecord, SampleRecord, FindingRecord, PatientRecord, to_tram
+from fhirbuild.validate import RejectedRow, Rejects, checked_rows, compile_checks
+
+def csv_to_samples(reader: csv.DictReader, mainidc:str=None, as_tram:bool=False):
+    """csv_to_samples turns a csv file into a list of SampleRecords, or of tram Sample instances if as_tram is set. mainidc can be given as argument or csv column. fhirids are taken if given, but not generated."""
+    return list(iter_samples(reader, mainidc=mainidc, as_tram=as_tram))
+
+def iter_samples(reader: csv.DictReader, mainidc:str=None, schema:Schema=None, as_tram:bool=False):
+    """iter_samples is csv_to_samples as a generator, it yields a SampleRecord, or a tram Sample if as_tram is set, for each csv row as it is read. schema is the compiled header, compiled from the reader's fieldnames if not given. rows rejected by validate.checked_rows are passed through in their place."""
+    schema = schema or _reader_schema(reader, "specimen")
     for row in reader:
-        samples.append(row_to_sample(row, mainidc=mainidc))
-
-    return samples
+        if isinstance(row, RejectedRow):
+            yield row
+            continue
+        sample = row_to_sample(row, mainidc=mainidc, schema=schema)
+        yield to_tram(sample) if as_tram else sample
 
 
 def csv_to_patient_fhir(reader: csv.DictReader, mainidc:str=None) -> list[dict]:
     """csv_to_patient_fhir turns csv file into a list of patient fhir entries."""
+    return list(iter_patient_fhir(reader, mainidc=mainidc))
 
-    entries = []
+def iter_patient_fhir(reader: csv.DictReader, mainidc:str=None, schema:Schema=None):
+    """iter_patient_fhir is csv_to_patient_fhir as a generator, it yields a patient fhir entry for each csv row as it is read. rejected rows are passed through, like in iter_samples."""
+    schema = schema or _reader_schema(reader, "patient")
     for row in reader:
-        entries.append(row_to_patient_fhir(row, mainidc=mainidc))
-
-    return entries
-
-
-def csv_to_findings(reader: csv.DictReader, delim_cmp:str):
-    """csv_to_findings turns csv rows to a list of Finding instances."""
-
-    rows = list(reader)
-
-    # todo check that only the specified columns are in csv
-    out = []
-
-    for i, row in enumerate(rows):
-        out.append(row_to_finding(row, delim_cmp, i))
-
-    return out
-
-
-def row_to_sample(row:dict, mainidc:str=None) -> dict:
-    """row_to_sample turns a csv row to a Sample instance. mainidc can be passed as parameter or csv column. aliquots can reference their parent aliquotgroups by fhirid or index in the csv file, a "fhirid" or "index" Identifier is written to the Sample accordingly. fhirids need to be generated later with _fill_in_fhirids"""
-    entry = None
-
-    row = DictPath(row)    # common
-
-    # get the ids without sidc_ prefix
-    raw_identifiers, mainidc = extract_and_resolve_identifiers(row, prefix="sidc_", mainidc=mainidc)
+        if isinstance(row, RejectedRow):
+            yield row
+            continue
+        yield row_to_patient_fhir(row, mainidc=mainidc, schema=schema)
+
+
+def csv_to_findings(reader: csv.DictReader, delim_cmp:str, as_tram:bool=False):
+    """csv_to_findings turns csv rows to a list of FindingRecords, or of tram Finding instances if as_tram is set."""
+    return list(iter_findings(reader, delim_cmp, as_tram=as_tram))
+
+def iter_findings(reader: csv.DictReader, delim_cmp:str, schema:Schema=None, as_tram:bool=False):
+    """iter_findings is csv_to_findings as a generator, it yields a FindingRecord, or a tram Finding if as_tram is set, for each csv row as it is read. rejected rows are passed through, like in iter_samples."""
+    schema = schema or _reader_schema(reader, "observation")
+    for i, row in enumerate(reader):
+        if isinstance(row, RejectedRow):
+            yield row
+            continue
+        finding = row_to_finding(row, i, delim_cmp, schema=schema)
+        yield to_tram(finding) if as_tram else finding
+
+def _reader_schema(reader, type:str) -> Schema:
+    """_reader_schema returns the compiled header of a csv.DictReader, or None for other iterables of rows, whose rows then look up the schema of their keys."""
+    fieldnames = getattr(reader, "fieldnames", None)
+    if fieldnames is None:
+        return None
+    return schema_for(type, tuple(fieldnames))
+
+
+# the fhir resource type and the file name part of the output for each csv type
+restypes = {
+    "specimen": ("Sample", "sample"),
+    "observation": ("Observation", "obs"),
+    "patient": ("Patient", "patient")
+}
+
+def csv_to_entries(reader: csv.DictReader, type:str, mainidc:str=None, delim_cmp:str=",", workers:int=1, chunksize:int=1000, fhirids:dict=None, schema:Schema=None, start:int=0, stats=None, rejects:Rejects=None):
+    """csv_to_entries yields the fhir entries for the rows of a csv of type specimen, observation or patient, in the order of the rows. with workers > 1 they are converted in a pool of worker processes."""
+
+    if type not in restypes:
+        raise ValueError(f"unknown type: {type}")
+
+    # the compiled header, from the reader's fieldnames if not given
+    schema = schema or _reader_schema(reader, type)
+    # start is the row number of the reader's first row, if it doesn't start at the first row of the csv. stats, a stats.Stats, times the stages if given.
+    entries = _csv_to_entries(reader, type, mainidc, delim_cmp, workers, chunksize, fhirids, schema, start, stats, rejects is not None)
+    # rejects, a validate.Rejects, has the rows checked before they are converted and takes those that don't pass, see validate.py. without it the rows aren't checked.
+    if rejects is not None:
+        entries = rejects.take(entries, start)
+    yield from entries
+
+def _csv_to_entries(reader, type:str, mainidc:str, delim_cmp:str, workers:int, chunksize:int, fhirids:dict, schema:Schema, start:int, stats, validate:bool):
+    """_csv_to_entries is csv_to_entries, with a RejectedRow in the place of each rejected row if validate is set."""
+
+    # convert in this process
+    if workers is None or workers <= 1:
+        yield from _rows_to_entries(type, reader, start, mainidc, delim_cmp, fhirids, schema=schema, stats=stats, validate=validate)
+        return
+
+    # the rows are cut into chunks of chunksize rows, at most two chunks per worker are in flight, so the csv is still streamed
+    problems = _new_fhirid_problems()
+    converted = _convert_in_pool(type, reader, start, mainidc, delim_cmp, workers, chunksize, fhirids, schema, problems, validate)
+    # in the pool, row_to is the wait for the converted chunks
+    if stats is not None:
+        converted = stats.timed("row_to", converted)
+    # with fhirids, an index of the referenced samples from prescan_fhirids, the workers fill in the fhirids and build the entries
+    if type == "specimen" and fhirids is None:
+        # the workers only make the Samples, fill in their fhirids sequentially, since aliquots look up their parents from earlier rows
+        yield from sample_entries(converted, start=start, problems=problems, stats=stats)
+    else:
+        yield from converted
+
+    # the fhirid problems of all chunks are reported once at the end
+    if type == "specimen":
+        report_fhirid_problems(problems)
+
+def csv_file_entries(mapped:MappedCsv, type:str, ranges:list=None, starts:list=None, mainidc:str=None, delim_cmp:str=",", workers:int=2, fhirids:dict=None, schema:Schema=None, stats=None, rejects:Rejects=None):
+    """csv_file_entries is csv_to_entries with workers for a memory-mapped csv: the worker processes read the byte ranges of whole rows from mapped, a reader.MappedCsv, by themselves and convert them, so the rows aren't read by this process and handed to them. the entries come in the order of the rows."""
+
+    if type not in restypes:
+        raise ValueError(f"unknown type: {type}")
+
+    schema = schema or schema_for(type, tuple(mapped.fieldnames or []))
+    # the (start, end) byte ranges, cut by mapped.ranges if not given
+    if ranges is None:
+        ranges = mapped.ranges()
+    # for specimens with fhirids, starts are the row numbers of the first rows of the ranges, as collected by mapped.iter_ranges, e.g. while the fhirids are prescanned. they tell aliquots that come before their parent.
+    if type == "specimen" and fhirids is not None and starts is None:
+        starts = []
+        for row in mapped.iter_ranges(ranges, starts):
+            pass
+
+    # the workers check the rows with rejects, see csv_to_entries for the other arguments
+    entries = _file_entries(mapped, type, ranges, starts, mainidc, delim_cmp, workers, fhirids, schema, stats, rejects is not None)
+    if rejects is not None:
+        # the rejected rows are numbered by their place among the entries
+        entries = rejects.take(entries)
+    yield from entries
+
+def _file_entries(mapped:MappedCsv, type:str, ranges:list, starts:list, mainidc:str, delim_cmp:str, workers:int, fhirids:dict, schema:Schema, stats, validate:bool):
+    """_file_entries is csv_file_entries, with a RejectedRow in the place of each rejected row if validate is set."""
+    problems = _new_fhirid_problems()
+    # the row numbers only matter for specimens, the other rows are numbered from the start of their range
+    tasks = ((_convert_range, (type, mapped.path, start, end, starts[i] if starts is not None else 0, mapped.delimiter, mapped.encoding, mainidc, delim_cmp, validate)) for (i, (start, end)) in enumerate(ranges))
+    converted = _in_pool(tasks, workers, fhirids, schema, problems)
+    if stats is not None:
+        converted = stats.timed("row_to", converted)
+    if type == "specimen" and fhirids is None:
+        # the workers only make the samples, fill in their fhirids sequentially, like csv_to_entries
+        yield from sample_entries(converted, problems=problems, stats=stats)
+    else:
+        yield from converted
+
+    if type == "specimen":
+        report_fhirid_problems(problems)
+
+def _convert_in_pool(type:str, reader, start:int, mainidc:str, delim_cmp:str, workers:int, chunksize:int, fhirids:dict, schema:Schema, problems:dict, validate:bool=False):
+    """_convert_in_pool converts the rows of reader in a pool of worker processes, one chunk of rows per task, and yields what the chunks are converted to in the order of the rows (see _convert_chunk). the fhirid problems of the chunks are collected in problems."""
+
+    def tasks(start):
+        rows = iter(reader)
+        while True:
+            chunk = list(islice(rows, chunksize))
+            if len(chunk) == 0:
+                return
+            yield (_convert_chunk, (type, chunk, start, mainidc, delim_cmp, validate))
+            start += len(chunk)
+
+    yield from _in_pool(tasks(start), workers, fhirids, schema, problems)
+
+def _in_pool(tasks, workers:int, fhirids:dict, schema:Schema, problems:dict):
+    """_in_pool runs tasks, (function, arguments) tuples whose functions return what they converted and the fhirid problems like _convert_chunk, in a pool of worker processes. it yields the converted in the order of the tasks, and collects the problems in problems. the tasks are taken from their iterable as the pool needs them."""
+
+    # imported here, multiprocessing is only needed with workers
+    from concurrent.futures import ProcessPoolExecutor
+
+    # the fhirid index, the schema and the timezone policy are handed to each worker once, not with each task.
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(fhirids, schema, get_timezone())) as pool:
+        pending = deque()
+        tasks = iter(tasks)
+        while True:
+            # keep the pool busy, but don't read further ahead than two tasks per worker
+            while len(pending) < 2 * workers:
+                task = next(tasks, None)
+                if task is None:
+                    break
+                (f, args) = task
+                pending.append(pool.submit(f, *args))
+            if len(pending) == 0:
+                break
+            # hand out the results in the order of the tasks
+            (results, taskproblems) = pending.popleft().result()
+            yield from results
+            if taskproblems is not None:
+                for kind in problems:
+                    problems[kind].extend(taskproblems[kind])
+
+def prescan_fhirids(reader: csv.DictReader, mainidc:str=None, schema:Schema=None, validate:bool=False) -> dict:
+    """prescan_fhirids is the first phase of the two-phase fhirid resolution for csv input, like index_fhirids for Samples. it reads the rows once and returns the fhirids of the rows with an index, by which aliquots can reference their aliquotgroups, keyed by ("index", index), each with the row number. the fhirids are taken from the fhirid column or generated like _fill_in_fhirids does, without building Samples. pass the index to csv_to_entries. with validate, the rows that don't pass the checks of validate.py are left out, like csv_to_entries leaves them out with rejects."""
+    schema = schema or _reader_schema(reader, "specimen")
+    check = None
+    fhirids = {}
+    for i, row in enumerate(reader):
+        index = row.get("index")
+        if is_nullish(index):
+            continue
+        if validate:
+            if check is None:
+                check = compile_checks("specimen", schema or schema_for("specimen", tuple(row.keys())), mainidc=mainidc)
+            if check(row) is not None:
+                continue
+        fhirid = row.get("fhirid")
+        if is_nullish(fhirid):
+            if row.get("category") == "ALIQUOTGROUP":
+                # from the parent sampleid and the material
+                fhirid = genfhirid(row["parent_sampleid"] + row["type"])
+            else:
+                # from the main sampleid
+                (ids, idc) = extract_and_resolve_identifiers(row, prefix="sidc_", mainidc=mainidc, schema=schema)
+                fhirid = genfhirid(ids[idc])
+        fhirids[("index", index)] = (fhirid, i)
+    return fhirids
+
+# the fhirid index and the schema of a worker process, set once per worker by _init_worker
+_worker_fhirids = None
+_worker_schema = None
+
+def _init_worker(fhirids:dict, schema:Schema=None, timezone:str=None):
+    """_init_worker remembers the fhirid index and the schema in a worker process and sets the timezone policy of the dates."""
+    global _worker_fhirids, _worker_schema
+    _worker_fhirids = fhirids
+    _worker_schema = schema
+    set_timezone(timezone)
+
+def _convert_chunk(type:str, rows:list, start:int, mainidc:str, delim_cmp:str, validate:bool=False) -> tuple:
+    """_convert_chunk converts a chunk of csv rows in a worker process. it returns the fhir entries and the fhirid problems of the chunk, or, for specimens without a fhirid index, the SampleRecords and None. with validate, the rows are checked and a RejectedRow takes the place of each rejected row."""
+    if validate:
+        rows = checked_rows(rows, type, _worker_schema, mainidc=mainidc, delim_cmp=delim_cmp)
+    if type == "specimen" and _worker_fhirids is None:
+        return (list(iter_samples(rows, mainidc=mainidc, schema=_worker_schema)), None)
+    problems = _new_fhirid_problems()
+    entries = list(_rows_to_entries(type, rows, start, mainidc, delim_cmp, _worker_fhirids, problems, _worker_schema))
+    return (entries, problems)
+
+def _convert_range(type:str, path:str, start:int, end:int, first:int, delimiter:str, encoding:str, mainidc:str, delim_cmp:str, validate:bool=False) -> tuple:
+    """_convert_range reads the rows of the byte range from start to end of the csv at path in a worker process and converts them like _convert_chunk, first being the row number of the first row."""
+    # imported here, only the workers that read byte ranges need it
+    from fhirbuild.reader import MappedCsv
+    with MappedCsv(path, delimiter=delimiter, encoding=encoding) as mapped:
+        rows = list(mapped.rows(start, end))
+    return _convert_chunk(type, rows, first, mainidc, delim_cmp, validate)
+
+def _rows_to_entries(type:str, rows, start:int, mainidc:str, delim_cmp:str, fhirids:dict=None, problems:dict=None, schema:Schema=None, stats=None, validate:bool=False):
+    """_rows_to_entries yields the fhir entries for csv rows of type, start is the index of the first row. stats times the conversion of the rows if given. with validate, the rows are checked first and a RejectedRow takes the place of each rejected row."""
+    if validate:
+        rows = checked_rows(rows, type, schema, mainidc=mainidc, delim_cmp=delim_cmp)
+        if stats is not None:
+            rows = stats.timed("check", rows)
+    match type:
+        case "specimen":
+            samples = iter_samples(rows, mainidc=mainidc, schema=schema)
+            if stats is not None:
+                samples = stats.timed("row_to", samples)
+            yield from sample_entries(samples, fhirids=fhirids, start=start, problems=problems, stats=stats)
+        case "observation":
+            findings = (row if isinstance(row, RejectedRow) else row_to_finding(row, i, delim_cmp, schema=schema) for (i, row) in enumerate(rows, start))
+            if stats is not None:
+                findings = stats.timed("row_to", findings)
+            yield from observation_entries(findings)
+        case "patient":
+            # the rows are built into entries right away
+            entries = iter_patient_fhir(rows, mainidc=mainidc, schema=schema)
+            if stats is not None:
+                entries = stats.timed("row_to", entries)
+            yield from entries
+
+
+def row_to_sample(row:dict, mainidc:str=None, values:dict=None, schema:Schema=None) -> SampleRecord:
+    """row_to_sample turns a csv row to a SampleRecord, see records.to_tram for a tram Sample. mainidc can be passed as parameter or csv column. aliquots can reference their parent aliquotgroups by fhirid or index in the csv file, a "fhirid" or "index" id is written to the sample accordingly. fhirids need to be generated later with _fill_in_fhirids. the ids of a validate.CheckedRow are taken as they are. values are the converted values of the row from sample_values, they are converted here if not given. schema is the compiled header, looked up by the row's keys if not given."""
+
+    if schema is None:
+        schema = schema_for("specimen", tuple(row.keys()))
+
+    # missing columns give None
+    get = row.get
+
+    if values is None:
+        values = sample_values(row)
+
+    # get the ids without sidc_ prefix, resolved already if the row was checked (see validate.CheckedRow). aliquotgroups don't come with sampleids.
+    checked_ids = getattr(row, "ids", None)
+    if checked_ids is not None:
+        raw_identifiers, mainidc = checked_ids
+    elif get("category") == "ALIQUOTGROUP" and all(is_nullish(v) for v in schema.identifiers(row, "sidc_").values()):
+        raw_identifiers = {}
+    else:
+        raw_identifiers, mainidc = extract_and_resolve_identifiers(row, prefix="sidc_", mainidc=mainidc, schema=schema)
 
-    # make an array of Identifier instances for each sidc_
-    identifiers = []
-    for type, value in raw_identifiers.items():
-        try:
-            identifiers.append(Identifier(code=type, id=value))
-        except ValueError as e:
-            print(f"Error processing identifier {type}: {e}")   
+    # an id for each sidc_
+    identifiers = [Ident(code=type, id=value) for type, value in raw_identifiers.items()]
 
     # if there's a fhirid, add it as identifier
-    if row["fhirid"] is not None:
-        identifiers.append(Identifier(code="fhirid", id=row["fhirid"]))
+    if values["fhirid"] is not None:
+        identifiers.append(Ident(code="fhirid", id=values["fhirid"]))
 
     # if there's a index, add it as identifier
-    if row["index"] is not None:
-        identifiers.append(Identifier(code="index", id=row["index"]))
-
-    ids = Idable(ids=identifiers, mainidc=mainidc)        
-        
-    # convert dates
-    received_date = fbh.fromisoornone(row['received_date'])    
-    collection_date = fbh.fromisoornone(row['collection_date'])
-    derival_date = fbh.fromisoornone(row['derival_date'])        
-    reposition_date = fbh.fromisoornone(row['reposition_date'])
-    derival_date = fbh.fromisoornone(row['derival_date'])   
-    collection_date = fbh.fromisoornone(row['collection_date'])
+    if values["index"] is not None:
+        identifiers.append(Ident(code="index", id=values["index"]))
 
     # make amounts
-    initial_amount = None      
-    if row['initial_amount']:
-        initial_amount = Amount(value=float(row['initial_amount']), unit=row['initial_unit'])
+    initial_amount = None
+    if values['initial_amount'] is not None:
+        initial_amount = AmountRecord(value=values['initial_amount'], unit=_shared(get('initial_unit')))
     rest_amount = None
-    if row['rest_amount']:
-        rest_amount = Amount(value=float(row['rest_amount']), unit=row['rest_unit'])
+    if values['rest_amount'] is not None:
+        rest_amount = AmountRecord(value=values['rest_amount'], unit=_shared(get('rest_unit')))
 
-    # make a parent Idable from parent_fhirid or parent_index
+    # make the parent ids from parent_fhirid or parent_index
     pids = []
-    
-    # for aliquots referencing aliquotgroups:
-    # notify if no parent reference given
-    if row["category"] == "DERIVED" and row["parent_fhirid"] is None and row["parent_index"] is None:
-        print(f"no parent_fhirid or parent_index for derived sample {ids.id()} given.")
-    # make Identifiers
-    if row["parent_fhirid"] is not None:
-        pids.append(Identifier(id=row["parent_fhirid"], code="fhirid"))
-    if row["parent_index"] is not None:
-        pids.append(Identifier(id=row["parent_index"], code="index"))
-        
-    # for aliquotgroups referencing samples:
-    # make Identifiers
-    if row["parent_sampleid"] is not None:
-        pids.append(Identifier(id=row["parent_sampleid"], code=row["parent_idc"]))
-        
+
+    # for aliquots referencing aliquotgroups (derived samples without parent are reported by _fill_in_fhirids)
+    if values["parent_fhirid"] is not None:
+        pids.append(Ident(id=values["parent_fhirid"], code="fhirid"))
+    if values["parent_index"] is not None:
+        pids.append(Ident(id=values["parent_index"], code="index"))
+
+    # for aliquotgroups referencing samples
+    if values["parent_sampleid"] is not None:
+        pids.append(Ident(id=values["parent_sampleid"], code=get("parent_idc")))
+
     parent = None
     if len(pids) > 0:
-        # print("mainidc: " + mainidc)
-        parent = Idable(ids=pids, mainidc=row["parent_idc"])
+        parent = Ids(ids=pids, mainidc=_shared(get("parent_idc")))
 
     # make a patient identifier
     # get the patient id without pidc_ prefix
-    patid_raw = extract_identifiers(row, prefix="pidc_")
+    patid_raw = schema.identifiers(row, "pidc_")
     # there is only one patient id allowed
     if len(patid_raw) > 1:
-        print(f"error: more than one patient id for sample {ids.id()} given.")
-    patids = []
-    for type, value in patid_raw.items():
-        patids.append(Identifier(code=type, id=value))
-
-    # convert yxpos to xpos and ypos if given
-    xpos = intornone(row['ypos'])
-    ypos = intornone(row['ypos'])
-    if dig(row, "yxpos") is not None:
-        yxpos = dig(row, "yxpos")
-        (xpos, ypos) = a01toxy(yxpos)
-        
-    # make a sample instance from the row
-    sample = Sample(
-        category=row['category'],
-        samplingdate=collection_date,
-        repositiondate=reposition_date,
-        locationpath=row['location_path'],
-        orga=row['organization_unit'],
-        derivaldate=derival_date,
-        ids=ids,
-        type=row['type'],
+        print(f"error: more than one patient id for sample {raw_identifiers.get(mainidc)} given.")
+    patids = [Ident(code=type, id=value) for type, value in patid_raw.items()]
+
+    # make a sample record from the row
+    return SampleRecord(
+        category=_shared(get('category')),
+        samplingdate=values['collection_date'],
+        repositiondate=values['reposition_date'],
+        locationpath=_shared(get('location_path')),
+        orga=_shared(get('organization_unit')),
+        derivaldate=values['derival_date'],
+        ids=Ids(ids=identifiers, mainidc=mainidc),
+        type=_shared(get('type')),
         parent=parent,
-        patient=Idable(ids=patids, mainidc=patids[0].code),
-        receiptdate=received_date,
+        patient=Ids(ids=patids, mainidc=patids[0].code),
+        receiptdate=values['received_date'],
         initialamount=initial_amount,
         restamount=rest_amount,
-        xposition=xpos,
-        yposition=ypos,
-        receptacle=row['receptacle']
+        xposition=values['xpos'],
+        yposition=values['ypos'],
+        receptacle=_shared(get('receptacle'))
     )
 
-    # return
-    return sample
+def _shared(value):
+    """_shared returns the same string object for equal strings, so that the values that repeat from row to row, like units, materials and organization units, are held once. other values are returned as they are."""
+    if isinstance(value, str):
+        return sys.intern(value)
+    return value
+
+# the columns of a specimen csv that sample_values converts, the columnar reader converts the same columns (see columnar.sample_columns)
+sample_value_columns = ["received_date", "collection_date", "derival_date", "reposition_date", "initial_amount", "rest_amount", "xpos", "ypos", "fhirid", "index", "parent_fhirid", "parent_index", "parent_sampleid"]
+
+def sample_values(row:dict) -> dict:
+    """sample_values converts the values of a specimen csv row that aren't taken as they are: the dates, the amounts, the positions and the references, which are None if nullish. yxpos, if given, becomes xpos and ypos."""
+    # missing columns give None
+    get = row.get
+
+    values = {
+        # convert dates
+        "received_date": fbh.fromisoornone(get('received_date')),
+        "collection_date": fbh.fromisoornone(get('collection_date')),
+        "derival_date": fbh.fromisoornone(get('derival_date')),
+        "reposition_date": fbh.fromisoornone(get('reposition_date')),
+        # amounts
+        "initial_amount": float(get('initial_amount')) if get('initial_amount') else None,
+        "rest_amount": float(get('rest_amount')) if get('rest_amount') else None,
+        # positions
+        "xpos": intornone(get('xpos')),
+        "ypos": intornone(get('ypos'))
+    }
+
+    # convert yxpos to xpos and ypos if given
+    if not is_nullish(get("yxpos")):
+        (values["xpos"], values["ypos"]) = a01toxy(get("yxpos"))
+
+    # references
+    for key in ["fhirid", "index", "parent_fhirid", "parent_index", "parent_sampleid"]:
+        values[key] = None if is_nullish(get(key)) else get(key)
+
+    return values
 
 def a01toxy(yxpos:str) -> (int, int):
     """a01toxy converts an A01 position (y: A, x: 01) to a 0?1?-indexed (x,y) position."""
@@ -168,29 +419,34 @@ def a01toxy(yxpos:str) -> (int, int):
 
     return (x, y)
 
-def row_to_patient_fhir(row:dict, mainidc:str=None):
+def row_to_patient_fhir(row:dict, mainidc:str=None, schema:Schema=None):
     """row_to_patient_fhir turns a csv row to a patient fhir entry. it lets update_with_overwrite be set for each row."""
 
-    # to avoid errors if keys are missing
-    row = DictPath(row)
-    
+    if schema is None:
+        schema = schema_for("patient", tuple(row.keys()))
+
+    # missing columns give None
+    get = row.get
+
     # todo id_PSN auseinander droeseln in zwei argumente, die id und den idcontainertyp
 
     update_with_overwrite = get_update_overwrite_flag(row)
 
-    # identifiers
-    raw_identifiers, mainidc = extract_and_resolve_identifiers(row, prefix="pidc_", mainidc=mainidc)
-
-    identifiers = []
+    # identifiers, resolved already if the row was checked
+    checked_ids = getattr(row, "ids", None)
+    if checked_ids is not None:
+        raw_identifiers, mainidc = checked_ids
+    else:
+        raw_identifiers, mainidc = extract_and_resolve_identifiers(row, prefix="pidc_", mainidc=mainidc, schema=schema)
 
-    for type, value in raw_identifiers.items():
-        identifiers.append(Identifier(code=type, id=value))
+    identifiers = [Ident(code=type, id=value) for type, value in raw_identifiers.items()]
 
-    # for now, tuck in the fhirid with the identifiers
-    identifiers.append(Identifier(code="fhirid", id=row["fhirid"]))
+    # for now, tuck in the fhirid with the identifiers, if there is one. else fhir_patient generates it.
+    if not is_nullish(get("fhirid")):
+        identifiers.append(Ident(code="fhirid", id=get("fhirid")))
 
-    patient = Patient(ids=Idable(ids=identifiers, mainidc=mainidc),
-                      orga=row['organization_unit'])
+    patient = PatientRecord(ids=Ids(ids=identifiers, mainidc=mainidc),
+                            orga=get('organization_unit'))
 
     p_fhir = fhir_patient(patient, update_with_overwrite=update_with_overwrite)
     
@@ -198,89 +454,49 @@ def row_to_patient_fhir(row:dict, mainidc:str=None):
 
 
 
-def row_to_finding(row:dict, i, delim_cmp, delete=False):
-    """row_to_finding turns a csv row to a Finding instance."""
-    entry = None
+def row_to_finding(row:dict, i, delim_cmp, delete=False, effectivedate=None, schema:Schema=None, recs:dict=None):
+    """row_to_finding turns a csv row to a FindingRecord, see records.to_tram for a tram Finding. effectivedate and the component recs by code can be passed if they are already parsed, the recs of a validate.CheckedRow are taken. schema is the compiled header, looked up by the row's keys if not given."""
 
-    row = DictPath(row)
+    if schema is None:
+        schema = schema_for("observation", tuple(row.keys()))
 
-    # gather the components (columns prefixed by 'cmp_t_' and 'cmp_v_' for type and value respectively)
-    comps = {} # map indexed by component code.
-    for key in row.keys():
-        # are we at a component column
-        if re.match("^cmp_", key):
-            # each component comes with a type (t) and value (v) column:
-            # cmp_t_CODE cmp_v_CODE
-            # for the field names see the observation section in readme.md.
-            
-            # is it type or value?
-            a = key.split("_")
-            typeorval = a[1]
-
-            # what's the code of the component?
-            code = re.sub(r"^cmp_(t|v)_", "", key)
-            
-            # is this component new? add it.
-            if not code in comps:
-                comps[code] = {}
-
-            # put what's in the row at this key either into the component type or value
-            if typeorval == "t":
-                comps[code]["type"] = row[key]
-            elif typeorval == "v":
-                comps[code]["value"] = row[key]
-            else:
-                print("error: each component needs a cmp_t_CODE and cmp_v_CODE column, see the fhirbuild readme.")
-
-    comprecs = {}
-    # make recs from each component.
-    for code, comp in comps.items():
-        rec = None
-        if comp["type"] == "BOOLEAN":
-            rec = BooleanRec(rec=comp["value"])
-        elif comp["type"] == "NUMBER":
-            rec = NumberRec(rec=comp["value"])
-        elif comp["type"] == "DATE":
-            rec = DateRec(rec=comp["value"]) # parse?
-        elif comp["type"] == "STRING":
-            rec = StringRec(rec=comp["value"])
-        elif comp["type"] == "MULTI":
-            # split the value
-            values = comp["value"].split(delim_cmp)
-            rec = MultiRec(rec=values)
-        elif comp["type"] == "CATALOG":
-            # split
-            values = comp["value"].split(delim_cmp)
-            rec = CatalogRec(rec=values)
-            
-        comprecs[code] = rec
+    # missing columns give None
+    get = row.get
+
+    # make recs from the components: each comes with a type (t) and value (v) column, cmp_t_CODE cmp_v_CODE, found once by the schema.
+    # for the field names see the observation section in readme.md, for the types components.py. a checked row comes with its recs.
+    if recs is None:
+        recs = getattr(row, "recs", None)
+    if recs is None:
+        # imported here, only observations need it
+        from fhirbuild.components import parse_component
+        recs = {}
+        for code, (tcol, vcol) in schema.components.items():
+            recs[code] = parse_component(get(tcol), get(vcol), delim_cmp)
         
     # gather the sampleids (columns prefixed by 'sidc_') 
-    raw_identifiers = extract_identifiers(row, prefix="sidc_")
-    # make identifiers from them
-    sids = [] # array of Identifiers
-    for key, val in raw_identifiers.items():
-        sids.append(Identifier(id = val, code = key))
+    raw_identifiers = schema.identifiers(row, "sidc_")
+    # make ids from them
+    sids = [Ident(id=val, code=key) for key, val in raw_identifiers.items()]
 
     # get the patient id
-    patid_raw = extract_identifiers(row, prefix="pidc_")
+    patid_raw = schema.identifiers(row, "pidc_")
     # there is only one patient id allowed
     if len(patid_raw) > 1:
-        print(f"error: more than one patient id for sample {ids.id()} given.")
-    patids = []
-    for type, value in patid_raw.items():
-        patids.append(Identifier(code=type, id=value))
+        print(f"error: more than one patient id for sample {raw_identifiers.get('SAMPLEID')} given.")
+    patids = [Ident(code=type, id=value) for type, value in patid_raw.items()]
 
-    effectivedate = fbh.fromisoornone(row["effective_date_time"])
+    if effectivedate is None:
+        effectivedate = fbh.fromisoornone(get("effective_date_time"))
 
     # build the finding
-    finding = Finding(findingdate=effectivedate,
-                      method=row['method'],
-                      methodname=row['methodname'],
-                      patient=Idable(ids=patids, mainidc=patids[0].code),
-                      recs=comprecs,
-                      sample=Idable(ids=sids, mainidc="SAMPLEID"),
-                      sender=row['sender']
+    finding = FindingRecord(findingdate=effectivedate,
+                            method=_shared(get('method')),
+                            methodname=_shared(get('methodname')),
+                            patient=Ids(ids=patids, mainidc=patids[0].code),
+                            recs=recs,
+                            sample=Ids(ids=sids, mainidc="SAMPLEID"),
+                            sender=_shared(get('sender'))
     )
     
     # return the finding
@@ -311,7 +527,7 @@ def extract_identifiers(row: dict, prefix:str="idc_") -> list:
     #print(row)  # Debugging output
     return out
 
-def extract_and_resolve_identifiers(row: dict, prefix: str, mainidc: str) -> tuple:
+def extract_and_resolve_identifiers(row: dict, prefix: str, mainidc: str, schema:Schema=None) -> tuple:
     """
     Extract non-null identifier values from a row and determine the effective main identifier code.
 
@@ -321,6 +537,7 @@ def extract_and_resolve_identifiers(row: dict, prefix: str, mainidc: str) -> tup
         row (dict): The row dictionary to extract identifiers from.
         prefix (str): The prefix to identify identifier columns.
         mainidc (str): The main identifier code to check for.
+        schema (Schema): The compiled header of the csv, the identifier columns are taken from it if given.
     Returns:
         tuple[dict[str, Any], str]: (identifiers, resolved_mainidc)
     Raises:
@@ -333,8 +550,9 @@ def extract_and_resolve_identifiers(row: dict, prefix: str, mainidc: str) -> tup
     if prefix not in ["sidc_", "pidc_"]:
         raise ValueError("prefix must be either 'sidc_' or 'pidc_'")
     # get only identfieres with a non-nullish value and remove the prefix from the keys
+    raw_identifiers = schema.identifiers(row, prefix) if schema is not None else extract_identifiers(row, prefix=prefix)
     extracted_identifiers = {
-        k: v for k, v in extract_identifiers(row, prefix=prefix).items()
+        k: v for k, v in raw_identifiers.items()
         if not is_nullish(v)
     }
 
@@ -0,0 +1,104 @@
+# dates.py parses the dates of the csv and formats them for fhir
+
+# the same dates come up again and again, e.g. the day of a batch of
+# samples, so both ways are memoized: fromisoornone remembers the datetime
+# of each date string, and datestring the fhir string of each datetime,
+# so a date that repeats is parsed and formatted once. equal date strings
+# give the same datetime object, which is held once then. parse_dates
+# parses a whole column, each distinct value once.
+
+# fhir wants date times with a time zone. the dates in the csv come
+# without one mostly, they get the zone of the timezone policy, +01:00 if
+# not set otherwise with set_timezone. dates that come with an offset keep
+# it.
+
+import re
+from datetime import datetime, timezone, timedelta
+from functools import lru_cache
+
+# the timezone policy that set_timezone takes if none is given
+default_timezone = "+01:00"
+
+# the number of date strings and datetimes that are remembered each way
+date_cache_size = 65536
+
+# the policy and its tzinfo for dates without zone
+_timezone = default_timezone
+_tzinfo = timezone(timedelta(hours=1))
+
+def set_timezone(policy:str=None):
+    """set_timezone sets the time zone that dates without one get in datestring. policy is an offset like +01:00 or -05:30, UTC, or the name of a zone like Europe/Berlin, which switches between summer and winter time by the date. None sets default_timezone. it raises a ValueError for a policy it doesn't know."""
+    global _timezone, _tzinfo
+    policy = policy or default_timezone
+    _tzinfo = timezone_of(policy)
+    _timezone = policy
+    _string.cache_clear()
+
+def get_timezone() -> str:
+    """get_timezone returns the timezone policy, e.g. to set it in worker processes."""
+    return _timezone
+
+def timezone_of(policy:str):
+    """timezone_of returns the tzinfo of a timezone policy, see set_timezone."""
+    match = re.fullmatch(r"([+-])(\d{2}):?(\d{2})", policy)
+    if match is not None:
+        (sign, hours, minutes) = match.groups()
+        offset = timedelta(hours=int(hours), minutes=int(minutes))
+        if offset >= timedelta(hours=24):
+            raise ValueError(f"the offset {policy} isn't less than 24 hours")
+        return timezone(-offset if sign == "-" else offset)
+    if policy.upper() in ["UTC", "Z"]:
+        return timezone.utc
+    # imported here, only zone names need it
+    from zoneinfo import ZoneInfo
+    try:
+        return ZoneInfo(policy)
+    except (ValueError, KeyError):
+        raise ValueError(f"unknown time zone {policy}, give an offset like +01:00, UTC or a zone name like Europe/Berlin")
+
+def _parse(date_str:str) -> datetime:
+    """_parse is fromisoornone without memo."""
+    # nullish like help.is_nullish
+    stripped = date_str.strip()
+    if stripped == "" or stripped.lower() == "null":
+        return None
+    return datetime.fromisoformat(date_str)
+
+_parsed = lru_cache(maxsize=date_cache_size)(_parse)
+
+def fromisoornone(date_str:str) -> datetime:
+    """fromisoornone parses an iso-8601 string, or returns None if the string is nullish (see help.is_nullish). the datetimes are remembered by string."""
+    if date_str is None:
+        return None
+    return _parsed(date_str)
+
+def parse_dates(values:list) -> list:
+    """parse_dates is fromisoornone for a whole column of date strings, each distinct value is parsed once."""
+    parsed = {value: fromisoornone(value) for value in set(values)}
+    return [parsed[value] for value in values]
+
+def _format(d:datetime) -> str:
+    """_format is datestring for dates without zone, without memo."""
+    return d.replace(tzinfo=_tzinfo).isoformat()
+
+_string = lru_cache(maxsize=date_cache_size)(_format)
+
+def datestring(d:datetime) -> str:
+    """datestring returns the fhir date time string of d. dates without zone get the zone of the timezone policy, see set_timezone. the strings are remembered by date."""
+    if d is None:
+        return None
+    # dates with zone are equal to the same time in another zone, they aren't remembered
+    if d.tzinfo is not None:
+        return d.isoformat()
+    return _string(d)
+
+def set_date_cache_size(maxsize:int):
+    """set_date_cache_size sets how many date strings and datetimes are remembered each way, the least recently used are dropped first. None doesn't limit the caches, 0 turns them off."""
+    global _parsed, _string, date_cache_size
+    date_cache_size = maxsize
+    _parsed = lru_cache(maxsize=maxsize)(_parse)
+    _string = lru_cache(maxsize=maxsize)(_format)
+
+def date_cache_info() -> dict:
+    """date_cache_info returns the hits, misses, maxsize and currsize of the caches of parsed (fromisoornone) and formatted (datestring) dates."""
+    return {"parsed": _parsed.cache_info(), "formatted": _string.cache_info()}
@@ -1,8 +1,11 @@
-from datetime import datetime, timezone, timedelta
 import uuid
 import re
 import sys
 import csv
+from contextlib import contextmanager
+from functools import lru_cache
+# the dates are parsed and formatted, memoized, by dates.py
+from fhirbuild.dates import datestring, fromisoornone
 
 def intornone(s:str):
     """intornone parses a string to int, and letters A,B,C,... to numbers 1,2,3... if it receives None it returns None."""
@@ -20,39 +23,43 @@ def intornone(s:str):
     return int(s)
 
 
-def datestring(d: datetime) -> str:
-    """datestring returns fhir-compatible date string of date."""    
-    if d is None: 
-        return None
-    # make the date time-zone aware (for utc +00:00 timezone)
-    # d = d.replace(tzinfo=timezone.utc)
-    # todo only if the date doesn't have a timezone
-    # don't use the current timezone, cause the time zone of the sample should be kept, not the time zone where the user runs fhirbuild
-    # d = d.replace(tzinfo=datetime.now().astimezone().tzinfo)
-    d = d.replace(tzinfo=timezone(timedelta(hours=1)))
-    return d.isoformat()
-
 def genfhirid(fromstr:str):
-    """genfhirid generates a fhirid from given string (e.g. sampleid)."""
+    """genfhirid generates a fhirid from given string (e.g. sampleid). the fhirids are cached, see set_fhirid_cache_size."""
     # Generate a deterministic ID based on the input string
    
-    namespace = uuid.NAMESPACE_DNS  # Use DNS namespace for UUID generation
     if fromstr is None or fromstr == "":
         raise ValueError("fromstr must not be None or empty")
 
+    return _cached_fhirid(fromstr)
+
+def _uuid5(fromstr:str) -> str:
+    """_uuid5 generates the fhirid, uncached."""
+    namespace = uuid.NAMESPACE_DNS  # Use DNS namespace for UUID generation
     return str(uuid.uuid5(namespace, fromstr))  # Use uuid5 for deterministic ID generation
-    
 
-def fromisoornone(date_str: str) -> datetime | None:
-    """fromisoornone parses a ISO-8601 string or returns None if string is nullish.
-    Args:
-        date_str (str): The ISO-8601 date string.
-    Returns:
-        datetime or None: The parsed datetime object or None if input is nullish.   """
-    if is_nullish(date_str):
-        return None
+# the number of fhirids that genfhirid remembers. the same ids come up again and again, e.g. a patient's id for all of its samples and findings.
+fhirid_cache_size = 65536
+
+_cached_fhirid = lru_cache(maxsize=fhirid_cache_size)(_uuid5)
 
-    return datetime.fromisoformat(date_str)
+def set_fhirid_cache_size(maxsize:int):
+    """set_fhirid_cache_size sets how many fhirids genfhirid remembers, the least recently used are dropped first. None doesn't limit the cache, 0 turns it off. the cache and its counters start empty again."""
+    global _cached_fhirid, fhirid_cache_size
+    fhirid_cache_size = maxsize
+    _cached_fhirid = lru_cache(maxsize=maxsize)(_uuid5)
+
+def fhirid_cache_info():
+    """fhirid_cache_info returns the hits, misses, maxsize and currsize of the fhirid cache, to see whether its size fits the data."""
+    return _cached_fhirid.cache_info()
+
+def genfhirids(fromstrs) -> list:
+    """genfhirids generates the fhirids for a whole column of strings at once. each distinct string is generated once, the column's duplicates don't go through the cache."""
+    fhirids = {}
+    for fromstr in fromstrs:
+        if fromstr not in fhirids:
+            fhirids[fromstr] = genfhirid(fromstr)
+    return [fhirids[fromstr] for fromstr in fromstrs]
+    
 
 def is_nullish(value: str) -> bool:
     """Checks if the given string is None, empty or only contains whitespace 
@@ -72,9 +79,18 @@ def open_csv_file(filename, delimiter=";", encoding="utf-8"):
     """
     open_csv_file opens a CSV file and returns a DictReader object.
     """
+    return csv.DictReader(_open_file(filename, encoding), delimiter=delimiter)
+
+@contextmanager
+def csv_file(filename, delimiter=";", encoding="utf-8"):
+    """csv_file is open_csv_file for a with block, the file is closed after it."""
+    with _open_file(filename, encoding) as file:
+        yield csv.DictReader(file, delimiter=delimiter)
+
+def _open_file(filename, encoding):
+    """_open_file opens a file for reading, it exits with a message if it can't."""
     try:
-        file = open(filename, "r", encoding=encoding)
-        return csv.DictReader(file, delimiter=delimiter)
+        return open(filename, "r", encoding=encoding)
     except FileNotFoundError:
         print(f"File {filename} not found.")
         sys.exit(1)
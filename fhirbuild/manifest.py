@@ -0,0 +1,211 @@
+# manifest.py records the progress of a run, so that a run that crashed can be resumed
+
+# the manifest is a ndjson file next to the pages: a header line with the
+# fingerprint of the input csv and the options that shape the output, a
+# line for each written page with its checksum and the row number and
+# byte offset in the csv after the page's last row, and a last line when
+# the run is done. the lines are appended and flushed one at a time, so
+# a crash leaves the manifest up to the last page that was written.
+# resuming checks the pages against their checksums and continues after
+# the last good page, at its byte offset, with the same timestamp and the
+# next page number.
+
+import hashlib
+import json
+import os
+import re
+from collections import deque
+from datetime import datetime
+from fhirbuild.sinks import compressions, read_compressed
+
+# the version of the manifest format
+manifest_version = 1
+
+# the input is read in chunks of this many bytes for the fingerprint
+fingerprint_chunk = 1 << 20
+
+def manifest_path(outdir:str, name:str) -> str:
+    """manifest_path returns the path of the manifest of the pages of name (e.g. sample) in outdir. it doesn't end in .json, so it isn't taken for a page."""
+    return os.path.join(outdir, f"{name}_manifest.ndjson")
+
+def fingerprint(path:str) -> dict:
+    """fingerprint returns the size and a checksum of the whole file at path, to recognize the input of a run again. the file is read in chunks, so the input changing anywhere, also with the same size, changes the fingerprint and a run on it isn't resumed."""
+    sha = hashlib.sha256()
+    with open(path, "rb") as f:
+        while chunk := f.read(fingerprint_chunk):
+            sha.update(chunk)
+    return {"size": os.path.getsize(path), "sha256": sha.hexdigest()}
+
+def load_manifest(path:str) -> tuple:
+    """load_manifest reads a manifest and returns its header, its page records in page order and whether the run is done. a last line cut off by a crash is ignored."""
+    header = None
+    pages = []
+    done = False
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                break
+            if header is None:
+                header = record
+            elif "page" in record:
+                pages.append(record)
+            elif record.get("done"):
+                done = True
+    if header is None or header.get("manifest") != manifest_version:
+        raise ValueError(f"{path} is not a fhirbuild manifest")
+    return (header, pages, done)
+
+def check_manifest(header:dict, incsv:str, options:dict) -> list:
+    """check_manifest compares the header of a manifest with the input csv and the options of the run to be resumed. it returns what differs, empty if the run can be resumed."""
+    diffs = []
+    if header["input"] != fingerprint(incsv):
+        diffs.append(f"the input {incsv} changed")
+    for key, value in options.items():
+        if header["options"].get(key) != value:
+            diffs.append(f"{key} was {header['options'].get(key)}, now {value}")
+    return diffs
+
+def verify_pages(outdir:str, header:dict, pages:list) -> int:
+    """verify_pages checks the written pages of a manifest against their checksums, in page order. it returns the number of pages up to the first missing or changed one. the pages are found by page number, padded or not."""
+    compress = header["options"].get("compress")
+    files = page_files(outdir, header["timestamp"], header["name"], compress)
+    for (n, record) in enumerate(pages):
+        if record["page"] != n or n not in files:
+            return n
+        try:
+            data = read_compressed(os.path.join(outdir, files[n]), compress)
+        except (OSError, EOFError, ValueError):
+            return n
+        if hashlib.sha256(data).hexdigest() != record["sha256"]:
+            return n
+    return len(pages)
+
+def page_files(outdir:str, timestamp:str, name:str, compress:str=None) -> dict:
+    """page_files returns the file names of the pages of a run in outdir by page number."""
+    pattern = re.compile(re.escape(f"{timestamp}_{name}_p") + r"(\d+)\.json" + re.escape(compressions.get(compress, "")) + "$")
+    files = {}
+    for file in os.listdir(outdir):
+        match = pattern.match(file)
+        if match is not None:
+            files[int(match.group(1))] = file
+    return files
+
+def tidy_pages(outdir:str, header:dict, pages:list):
+    """tidy_pages prepares the pages of a run for resuming: the kept pages get back the names they were written with, in case they were padded already, and the pages after them are removed, they are written again."""
+    compress = header["options"].get("compress")
+    suffix = compressions.get(compress, "")
+    for (n, file) in page_files(outdir, header["timestamp"], header["name"], compress).items():
+        if n >= len(pages):
+            os.remove(os.path.join(outdir, file))
+        elif file != pages[n]["name"] + suffix:
+            os.replace(os.path.join(outdir, file), os.path.join(outdir, pages[n]["name"] + suffix))
+
+
+class Checkpoint:
+    """Checkpoint writes the manifest of a run while the pages are written. reader is the manifest's reader.OffsetReader, it tells the byte offset after each row. the entries need to be passed through count, one entry per csv row, for page to know the rows of a page by its last entry, rows without entry are counted with skip. to resume, rows is the number of rows done before and pages the page records kept from the manifest."""
+
+    def __init__(self, path:str, header:dict, reader, rows:int=0, pages:list=None):
+        self.path = path
+        self.header = header
+        self.reader = reader
+        self.rows = rows
+        # the entries taken and not yet put on a page, with the number of rows done by each
+        self.pending = deque()
+        # write the header and the kept pages anew, dropping what came after the last good page
+        tmp = path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            for record in [header] + (pages or []):
+                f.write(json.dumps(record) + "\n")
+        os.replace(tmp, path)
+        self.file = open(path, "a", encoding="utf-8")
+
+    def count(self, entries):
+        """count passes the entries through, counting the csv rows done and remembering the rows done with each entry."""
+        for entry in entries:
+            self.rows += 1
+            self.pending.append((entry, self.rows))
+            yield entry
+
+    def skip(self):
+        """skip counts a csv row that gives no entry, like a row that validate.Rejects took, as done. the row counts with the next entry."""
+        self.rows += 1
+
+    def done_with(self, bundle:dict) -> int:
+        """done_with returns the number of rows done with the last entry of bundle and forgets the entries up to it. the bundling may hold back entries taken for the next page, or entries may be left out on the way, so the rows are told by the entries on the page, not by the entries taken. for a page without entries all rows taken are done."""
+        entries = bundle.get("entry") if bundle is not None else None
+        if not entries:
+            self.pending.clear()
+            return self.rows
+        last = entries[-1]
+        while len(self.pending) > 0:
+            (entry, rows) = self.pending.popleft()
+            if entry is last:
+                return rows
+        return self.rows
+
+    def position(self, rows:int=None) -> tuple:
+        """position returns the number of rows done, all rows taken if not given, and the byte offset after the last of them."""
+        if rows is None:
+            rows = self.rows
+        offsets = self.reader.offsets
+        # the reader may have read ahead, drop the offsets of the rows before the last one done
+        while len(offsets) > 0 and offsets[0][0] < rows - 1:
+            offsets.popleft()
+        offset = offsets[0][1] if len(offsets) > 0 and offsets[0][0] == rows - 1 else None
+        return (rows, offset)
+
+    def page(self, page:int, name:str, bundle:dict=None):
+        """page takes the position at the end of page, which is to be written as name, after the last entry of bundle. it returns a function that records the page with the checksum of its bytes once they are written."""
+        (rows, offset) = self.position(self.done_with(bundle))
+        def written(data:bytes):
+            self._record({"page": page, "name": name, "sha256": hashlib.sha256(data).hexdigest(), "rows": rows, "offset": offset})
+        return written
+
+    def _record(self, record:dict):
+        """_record appends a line to the manifest and flushes it."""
+        self.file.write(json.dumps(record) + "\n")
+        self.file.flush()
+
+    def finish(self, pages:int):
+        """finish records that the run is done with pages pages."""
+        self._record({"done": True, "pages": pages})
+
+    def close(self):
+        """close closes the manifest."""
+        self.file.close()
+
+def new_header(incsv:str, name:str, timestamp:str, options:dict) -> dict:
+    """new_header returns the header of the manifest of a new run from incsv, writing the pages of name with timestamp. options are the options that shape the output, a resumed run needs the same."""
+    return {"manifest": manifest_version, "name": name, "timestamp": timestamp, "input": fingerprint(incsv), "options": options}
+
+def start_run(incsv:str, outdir:str, name:str, options:dict, resume:bool=False, delimiter:str=";", encoding:str="utf-8") -> tuple:
+    """start_run starts a run with a manifest in outdir, writing the pages of name from incsv, or, with resume, continues the run of the manifest there after its last good page. options are the options that shape the output. it returns the Checkpoint, the reader.OffsetReader positioned at the first row to convert, its row number, the first page number and the timestamp of the run. if the run of the manifest is already done, it returns None. it raises a ValueError if the run can't be resumed with this input and these options."""
+    from fhirbuild.reader import OffsetReader
+
+    path = manifest_path(outdir, name)
+    pages = []
+    (start_row, offset) = (0, None)
+    if resume and os.path.exists(path):
+        (header, pages, done) = load_manifest(path)
+        if done:
+            print(f"the run in {path} is done, nothing to resume")
+            return None
+        diffs = check_manifest(header, incsv, options)
+        if len(diffs) > 0:
+            raise ValueError(f"can't resume the run in {path}: {'; '.join(diffs)}")
+        pages = pages[:verify_pages(outdir, header, pages)]
+        tidy_pages(outdir, header, pages)
+        if len(pages) > 0:
+            (start_row, offset) = (pages[-1]["rows"], pages[-1]["offset"])
+        print(f"resuming the run in {path} at page {len(pages)}, row {start_row}")
+    else:
+        if resume:
+            print(f"no manifest {path}, starting a new run")
+        header = new_header(incsv, name, datetime.now().strftime("%Y-%m-%d_%H-%M-%S"), options)
+
+    os.makedirs(outdir, exist_ok=True)
+    reader = OffsetReader(incsv, delimiter=delimiter, encoding=encoding, offset=offset, row=start_row)
+    checkpoint = Checkpoint(path, header, reader, rows=start_row, pages=pages)
+    return (checkpoint, reader, start_row, len(pages), header["timestamp"])
@@ -0,0 +1,84 @@
+# profiling.py profiles a run with cProfile, for pstats and flame graphs
+
+# cProfile records for each function the time it took by itself and
+# with what it called, per caller, but no whole call stacks. the stacks
+# for flame graphs are estimated from that: starting at the functions
+# that weren't called by others, each function's time is split among
+# the functions it called in proportion to their time from it. that is
+# exact for functions called from one place, for functions called from
+# several places their time is spread evenly over their calls.
+
+import cProfile
+import os
+import pstats
+from contextlib import contextmanager
+
+@contextmanager
+def profiled(path:str, folded:str=None):
+    """profiled profiles the code run in its block and writes the stats to path, to be read with pstats (or snakeviz and the like), and the collapsed stacks to folded, to be read by flamegraph.pl, speedscope or inferno. folded is path with the extension .folded if not given. the stats are written also if the block raises. only this process is profiled, not worker processes."""
+    profile = cProfile.Profile()
+    profile.enable()
+    try:
+        yield profile
+    finally:
+        profile.disable()
+        if folded is None:
+            folded = os.path.splitext(path)[0] + ".folded"
+        write_profile(profile, path, folded)
+
+def write_profile(profile:cProfile.Profile, path:str, folded:str):
+    """write_profile writes the stats of a profile to path and its collapsed stacks to folded."""
+    profile.dump_stats(path)
+    stats = pstats.Stats(profile)
+    with open(folded, "w", encoding="utf-8") as f:
+        for (stack, micros) in collapsed_stacks(stats):
+            f.write(f"{stack} {micros}\n")
+    print(f"wrote the profile to {path} and {folded}")
+
+def collapsed_stacks(stats:pstats.Stats, min_micros:int=1, max_depth:int=200) -> list:
+    """collapsed_stacks returns the call stacks of pstats stats with the microseconds spent in the last function of each stack by itself, estimated from the times per caller, as (stack, microseconds) tuples. the functions of a stack are separated by ;, like flame graph tools read them. stacks with less than min_micros are left out, recursion is cut."""
+    # the functions each function called, with their cumulative time from it
+    callees = {}
+    roots = []
+    for (func, (cc, nc, tt, ct, callers)) in stats.stats.items():
+        if len(callers) == 0:
+            roots.append(func)
+        for (caller, edge) in callers.items():
+            callees.setdefault(caller, []).append((func, edge[3]))
+
+    # add up the time of equal stacks
+    micros = {}
+
+    def walk(func, seconds:float, stack:list, names:list):
+        """walk attributes seconds of func's cumulative time on stack to func itself and to its callees."""
+        (cc, nc, tt, ct, callers) = stats.stats[func]
+        names = names + [_func_name(func)]
+        # the share of func's time that is spent on this stack
+        share = seconds / ct if ct > 0 else 0.0
+        own = int(tt * share * 1e6)
+        if own >= min_micros:
+            key = ";".join(names)
+            micros[key] = micros.get(key, 0) + own
+        if len(names) >= max_depth:
+            return
+        for (callee, edge) in callees.get(func, []):
+            # recursion is counted in the first call already
+            if callee in stack or callee == func:
+                continue
+            t = edge * share
+            if t * 1e6 >= min_micros:
+                walk(callee, t, stack + [func], names)
+
+    for func in roots:
+        walk(func, stats.stats[func][3], [], [])
+    return sorted(micros.items())
+
+def _func_name(func:tuple) -> str:
+    """_func_name returns a readable name for a pstats function key (file, line, name), without the characters that separate the collapsed stacks."""
+    (file, line, name) = func
+    if file == "~":
+        # builtins
+        label = name
+    else:
+        label = f"{name} ({os.path.basename(file)}:{line})"
+    return label.replace(";", ",")
@@ -0,0 +1,172 @@
+# reader.py reads csv files keeping track of where in the file each row ends
+
+# MappedCsv memory-maps the csv and cuts it into byte ranges of whole rows,
+# that can be read by themselves, e.g. by worker processes, without the
+# rows being read and handed over by one process. a newline ends a row if
+# an even number of quotes came before it since the start of the row, else
+# it is in a quoted value. the quotes are counted from one range boundary
+# to the next, so the file is scanned once, a block at a time. each range
+# starts after a newline byte, so it decodes by itself in an ascii-
+# compatible encoding.
+
+import csv
+import io
+import mmap
+import os
+from collections import deque
+
+# the bytes per range that MappedCsv.ranges aims at
+range_bytes = 4 * 1024 * 1024
+
+# the bytes that are searched for quotes at a time
+_block = 1024 * 1024
+
+def _check_encoding(encoding:str):
+    """_check_encoding raises a ValueError if the rows can't be split at newline bytes in encoding, since it's not ascii-compatible."""
+    # the lines are split as bytes, this needs newlines and the csv characters to be single ascii bytes
+    if not "\n;,\"".encode(encoding).endswith(b"\n;,\""):
+        raise ValueError(f"can't split the rows of a csv in {encoding} by bytes, use an ascii-compatible encoding like utf-8")
+
+def _row_dict(fieldnames:list, values:list) -> dict:
+    """_row_dict makes the dict of a row like csv.DictReader: missing values are None, extra values are listed under None."""
+    row = dict(zip(fieldnames, values))
+    if len(values) < len(fieldnames):
+        for name in fieldnames[len(values):]:
+            row[name] = None
+    elif len(values) > len(fieldnames):
+        row[None] = values[len(fieldnames):]
+    return row
+
+class OffsetReader:
+    """OffsetReader reads a csv file like csv.DictReader, yielding a dict for each row, and remembers the byte offset after each row in offsets, as (row number, offset) tuples. the remembered offsets are dropped by whoever uses them, see manifest.Checkpoint. with offset and row, reading starts at byte offset in the file, which counts as row number row, after the header is read from the start of the file. the encoding needs to be ascii-compatible, like utf-8, utf-8-sig or latin-1, so that lines can be split at newline bytes."""
+
+    def __init__(self, path:str, delimiter:str=";", encoding:str="utf-8", offset:int=None, row:int=0):
+        _check_encoding(encoding)
+        self.path = path
+        self.encoding = encoding
+        self.file = open(path, "rb")
+        self.offset = 0
+        self.row = row
+        self.offsets = deque()
+        self.reader = csv.reader(self._lines(), delimiter=delimiter)
+        self.fieldnames = next(self.reader, None)
+        if offset is not None:
+            self.file.seek(offset)
+            self.offset = offset
+
+    def _lines(self):
+        """_lines yields the decoded lines of the file, counting the bytes read. line endings become \\n, like in text mode."""
+        while True:
+            raw = self.file.readline()
+            if raw == b"":
+                return
+            self.offset += len(raw)
+            line = raw.decode(self.encoding)
+            if line.endswith("\r\n"):
+                line = line[:-2] + "\n"
+            yield line
+
+    def __iter__(self):
+        return self
+
+    def __next__(self) -> dict:
+        values = next(self.reader)
+        # skip empty lines, like csv.DictReader
+        while values == []:
+            values = next(self.reader)
+        self.offsets.append((self.row, self.offset))
+        self.row += 1
+        return _row_dict(self.fieldnames, values)
+
+    def close(self):
+        """close closes the file."""
+        self.file.close()
+
+
+class MappedCsv:
+    """MappedCsv memory-maps a csv file to cut it into byte ranges of whole rows, see ranges, and to read the rows of a range, see rows. the header is read on opening, fieldnames are its column names and start is the byte offset of the first row after it. quoted values may span lines. the encoding needs to be ascii-compatible, like utf-8, utf-8-sig or latin-1."""
+
+    def __init__(self, path:str, delimiter:str=";", encoding:str="utf-8"):
+        _check_encoding(encoding)
+        self.path = path
+        self.delimiter = delimiter
+        self.encoding = encoding
+        self.file = open(path, "rb")
+        self.size = os.fstat(self.file.fileno()).st_size
+        # an empty file can't be mapped
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ) if self.size > 0 else b""
+        self.start = self.boundary(0, 0)
+        header = list(self._reader(0, self.start))
+        self.fieldnames = header[0] if len(header) > 0 else None
+
+    def boundary(self, pos:int, after:int) -> int:
+        """boundary returns the offset of the first row that starts after pos, or the size of the file. after is the offset of a row start at or before pos, the quotes between it and pos tell whether pos is in a quoted value."""
+        inside = self._quotes(after, pos) % 2 == 1
+        while True:
+            if inside:
+                # skip to the closing quote, an escaped quote "" closes and opens again
+                q = self.map.find(b'"', pos)
+                if q < 0:
+                    return self.size
+                (pos, inside) = (q + 1, False)
+            else:
+                n = self.map.find(b"\n", pos)
+                if n < 0:
+                    return self.size
+                q = self.map.find(b'"', pos, n)
+                if q < 0:
+                    return n + 1
+                (pos, inside) = (q + 1, True)
+
+    def _quotes(self, start:int, end:int) -> int:
+        """_quotes counts the quotes between the offsets start and end, a block at a time."""
+        n = 0
+        for i in range(start, end, _block):
+            n += self.map[i:min(i + _block, end)].count(b'"')
+        return n
+
+    def ranges(self, size:int=None) -> list:
+        """ranges cuts the rows after the header into ranges of about size bytes, range_bytes if not given, and returns them as (start, end) byte offsets. each range holds whole rows, a row longer than size makes a range longer than size."""
+        size = size or range_bytes
+        ranges = []
+        start = self.start
+        while start < self.size:
+            end = self.boundary(min(start + size, self.size), start) if start + size < self.size else self.size
+            ranges.append((start, end))
+            start = end
+        return ranges
+
+    def _reader(self, start:int, end:int):
+        """_reader returns a csv.reader for the bytes between start and end, decoded by themselves. line endings become \\n, like when the file is read in text mode."""
+        text = self.map[start:end].decode(self.encoding)
+        return csv.reader(io.StringIO(text, newline=None), delimiter=self.delimiter)
+
+    def rows(self, start:int, end:int):
+        """rows yields the rows of the range from start to end as dicts, like csv.DictReader."""
+        for values in self._reader(start, end):
+            # skip empty lines, like csv.DictReader
+            if values == []:
+                continue
+            yield _row_dict(self.fieldnames, values)
+
+    def iter_ranges(self, ranges:list, starts:list=None):
+        """iter_ranges yields the rows of ranges one after the other. if starts is given, the row number of the first row of each range is appended to it."""
+        n = 0
+        for (start, end) in ranges:
+            if starts is not None:
+                starts.append(n)
+            for row in self.rows(start, end):
+                n += 1
+                yield row
+
+    def close(self):
+        """close unmaps and closes the file."""
+        if self.size > 0:
+            self.map.close()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,152 @@
+# records.py holds the lean records the csv rows are converted to
+
+# a csv row used to become a DictPath and then a tram Sample, Finding or
+# Patient, with an Identifier object for each id and an Idable around
+# them. the records here hold the same in slotted objects, with the ids as
+# (code, id) tuples. where the fhir_* builders read them (sample.id(code),
+# sample.identifier(), sample.ids, sample.parent, ...) they look like the
+# tram objects, so the builders take either. to_tram makes tram objects of
+# them for library callers that want those.
+
+from collections import namedtuple
+
+# an id with its idc code, like a tram Identifier
+Ident = namedtuple("Ident", ["code", "id"])
+
+# an amount with its unit, like a tram Amount
+AmountRecord = namedtuple("AmountRecord", ["value", "unit"])
+
+class Ids:
+    """Ids is a list of Idents with the code of the main id, like a tram Idable."""
+
+    __slots__ = ("ids", "mainidc")
+
+    def __init__(self, ids:list=None, mainidc:str=None):
+        self.ids = ids if ids is not None else []
+        self.mainidc = mainidc
+
+    def identifier(self, code:str=None) -> Ident:
+        """identifier returns the first Ident with code, the main id if code isn't given, or None."""
+        if code is None:
+            code = self.mainidc
+        for ident in self.ids:
+            if ident.code == code:
+                return ident
+        return None
+
+    def id(self, code:str=None) -> str:
+        """id returns the id with code, the main id if code isn't given, or None."""
+        ident = self.identifier(code)
+        if ident is None:
+            return None
+        return ident.id
+
+class SampleRecord(Ids):
+    """SampleRecord is a sample from a csv row, with the fields of a tram Sample. its own ids are in ids, parent and patient are Ids."""
+
+    __slots__ = ("category", "samplingdate", "repositiondate", "locationpath", "orga", "derivaldate", "type", "parent", "patient", "receiptdate", "initialamount", "restamount", "xposition", "yposition", "receptacle", "stockprocessing", "stockprocessingdate", "secondprocessing", "secondprocessingdate", "concentration")
+
+    def __init__(self, ids:Ids=None, category:str=None, samplingdate=None, repositiondate=None, locationpath:str=None, orga:str=None, derivaldate=None, type:str=None, parent:Ids=None, patient:Ids=None, receiptdate=None, initialamount:AmountRecord=None, restamount:AmountRecord=None, xposition:int=None, yposition:int=None, receptacle:str=None, stockprocessing:str=None, stockprocessingdate=None, secondprocessing:str=None, secondprocessingdate=None, concentration=None):
+        ids = ids or Ids()
+        super().__init__(ids.ids, ids.mainidc)
+        self.category = category
+        self.samplingdate = samplingdate
+        self.repositiondate = repositiondate
+        self.locationpath = locationpath
+        self.orga = orga
+        self.derivaldate = derivaldate
+        self.type = type
+        self.parent = parent
+        self.patient = patient
+        self.receiptdate = receiptdate
+        self.initialamount = initialamount
+        self.restamount = restamount
+        self.xposition = xposition
+        self.yposition = yposition
+        self.receptacle = receptacle
+        self.stockprocessing = stockprocessing
+        self.stockprocessingdate = stockprocessingdate
+        self.secondprocessing = secondprocessing
+        self.secondprocessingdate = secondprocessingdate
+        self.concentration = concentration
+
+class FindingRecord:
+    """FindingRecord is a finding from a csv row, with the fields of a tram Finding. patient and sample are Ids, recs are the component Recs by code."""
+
+    __slots__ = ("findingdate", "method", "methodname", "patient", "recs", "sample", "sender")
+
+    def __init__(self, findingdate=None, method:str=None, methodname:str=None, patient:Ids=None, recs:dict=None, sample:Ids=None, sender:str=None):
+        self.findingdate = findingdate
+        self.method = method
+        self.methodname = methodname
+        self.patient = patient
+        self.recs = recs
+        self.sample = sample
+        self.sender = sender
+
+class PatientRecord(Ids):
+    """PatientRecord is a patient from a csv row, with the fields of a tram Patient."""
+
+    __slots__ = ("orga",)
+
+    def __init__(self, ids:Ids=None, orga:str=None):
+        ids = ids or Ids()
+        super().__init__(ids.ids, ids.mainidc)
+        self.orga = orga
+
+def to_tram(record):
+    """to_tram returns the tram Sample, Finding or Patient of a SampleRecord, FindingRecord or PatientRecord. other objects, e.g. tram objects already, are returned as they are."""
+    # imported here, only callers that want tram objects need it
+    import tram
+    match record:
+        case SampleRecord():
+            return tram.Sample(
+                ids=_idable(record),
+                category=record.category,
+                samplingdate=record.samplingdate,
+                repositiondate=record.repositiondate,
+                locationpath=record.locationpath,
+                orga=record.orga,
+                derivaldate=record.derivaldate,
+                type=record.type,
+                parent=_idable(record.parent),
+                patient=_idable(record.patient),
+                receiptdate=record.receiptdate,
+                initialamount=_amount(record.initialamount),
+                restamount=_amount(record.restamount),
+                xposition=record.xposition,
+                yposition=record.yposition,
+                receptacle=record.receptacle,
+                stockprocessing=record.stockprocessing,
+                stockprocessingdate=record.stockprocessingdate,
+                secondprocessing=record.secondprocessing,
+                secondprocessingdate=record.secondprocessingdate,
+                concentration=record.concentration
+            )
+        case FindingRecord():
+            return tram.Finding(
+                findingdate=record.findingdate,
+                method=record.method,
+                methodname=record.methodname,
+                patient=_idable(record.patient),
+                recs=record.recs,
+                sample=_idable(record.sample),
+                sender=record.sender
+            )
+        case PatientRecord():
+            return tram.Patient(ids=_idable(record), orga=record.orga)
+    return record
+
+def _idable(ids:Ids):
+    """_idable returns the tram Idable of Ids, or None."""
+    import tram
+    if ids is None:
+        return None
+    return tram.Idable(ids=[tram.Identifier(code=ident.code, id=ident.id) for ident in ids.ids], mainidc=ids.mainidc)
+
+def _amount(amount:AmountRecord):
+    """_amount returns the tram Amount of an AmountRecord, or None."""
+    import tram
+    if amount is None:
+        return None
+    return tram.Amount(value=amount.value, unit=amount.unit)
@@ -0,0 +1,86 @@
+# schema.py compiles the header of a csv once into the plan the row converters work by
+
+# the header is the same for each row of a file, so which columns hold
+# sample ids, patient ids and the type and value of which component is
+# worked out once, instead of each row scanning its keys for prefixes.
+# unknown and malformed columns are found up front, at no cost per row.
+
+from functools import lru_cache
+
+# the columns each csv type knows, besides the prefixed id and component columns. see the column names in readme.md.
+columns = {
+    "specimen": ["category", "collection_date", "concentration", "concentration_unit", "derival_date", "fhirid", "index", "initial_amount", "initial_unit", "location_path", "mainidc", "organization_unit", "parent_fhirid", "parent_idc", "parent_index", "parent_sampleid", "received_date", "receptacle", "reposition_date", "rest_amount", "rest_unit", "type", "xpos", "ypos", "yxpos"],
+    "observation": ["effective_date_time", "method", "methodname", "sender", "update_with_overwrite"],
+    "patient": ["fhirid", "mainidc", "organization_unit", "study", "update_with_overwrite"]
+}
+
+# the prefixed columns each csv type knows
+prefixes = {
+    "specimen": ["sidc_", "pidc_"],
+    "observation": ["sidc_", "pidc_", "cmp_"],
+    "patient": ["pidc_"]
+}
+
+class Schema:
+    """Schema is the compiled header of a csv of type specimen, observation or patient. ids maps the prefixes sidc_ and pidc_ to (idc code, column) tuples, components maps each component code to its cmp_t_ and cmp_v_ column, unknown lists the columns that aren't used."""
+
+    def __init__(self, type:str, fieldnames:list, ids:dict, components:dict, unknown:list):
+        self.type = type
+        self.fieldnames = fieldnames
+        self.ids = ids
+        self.components = components
+        self.unknown = unknown
+
+    def identifiers(self, row:dict, prefix:str) -> dict:
+        """identifiers is extract_identifiers by the plan: the ids of the row with prefix, keyed by idc code without prefix, leaving out None values."""
+        return {code: row[column] for (code, column) in self.ids.get(prefix, []) if row[column] is not None}
+
+def compile_schema(fieldnames, type:str) -> Schema:
+    """compile_schema compiles the header fieldnames of a csv of type. it raises a ValueError for component columns that aren't cmp_t_CODE or cmp_v_CODE or miss their counterpart."""
+    if type not in columns:
+        raise ValueError(f"unknown type: {type}, choose from {', '.join(columns)}")
+    fieldnames = list(fieldnames) if fieldnames is not None else []
+
+    ids = {"sidc_": [], "pidc_": []}
+    comps = {}
+    unknown = []
+    malformed = []
+    for name in fieldnames:
+        if name is None:
+            continue
+        prefix = next((p for p in prefixes[type] if name.startswith(p)), None)
+        if prefix is None:
+            if name not in columns[type]:
+                unknown.append(name)
+        elif prefix == "cmp_":
+            # each component comes with a type (t) and value (v) column: cmp_t_CODE cmp_v_CODE
+            if name.startswith("cmp_t_"):
+                comps.setdefault(name.removeprefix("cmp_t_"), {})["type"] = name
+            elif name.startswith("cmp_v_"):
+                comps.setdefault(name.removeprefix("cmp_v_"), {})["value"] = name
+            else:
+                malformed.append(name)
+        else:
+            ids[prefix].append((name.removeprefix(prefix), name))
+
+    # each component needs both columns
+    for code, comp in comps.items():
+        if "type" not in comp:
+            malformed.append(f"cmp_v_{code} (no cmp_t_{code})")
+        elif "value" not in comp:
+            malformed.append(f"cmp_t_{code} (no cmp_v_{code})")
+    if len(malformed) > 0:
+        raise ValueError(f"each component needs a cmp_t_CODE and cmp_v_CODE column, see the fhirbuild readme. malformed: {', '.join(malformed)}")
+
+    components = {code: (comp["type"], comp["value"]) for code, comp in comps.items()}
+    return Schema(type, fieldnames, ids, components, unknown)
+
+@lru_cache(maxsize=64)
+def schema_for(type:str, fieldnames:tuple) -> Schema:
+    """schema_for is compile_schema, compiled once per type and header. the row converters use it when they aren't given a schema."""
+    return compile_schema(fieldnames, type)
+
+def warn_unknown(schema:Schema):
+    """warn_unknown prints the columns of schema that aren't used."""
+    if len(schema.unknown) > 0:
+        print(f"warning: unknown {schema.type} columns are ignored: {', '.join(schema.unknown)}")
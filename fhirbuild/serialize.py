@@ -0,0 +1,105 @@
+# serialize.py turns fhir bundles into the bytes that are written out
+
+import json
+import os
+import re
+
+# orjson is optional, it is used by the fast serializer if it is installed. it is imported when the fast serializer is asked for.
+_orjson = None
+
+# the names of the serializers
+serializers = ["pretty", "compact", "fast"]
+
+def get_serializer(name:str="pretty"):
+    """get_serializer returns a function that turns a bundle into utf-8 bytes, by the name pretty, compact or fast."""
+    # the output of each serializer is byte-for-byte the same for the same bundle. pretty and compact don't depend on what is installed, fast does, so pass compact if the output is compared across machines.
+    match name:
+        case "pretty":
+            # indented by 4, lines end like a text file on this platform, as writeout always did. the slowest, for reading and debugging.
+            return _pretty
+        case "compact":
+            # no whitespace, with the c encoder of the json module
+            return _compact
+        case "fast":
+            # compact via orjson if it is installed
+            orjson = _import_orjson()
+            if orjson is not None:
+                return orjson.dumps
+            return _compact
+        case _:
+            raise ValueError(f"unknown serializer {name}, choose from {', '.join(serializers)}")
+
+def _import_orjson():
+    """_import_orjson returns the orjson module, or False if it isn't installed."""
+    global _orjson
+    if _orjson is None:
+        try:
+            import orjson
+            _orjson = orjson
+        except ImportError:
+            _orjson = False
+    return _orjson or None
+
+def _pretty(bundle) -> bytes:
+    """_pretty serializes indented with the line endings of the platform."""
+    s = json.dumps(bundle, indent=4, ensure_ascii=False)
+    if os.linesep != "\n":
+        # json escapes newlines in strings, so only the indentation newlines are replaced
+        s = s.replace("\n", os.linesep)
+    return s.encode("utf-8")
+
+def _compact(bundle) -> bytes:
+    """_compact serializes without whitespace."""
+    return json.dumps(bundle, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+def serializer_indent(name:str="pretty") -> int:
+    """serializer_indent returns the indentation of the serializer name, None for the compact ones."""
+    if name == "pretty":
+        return 4
+    return None
+
+def estimate_size(obj, indent:int=None, depth:int=0) -> int:
+    """estimate_size returns the number of bytes of obj serialized as json, without serializing it: compact, or indented by indent like pretty at nesting depth depth. it is exact, escapes included, so it can be added up entry by entry."""
+    t = type(obj)
+    if t is str:
+        return _str_size(obj) + 2
+    if t is dict or t is list:
+        n = len(obj)
+        if n == 0:
+            return 2
+        if t is dict:
+            # "key":value
+            size = sum(_str_size(key) + 3 + estimate_size(value, indent, depth + 1) for (key, value) in obj.items())
+        else:
+            size = sum(estimate_size(value, indent, depth + 1) for value in obj)
+        # the brackets and the commas
+        size += 2 + n - 1
+        if indent is not None:
+            # a line break and the indentation before each item and before the closing bracket
+            size += (n + 1) * len(os.linesep) + n * indent * (depth + 1) + indent * depth
+            if t is dict:
+                # the space after each colon
+                size += n
+        return size
+    # numbers, true, false and null are as long as their repr
+    return len(repr(obj))
+
+def list_item_size(obj, indent:int=None, depth:int=0) -> int:
+    """list_item_size returns the number of bytes obj adds as an item to a non-empty list whose items are at nesting depth depth, with the comma before it, see estimate_size."""
+    size = estimate_size(obj, indent, depth) + 1
+    if indent is not None:
+        size += len(os.linesep) + indent * depth
+    return size
+
+# the characters json escapes in strings: " and \ and \b \f \n \r \t get a backslash, the other control characters become \u00XX
+_escaped = re.compile(r'[\x00-\x1f"\\]')
+_short_escapes = set('"\\\b\f\n\r\t')
+
+def _str_size(s:str) -> int:
+    """_str_size returns the number of utf-8 bytes of s in a json string, without the quotes."""
+    size = len(s) if s.isascii() else len(s.encode("utf-8"))
+    # most strings have nothing to escape
+    if '"' in s or "\\" in s or not s.isprintable():
+        for c in _escaped.findall(s):
+            size += 1 if c in _short_escapes else 5
+    return size
@@ -0,0 +1,383 @@
+# sinks.py holds the places the pages of a run are written to: a directory of (compressed) files, a single archive or a fhir server
+
+import gzip
+import io
+import json
+import os
+import queue
+import sys
+import threading
+import time
+from datetime import datetime
+
+# the modules that only some sinks need (tarfile, zipfile, http.client and
+# the thread pool) are imported by the sinks, so that fhirbuild starts quickly.
+
+# zstandard is optional, it is needed for zstd compression and imported then
+def _import_zstandard():
+    """_import_zstandard returns the zstandard module, or raises a ValueError if it isn't installed."""
+    try:
+        import zstandard
+    except ImportError:
+        raise ValueError("zstd compression needs the zstandard package, pip install zstandard")
+    return zstandard
+
+# the compressions and the file name suffix they add
+compressions = {
+    "gzip": ".gz",
+    "zstd": ".zst"
+}
+
+# the archive formats
+archives = ["tar", "zip"]
+
+def open_compressed(path:str, compress:str=None):
+    """open_compressed opens path for writing bytes, compressing them with gzip or zstd on the way if compress is given. the returned file needs to be closed."""
+    match compress:
+        case None:
+            return open(path, "wb")
+        case "gzip":
+            # leave the time out of the gzip header, so the same input gives the same bytes
+            return gzip.GzipFile(path, mode="wb", mtime=0)
+        case "zstd":
+            zstandard = _import_zstandard()
+            return zstandard.ZstdCompressor().stream_writer(open(path, "wb"))
+        case _:
+            raise ValueError(f"unknown compression {compress}, choose from {', '.join(compressions)}")
+
+def read_compressed(path:str, compress:str=None) -> bytes:
+    """read_compressed reads the bytes of a file written by open_compressed, decompressing them if compress is given."""
+    match compress:
+        case None:
+            with open(path, "rb") as f:
+                return f.read()
+        case "gzip":
+            with gzip.open(path, "rb") as f:
+                return f.read()
+        case "zstd":
+            zstandard = _import_zstandard()
+            with open(path, "rb") as f:
+                return zstandard.ZstdDecompressor().stream_reader(f).read()
+        case _:
+            raise ValueError(f"unknown compression {compress}, choose from {', '.join(compressions)}")
+
+
+class DirSink:
+    """DirSink writes each page into its own file in a directory, compressed if compress is given. with fsync each file is flushed to disk before write returns."""
+
+    def __init__(self, dir:str, compress:str=None, fsync:bool=False):
+        # check the compression up front
+        if compress is not None and compress not in compressions:
+            raise ValueError(f"unknown compression {compress}, choose from {', '.join(compressions)}")
+        self.dir = dir
+        self.compress = compress
+        self.suffix = compressions.get(compress, "")
+        self.fsync = fsync
+
+    def write(self, name:str, data:bytes) -> str:
+        """write writes data to the file name (plus the suffix of the compression) and returns its path."""
+        path = os.path.join(self.dir, name + self.suffix)
+        f = open_compressed(path, self.compress)
+        try:
+            f.write(data)
+        finally:
+            f.close()
+        if self.fsync:
+            # the compressed file is closed by now, sync it by its path
+            fd = os.open(path, os.O_RDWR)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+        return path
+
+    def rename(self, old:str, new:str):
+        """rename renames a written file."""
+        os.replace(os.path.join(self.dir, old + self.suffix), os.path.join(self.dir, new + self.suffix))
+
+    def close(self):
+        """close does nothing, each file is closed after it is written."""
+        pass
+
+
+class TarSink:
+    """TarSink writes the pages as members of one tar archive, streamed and compressed as a whole if compress is given."""
+
+    def __init__(self, path:str, compress:str=None):
+        self.path = path + ".tar" + compressions.get(compress, "")
+        import tarfile
+        self.file = open_compressed(self.path, compress)
+        self.tar = tarfile.open(fileobj=self.file, mode="w|")
+        self.mtime = int(time.time())
+
+    def write(self, name:str, data:bytes) -> str:
+        """write adds data as member name and returns the archive path."""
+        import tarfile
+        info = tarfile.TarInfo(name)
+        info.size = len(data)
+        info.mtime = self.mtime
+        self.tar.addfile(info, io.BytesIO(data))
+        return self.path
+
+    def close(self):
+        """close finishes the archive."""
+        self.tar.close()
+        self.file.close()
+
+
+class ZipSink:
+    """ZipSink writes the pages as members of one zip archive. zip compresses each member by itself, with deflate for gzip."""
+
+    def __init__(self, path:str, compress:str=None):
+        import zipfile
+        match compress:
+            case None:
+                method = zipfile.ZIP_STORED
+            case "gzip":
+                method = zipfile.ZIP_DEFLATED
+            case _:
+                raise ValueError(f"zip archives can't be compressed with {compress}, use gzip or a tar archive")
+        self.path = path + ".zip"
+        self.zip = zipfile.ZipFile(self.path, "w", compression=method)
+        self.date_time = time.localtime()[:6]
+
+    def write(self, name:str, data:bytes) -> str:
+        """write adds data as member name and returns the archive path."""
+        import zipfile
+        self.zip.writestr(zipfile.ZipInfo(name, date_time=self.date_time), data, compress_type=self.zip.compression)
+        return self.path
+
+    def close(self):
+        """close finishes the archive."""
+        self.zip.close()
+
+
+def open_archive(path:str, archive:str, compress:str=None):
+    """open_archive returns a TarSink or ZipSink writing to path plus the archive's suffix."""
+    match archive:
+        case "tar":
+            return TarSink(path, compress)
+        case "zip":
+            return ZipSink(path, compress)
+        case _:
+            raise ValueError(f"unknown archive {archive}, choose from {', '.join(archives)}")
+
+
+class TeeSink:
+    """TeeSink writes each page to each of its sinks, e.g. into files and to a fhir server."""
+
+    def __init__(self, sinks:list):
+        self.sinks = sinks
+
+    def write(self, name:str, data:bytes) -> str:
+        """write writes data to each sink and returns what the first sink returns."""
+        results = [sink.write(name, data) for sink in self.sinks]
+        return results[0]
+
+    def rename(self, old:str, new:str):
+        """rename renames the page in the sinks that can rename."""
+        for sink in self.sinks:
+            if hasattr(sink, "rename"):
+                sink.rename(old, new)
+
+    @property
+    def failures(self) -> list:
+        """failures are the failures of the sinks that send in the background."""
+        return [failure for sink in self.sinks for failure in getattr(sink, "failures", [])]
+
+    def close(self):
+        """close closes each sink."""
+        for sink in self.sinks:
+            sink.close()
+
+
+# the statuses after which a page is sent again
+retry_statuses = [429, 500, 502, 503, 504]
+
+class HttpSink:
+    """HttpSink sends each page as a transaction bundle to the fhir server at url by POST, instead of writing it to a file. up to in_flight pages are sent at the same time, each thread keeps its connection alive for the next page."""
+
+    def __init__(self, url:str, log:str=None, in_flight:int=4, retries:int=3, backoff:float=1.0, timeout:float=60.0, headers:dict=None, compress:str=None):
+        import http.client
+        import urllib.parse
+        from concurrent.futures import ThreadPoolExecutor
+        parts = urllib.parse.urlsplit(url)
+        if parts.scheme not in ["http", "https"] or parts.netloc == "":
+            raise ValueError(f"can't upload to {url}, give the base url of a fhir server, like http://localhost:8080/fhir")
+        if compress not in [None, "gzip"]:
+            raise ValueError(f"pages can't be uploaded compressed with {compress}, only with gzip")
+        if in_flight < 1:
+            raise ValueError("in_flight needs to be at least 1")
+        self.url = url
+        self.connection_class = http.client.HTTPSConnection if parts.scheme == "https" else http.client.HTTPConnection
+        self.host = parts.netloc
+        self.path = (parts.path or "/") + (f"?{parts.query}" if parts.query else "")
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        # headers are sent with each request, e.g. for authorization
+        self.headers = {"Content-Type": "application/fhir+json", "Accept": "application/fhir+json", **(headers or {})}
+        self.gzip = compress == "gzip"
+        if self.gzip:
+            self.headers["Content-Encoding"] = "gzip"
+        # the pages that fail for good, as (page number, name, exception) tuples like for WriteError, with no page number, since the sink only knows the names
+        self.failures = []
+        self.sent = 0
+        self.lock = threading.Lock()
+        # the result of each page (status, attempts, seconds) is appended to the ndjson file log
+        self.log = open(log, "a", encoding="utf-8") if log is not None else None
+        # each thread's connection, all of them to close them at the end
+        self.local = threading.local()
+        self.connections = []
+        # write returns as soon as the page is handed to a thread, at most in_flight more pages wait for one, which caps the memory
+        self.slots = threading.BoundedSemaphore(2 * in_flight)
+        self.pool = ThreadPoolExecutor(max_workers=in_flight, thread_name_prefix="fhirbuild-upload")
+
+    def write(self, name:str, data:bytes) -> str:
+        """write hands data to a thread that sends it as page name and returns the url. it blocks while in_flight pages wait."""
+        self.slots.acquire()
+        future = self.pool.submit(self._send, name, data)
+        future.add_done_callback(lambda f: self.slots.release())
+        return self.url
+
+    def rename(self, old:str, new:str):
+        """rename does nothing, the pages have no names on the server."""
+        pass
+
+    def _connection(self):
+        """_connection returns the connection of this thread, opening it if needed."""
+        connection = getattr(self.local, "connection", None)
+        if connection is None:
+            connection = self.connection_class(self.host, timeout=self.timeout)
+            self.local.connection = connection
+            with self.lock:
+                self.connections.append(connection)
+        return connection
+
+    def _drop_connection(self):
+        """_drop_connection closes the connection of this thread, the next page opens a new one."""
+        connection = getattr(self.local, "connection", None)
+        if connection is not None:
+            connection.close()
+            self.local.connection = None
+
+    def _send(self, name:str, data:bytes):
+        """_send sends a page, retrying if it fails, and records the result. any exception of a page is recorded as its failure, so it is raised with the others by writeout."""
+        import http.client
+        body = gzip.compress(data, mtime=0) if self.gzip else data
+        started = time.perf_counter()
+        attempts = 0
+        status = None
+        failure = None
+        while True:
+            attempts += 1
+            wait = None
+            try:
+                connection = self._connection()
+                connection.request("POST", self.path, body=body, headers=self.headers)
+                response = connection.getresponse()
+                content = response.read()
+                status = response.status
+                if 200 <= status < 300:
+                    error = None
+                    break
+                error = f"{status} {response.reason}: {content[:500].decode('utf-8', errors='replace')}"
+                if status not in retry_statuses:
+                    break
+                wait = _retry_after(response.getheader("Retry-After"))
+                if response.will_close:
+                    self._drop_connection()
+            except (OSError, http.client.HTTPException) as e:
+                # the connection is broken, open a new one
+                self._drop_connection()
+                (status, error) = (None, f"{type(e).__name__}: {e}")
+            except Exception as e:
+                # e.g. a url or header that http.client doesn't take, sending it again won't help
+                self._drop_connection()
+                (status, error, failure) = (None, f"{type(e).__name__}: {e}", e)
+                break
+            # a connection error or a status in retry_statuses is sent again up to retries times, after backoff seconds, doubled each time, or as long as the server asks for with Retry-After
+            if attempts > self.retries:
+                break
+            time.sleep(wait if wait is not None else self.backoff * 2 ** (attempts - 1))
+
+        self._record({"page": name, "url": self.url, "status": status, "ok": error is None, "attempts": attempts, "seconds": round(time.perf_counter() - started, 3), "bytes": len(body), "error": error, "time": datetime.now().isoformat(timespec="seconds")})
+        with self.lock:
+            if error is None:
+                self.sent += 1
+            else:
+                print(f"error: uploading page {name} failed: {error}", file=sys.stderr)
+                self.failures.append((None, name, failure or OSError(error)))
+
+    def _record(self, record:dict):
+        """_record appends the result of a page to the log."""
+        if self.log is None:
+            return
+        with self.lock:
+            self.log.write(json.dumps(record) + "\n")
+            self.log.flush()
+
+    def close(self):
+        """close waits for the pages to be sent and closes the connections and the log."""
+        self.pool.shutdown(wait=True)
+        for connection in self.connections:
+            connection.close()
+        if self.log is not None:
+            self.log.close()
+        print(f"uploaded {self.sent} of {self.sent + len(self.failures)} pages to {self.url}")
+
+def _retry_after(value:str) -> float:
+    """_retry_after returns the seconds of a Retry-After header, or None if it doesn't give seconds."""
+    try:
+        return max(float(value), 0.0)
+    except (TypeError, ValueError):
+        return None
+
+
+class WriteError(Exception):
+    """WriteError is raised when pages couldn't be written. failures holds a (page number, file name, exception) tuple for each failed page, the page number is None for pages sent by an HttpSink."""
+
+    def __init__(self, failures:list):
+        self.failures = failures
+        pages = ", ".join(f"{name}: {e}" if page is None else f"{page} ({name}): {e}" for (page, name, e) in failures[:10])
+        if len(failures) > 10:
+            pages += f" and {len(failures) - 10} more"
+        super().__init__(f"{len(failures)} pages couldn't be written: {pages}")
+
+
+class BackgroundWriter:
+    """BackgroundWriter serializes and writes pages to a sink in a background thread, so the next pages can be built meanwhile. at most maxsize pages wait in the queue, if it is full, write blocks until the thread catches up, which caps the memory. a page that fails is reported with its page number and file name, and the following pages are still written. a page that is written is handed to its written function, if given. close waits for the queue to be written and closes the sink."""
+
+    def __init__(self, sink, serialize, maxsize:int=8):
+        self.sink = sink
+        self.serialize = serialize
+        self.queue = queue.Queue(maxsize=maxsize)
+        self.failures = []
+        self.thread = threading.Thread(target=self._run, name="fhirbuild-writer", daemon=True)
+        self.thread.start()
+
+    def write(self, page:int, name:str, bundle, written=None):
+        """write queues the bundle of page to be written as name. written is called with the bytes of the page after they are written."""
+        self.queue.put((page, name, bundle, written))
+
+    def _run(self):
+        """_run writes the queued pages until it gets None."""
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            (page, name, bundle, written) = item
+            try:
+                data = self.serialize(bundle)
+                self.sink.write(name, data)
+                if written is not None:
+                    written(data)
+            except Exception as e:
+                print(f"error: writing page {page} ({name}) failed: {e}", file=sys.stderr)
+                self.failures.append((page, name, e))
+
+    def close(self):
+        """close writes the rest of the queue and closes the sink."""
+        self.queue.put(None)
+        self.thread.join()
+        self.sink.close()
@@ -0,0 +1,190 @@
+# stats.py measures where the time of a run goes
+
+# the stages of the pipeline are generators pulling from each other,
+# read -> check -> row_to -> fhirids -> build -> bundle, and the pages are then
+# serialized and written. timed wraps a stage's generator and adds up the
+# time spent getting each of its items, without the time of the timed
+# stages it pulls from, so each stage gets its own time. the timed stages
+# that run within each other are tracked per thread, the pages written in
+# the background are timed in their own thread. the wrappers are only put
+# in when stats are asked for, without them the pipeline runs as it is.
+
+import json
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+# resource isn't there on windows, there's no peak rss then
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# the stages in the order they come in the pipeline, for the summary
+stage_order = ["prescan", "read", "check", "row_to", "fhirids", "build", "changes", "bundle", "serialize", "write"]
+
+class Stats:
+    """Stats collects the time of each stage of a run, the items that passed each stage, the pages and bytes written and the peak memory."""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.ended = None
+        # the seconds of each stage by itself
+        self.seconds = {}
+        # the items that passed each stage
+        self.counts = {}
+        self.pages = 0
+        self.bytes_written = 0
+        # the stages running in each thread
+        self._local = threading.local()
+
+    def _add(self, stage:str):
+        """_add adds stage if it's new."""
+        if stage not in self.seconds:
+            self.seconds[stage] = 0.0
+            self.counts[stage] = 0
+
+    @contextmanager
+    def _timing(self, stage:str):
+        """_timing adds the time of a block to stage, minus the time of the timed stages run within."""
+        stack = getattr(self._local, "stack", None)
+        if stack is None:
+            stack = self._local.stack = []
+        # the time of the stages within is added up on top of the stack
+        stack.append(0.0)
+        t = time.perf_counter()
+        try:
+            yield
+        finally:
+            dt = time.perf_counter() - t
+            inner = stack.pop()
+            self.seconds[stage] += dt - inner
+            if len(stack) > 0:
+                stack[-1] += dt
+
+    def _call(self, stage:str, f, *args, **kwargs):
+        """_call calls f, adding the time of the call to stage."""
+        with self._timing(stage):
+            return f(*args, **kwargs)
+
+    def timed(self, stage:str, items):
+        """timed yields the items, adding the time spent getting each of them to stage and counting them."""
+        self._add(stage)
+        it = iter(items)
+        while True:
+            try:
+                item = self._call(stage, next, it)
+            except StopIteration:
+                return
+            self.counts[stage] += 1
+            yield item
+
+    def timed_call(self, stage:str, f):
+        """timed_call returns f, adding the time of each call to stage and counting the calls."""
+        self._add(stage)
+        def call(*args, **kwargs):
+            result = self._call(stage, f, *args, **kwargs)
+            self.counts[stage] += 1
+            return result
+        return call
+
+    def timed_write(self, write):
+        """timed_write returns the write(name, data) function of a sink, adding its time to the write stage and counting the pages and bytes written."""
+        timed = self.timed_call("write", write)
+        def call(name, data):
+            result = timed(name, data)
+            self.pages += 1
+            self.bytes_written += len(data)
+            return result
+        return call
+
+    @contextmanager
+    def stage(self, stage:str):
+        """stage adds the time of a block to stage."""
+        self._add(stage)
+        with self._timing(stage):
+            yield
+        self.counts[stage] += 1
+
+    def done(self):
+        """done ends the run."""
+        self.ended = time.perf_counter()
+
+    def summary(self) -> dict:
+        """summary returns the stats as a dict, for json."""
+        from fhirbuild.help import fhirid_cache_info
+        from fhirbuild.dates import date_cache_info
+        wall = (self.ended or time.perf_counter()) - self.started
+        # one entry per row, the rows aren't read by themselves when reading with pandas
+        entries = self.counts.get("build")
+        rows = self.counts.get("read", entries)
+        cache = fhirid_cache_info()
+        dates = date_cache_info()
+        return {
+            "wall_seconds": wall,
+            "rows": rows,
+            "entries": entries,
+            "pages": self.pages,
+            "bytes_written": self.bytes_written,
+            "rows_per_sec": rows / wall if rows is not None and wall > 0 else None,
+            "entries_per_sec": entries / wall if entries is not None and wall > 0 else None,
+            "peak_rss_bytes": peak_rss(),
+            "peak_rss_children_bytes": peak_rss(children=True),
+            "stages": {stage: {"seconds": self.seconds[stage], "items": self.counts[stage]} for stage in sorted(self.seconds, key=_stage_rank)},
+            "fhirid_cache": {"hits": cache.hits, "misses": cache.misses, "maxsize": cache.maxsize, "currsize": cache.currsize},
+            "date_caches": {name: {"hits": c.hits, "misses": c.misses, "maxsize": c.maxsize, "currsize": c.currsize} for (name, c) in dates.items()}
+        }
+
+    def report(self, file=None):
+        """report prints a summary of the stats, to stdout or file."""
+        s = self.summary()
+        out = file or sys.stdout
+        wall = s["wall_seconds"]
+        line = f"{wall:.2f} s"
+        if s["rows"] is not None:
+            line += f", {s['rows']} rows ({s['rows_per_sec']:.0f}/s)"
+        if s["entries"] is not None:
+            line += f", {s['entries']} entries ({s['entries_per_sec']:.0f}/s)"
+        line += f", {s['pages']} pages, {_size(s['bytes_written'])} written"
+        if s["peak_rss_bytes"] is not None:
+            line += f", peak rss {_size(s['peak_rss_bytes'])}"
+        print(f"stats: {line}", file=out)
+        for stage, st in s["stages"].items():
+            share = st["seconds"] / wall * 100 if wall > 0 else 0
+            print(f"  {stage:<10} {st['seconds']:9.3f} s {share:5.1f} %  {st['items']} items", file=out)
+        cache = s["fhirid_cache"]
+        print(f"  fhirid cache of this process: {cache['hits']} hits, {cache['misses']} misses, {cache['currsize']} of {cache['maxsize']} ids", file=out)
+        for (name, c) in s["date_caches"].items():
+            print(f"  {name} dates of this process: {c['hits']} hits, {c['misses']} misses, {c['currsize']} of {c['maxsize']} dates", file=out)
+
+    def write_json(self, path:str):
+        """write_json writes the summary to a json file at path."""
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(self.summary(), f, indent=4)
+            f.write("\n")
+
+def _stage_rank(stage:str) -> int:
+    """_stage_rank returns the place of stage in the pipeline, stages that aren't known come last."""
+    if stage in stage_order:
+        return stage_order.index(stage)
+    return len(stage_order)
+
+def peak_rss(children:bool=False):
+    """peak_rss returns the peak resident memory of this process, or of its finished child processes, in bytes, or None where it can't be told."""
+    if resource is None:
+        return None
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF)
+    # linux counts in kibibytes, macos in bytes
+    if sys.platform == "darwin":
+        return usage.ru_maxrss
+    return usage.ru_maxrss * 1024
+
+def _size(n:int) -> str:
+    """_size returns n bytes in a readable unit."""
+    if n < 1024:
+        return f"{n} B"
+    for unit in ["KiB", "MiB", "GiB"]:
+        n /= 1024
+        if n < 1024 or unit == "GiB":
+            return f"{n:.1f} {unit}"
@@ -0,0 +1,194 @@
+# templates.py holds precompiled builders for the fhir entries that are built once per csv row.
+
+# fhir_specimen and fhir_obs assemble each entry from fhir_extension and
+# fhir_coding calls and look up the sampleLocation extension again for the
+# x and y position. the builders here are compiled once per resource type
+# and cxx version: the urls, systems and the fixed parts of the entry are
+# bound up front, and per row only the variable slots are filled in by
+# straight-line code. the output is the same as from fhir_specimen and
+# fhir_obs, key order included, so the written json doesn't change. each
+# entry still gets dicts of its own, so entries can be changed afterwards.
+
+from fhirbuild.help import datestring, genfhirid
+
+_ext = "https://fhir.centraxx.de/extension/"
+
+# the compiled builders by resource type and cxx version
+_builders = {}
+
+def builder(restype:str, cxx:int=3):
+    """builder returns the compiled builder for restype (Specimen or Observation) and cxx version, compiling it on first use. the Specimen builder takes the arguments of fhir_specimen, the Observation builder those of fhir_obs."""
+    key = (restype, cxx)
+    if key not in _builders:
+        match restype:
+            case "Specimen":
+                _builders[key] = compile_specimen(cxx)
+            case "Observation":
+                _builders[key] = compile_obs(cxx)
+            case _:
+                raise ValueError(f"no template for {restype}")
+    return _builders[key]
+
+def compile_specimen(cxx:int=3):
+    """compile_specimen compiles a builder that returns the same entry as fhir_specimen. the entries don't differ between cxx versions at the moment, cxx is there to keep the builders apart when they do."""
+
+    # imported here, cause fhirbuild imports this module
+    from fhirbuild import fhir_identifier
+
+    system = "urn:centraxx"
+    update_url = _ext + "updateWithOverwrite"
+    orga_url = _ext + "sample/organizationUnit"
+    category_url = _ext + "sampleCategory"
+    sprec_url = _ext + "sprec"
+    use_sprec_url = _ext + "sprec/useSprec"
+    stock_url = _ext + "sprec/stockProcessing"
+    stock_date_url = _ext + "sprec/stockProcessingDate"
+    second_url = _ext + "sprec/secondProcessing"
+    second_date_url = _ext + "sprec/secondProcessingDate"
+    location_url = _ext + "sample/sampleLocation"
+    location_path_url = _ext + "sample/sampleLocationPath"
+    xpos_url = _ext + "sample/xPosition"
+    ypos_url = _ext + "sample/yPosition"
+    derival_url = _ext + "sample/derivalDate"
+    concentration_url = _ext + "sample/concentration"
+    reposition_url = _ext + "sample/repositionDate"
+    skip_codes = ("oid", "fhirid", "index")
+
+    def quantity(amount):
+        return {
+            "value": float(amount.value) if amount.value is not None else None,
+            "unit": str(amount.unit) if amount.unit is not None else None,
+            "system": system
+        }
+
+    def build(sample=None, update_with_overwrite:bool=False):
+        fhirid = sample.id('fhirid')
+        url = f"Specimen/{fhirid}"
+
+        extension = [
+            {"url": update_url, "valueBoolean": update_with_overwrite},
+            {"url": orga_url, "valueReference": {"identifier": {"value": str(sample.orga)}}},
+            {"url": category_url, "valueCoding": {"system": system, "code": str(sample.category)}}
+        ]
+
+        # the sprec extension
+        sprec = [{"url": use_sprec_url, "valueBoolean": True}]
+        if sample.stockprocessing is not None:
+            sprec.append({"url": stock_url, "valueCoding": {"system": system, "code": sample.stockprocessing}})
+        if sample.stockprocessingdate is not None:
+            sprec.append({"url": stock_date_url, "valueDateTime": datestring(sample.stockprocessingdate)})
+        if sample.secondprocessing is not None:
+            sprec.append({"url": second_url, "valueCoding": {"system": system, "code": sample.secondprocessing}})
+        if sample.secondprocessingdate is not None:
+            sprec.append({"url": second_date_url, "valueDateTime": datestring(sample.secondprocessingdate)})
+        extension.append({"url": sprec_url, "extension": sprec})
+
+        # the location, with x and y position right after the path
+        if sample.locationpath is not None:
+            location = [{"url": location_path_url, "valueString": str(sample.locationpath)}]
+            if sample.xposition != None:
+                location.append({"url": xpos_url, "valueInteger": int(sample.xposition)})
+            if sample.yposition != None:
+                location.append({"url": ypos_url, "valueInteger": int(sample.yposition)})
+            extension.append({"url": location_url, "extension": location})
+
+        if sample.derivaldate:
+            extension.append({"url": derival_url, "valueDateTime": datestring(sample.derivaldate)})
+
+        resource = {
+            "resourceType": "Specimen",
+            "id": f"{fhirid}",
+            "extension": extension,
+            "identifier": [fhir_identifier(id) for id in sample.ids if id.code not in skip_codes],
+            "status": "available",
+            "type": {"coding": []},
+            "subject": {"identifier": fhir_identifier(sample.patient.identifier())},
+            "collection": {},
+            "container": [{"identifier": [{"system": system, "value": str(sample.receptacle)}]}]
+        }
+
+        # reference the parent by fhirid if given, else by its sampleid
+        parent = sample.parent
+        if parent is not None:
+            pfhirid = parent.id('fhirid')
+            if pfhirid is not None:
+                resource["parent"] = [{"reference": f"Specimen/{pfhirid}"}]
+            else:
+                resource["parent"] = [{"identifier": fhir_identifier(parent.identifier())}]
+
+        if sample.concentration is not None:
+            extension.append({"url": concentration_url, "valueQuantity": str(sample.concentration)})
+        if sample.samplingdate is not None:
+            resource["collection"]["collectedDateTime"] = datestring(sample.samplingdate)
+        if sample.receiptdate is not None:
+            resource["receivedTime"] = datestring(sample.receiptdate)
+        if sample.repositiondate is not None:
+            extension.append({"url": reposition_url, "valueDateTime": f"{datestring(sample.repositiondate)}"})
+        if sample.initialamount is not None:
+            resource["collection"]["quantity"] = quantity(sample.initialamount)
+        if sample.restamount is not None:
+            resource["container"][0]["specimenQuantity"] = quantity(sample.restamount)
+        if sample.type is not None:
+            resource["type"]["coding"].append({"system": system, "code": str(sample.type)})
+
+        return {
+            "fullUrl": url,
+            "resource": resource,
+            "request": {"method": "POST", "url": url}
+        }
+
+    return build
+
+def compile_obs(cxx:int=3):
+    """compile_obs compiles a builder that returns the same entry as fhir_obs. the entries don't differ between cxx versions at the moment, cxx is there to keep the builders apart when they do."""
+
+    # imported here, cause fhirbuild imports this module
+    from fhirbuild import fhir_identifier
+    from fhirbuild.components import emit_component
+
+    system = "urn:centraxx"
+    update_url = _ext + "updateWithOverwrite"
+
+    def build(finding=None, fhirid:str=None, update_with_overwrite:bool=False, delete:bool=False):
+        if finding.sample is None:
+            raise ValueError("the finding has no sample id")
+
+        # if no fhirid given, generate
+        if fhirid is None:
+            fhirid = genfhirid(finding.sample.id())
+
+        url = f"Observation/{fhirid}"
+
+        # die messparameter landen in components
+        components = []
+        for code, rec in finding.recs.items():
+            # don't put in empty values
+            if rec is None:
+                continue
+            comp = {"code": {"coding": [{"system": system, "code": str(code)}]}}
+            if not emit_component(comp, rec):
+                continue
+            components.append(comp)
+
+        # add the sender
+        if finding.sender:
+            components.append({"code": {"coding": [{"system": system, "code": "EINS_CODE"}]}, "valueString": str(finding.sender)})
+
+        return {
+            "fullUrl": url,
+            "request": {"method": "DELETE" if delete == True else "POST", "url": url},
+            "resource": {
+                "resourceType": "Observation",
+                "id": str(fhirid),
+                "extension": [{"url": update_url, "valueBoolean": update_with_overwrite}],
+                "status": "unknown",
+                "code": {"coding": [{"system": system, "code": str(finding.methodname)}]},
+                "subject": {"identifier": fhir_identifier(finding.patient.identifier())},
+                "effectiveDateTime": datestring(finding.findingdate),
+                "method": {"coding": [{"system": system, "version": "1", "code": str(finding.method)}]},
+                "specimen": {"identifier": fhir_identifier(finding.sample.identifier())},
+                "component": components
+            }
+        }
+
+    return build
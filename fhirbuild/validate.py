@@ -0,0 +1,330 @@
+# validate.py checks the csv rows before they are converted and takes the rows that don't pass
+
+# each row is checked against the compiled header (see schema.py) in one
+# go, and all its problems are collected as RowErrors, instead of the
+# conversion stopping at the first one, deep down, or printing it and
+# going on. the checks are compiled once per header, a clean row costs a
+# few lookups. what the checks make of a row isn't made again by the
+# conversion: a row that passes comes as a CheckedRow with its resolved
+# ids and its component Recs, and the dates it parses are remembered
+# (see dates.py). a row that doesn't pass becomes a RejectedRow, which
+# takes the place of the row's record and entry on the way through the
+# converters, so the rows keep their numbers, and Rejects takes it out of
+# the entries at the end, writing it to the rejects csv.
+
+# the kinds of RowErrors:
+#   columns    the row has more values than the header has columns
+#   id         no sample or patient id, or the main id can't be told
+#   patient    no patient id, or more than one
+#   category   a category other than MASTER, DERIVED or ALIQUOTGROUP
+#   parent     a derived sample or aliquotgroup without its parent
+#   method     an observation without method
+#   date       a date that isn't iso 8601
+#   number     an amount that isn't a number
+#   position   an x, y or yx position that can't be read
+#   component  a component value that doesn't parse as its type
+
+# that the parent an aliquot references is there is told only when the
+# fhirids are filled in, it is reported then, see report_fhirid_problems.
+
+import csv
+import os
+from fhirbuild.help import is_nullish, intornone
+from fhirbuild.dates import fromisoornone
+from fhirbuild.schema import Schema, schema_for
+
+# the categories a sample can have
+categories = ["MASTER", "DERIVED", "ALIQUOTGROUP"]
+
+# the most values per column that are remembered as passed
+passed_size = 4096
+
+class RowError(ValueError):
+    """RowError is a problem with a csv row. kind is the kind of problem, see the top of validate.py, column the column it is in if it is in one. row is the number of the row, counted from 1 after the header, once it is known."""
+
+    def __init__(self, kind:str, message:str, column:str=None, row:int=None):
+        super().__init__(message)
+        self.kind = kind
+        self.message = message
+        self.column = column
+        self.row = row
+
+    def __reduce__(self):
+        # the worker processes hand the errors back pickled
+        return (RowError, (self.kind, self.message, self.column, self.row))
+
+    def __str__(self) -> str:
+        if self.row is None:
+            return self.message
+        return f"row {self.row}: {self.message}"
+
+class RejectedRow:
+    """RejectedRow is a csv row that didn't pass the checks, with its RowErrors and its values. it takes the place of the row's record or entry, see Rejects.take."""
+
+    __slots__ = ("errors", "values", "row")
+
+    def __init__(self, errors:list, values:dict, row:int=None):
+        self.errors = errors
+        self.values = values
+        self.row = row
+
+    def number(self, row:int):
+        """number sets the row number of the rejected row and its errors."""
+        self.row = row
+        for error in self.errors:
+            error.row = row
+
+class CheckedRow(dict):
+    """CheckedRow is a csv row that passed the checks, with what the checks made of it, so the conversion takes it instead of making it again. ids are the (identifiers, mainidc) of its sidc_ or pidc_ ids from csvtofhir.extract_and_resolve_identifiers, recs the Recs of its components by code, None if the checks didn't make them."""
+
+    __slots__ = ("ids", "recs")
+
+    def __init__(self, row:dict):
+        super().__init__(row)
+        self.ids = None
+        self.recs = None
+
+def compile_checks(type:str, schema:Schema, mainidc:str=None, delim_cmp:str=","):
+    """compile_checks compiles the checks of the rows of a csv of type with the header schema. it returns a function that returns the list of RowErrors of a row, or None if the row passes. a CheckedRow that passes gets the ids and Recs made on the way."""
+    # imported here, csvtofhir imports this module
+    from fhirbuild.csvtofhir import extract_and_resolve_identifiers, a01toxy
+
+    names = set(schema.fieldnames)
+
+    def has(column:str) -> bool:
+        return column in names
+
+    # the dates and amounts to check, only those in the header
+    date_columns = [c for c in ["received_date", "collection_date", "derival_date", "reposition_date"] if has(c)] if type == "specimen" else [c for c in ["effective_date_time"] if has(c)]
+    amount_columns = [c for c in ["initial_amount", "rest_amount"] if has(c)]
+    position_columns = [c for c in ["xpos", "ypos"] if has(c)]
+
+    # the amounts, positions and component values repeat from row to row, the values that passed aren't checked again. the Recs of the component values are kept with them.
+    passed = {column: set() for column in amount_columns + position_columns}
+    passed_recs = {code: {} for code in schema.components}
+
+    def remember(column:str, value):
+        if len(passed[column]) < passed_size:
+            passed[column].add(value)
+
+    def check_columns(row:dict, errors:list):
+        if None in row:
+            errors.append(RowError("columns", f"{len(row[None])} more values than the header has columns"))
+
+    def check_ids(row:dict, prefix:str, errors:list) -> tuple:
+        try:
+            return extract_and_resolve_identifiers(row, prefix=prefix, mainidc=mainidc, schema=schema)
+        except ValueError as e:
+            errors.append(RowError("id", str(e)))
+
+    patient_columns = [column for (code, column) in schema.ids.get("pidc_", [])]
+
+    def check_patient(row:dict, errors:list):
+        # there is only one patient id allowed, and it can't be empty. with one pidc_ column a clean row needs one lookup.
+        if len(patient_columns) == 1 and row[patient_columns[0]]:
+            return
+        patids = schema.identifiers(row, "pidc_")
+        if len(patids) == 0:
+            errors.append(RowError("patient", "no patient id"))
+        elif len(patids) > 1:
+            errors.append(RowError("patient", f"more than one patient id: {', '.join(patids)}"))
+        else:
+            (code, id) = next(iter(patids.items()))
+            if id == "":
+                errors.append(RowError("patient", f"the patient id pidc_{code} is empty", column=f"pidc_{code}"))
+
+    def check_dates(row:dict, errors:list):
+        for column in date_columns:
+            try:
+                fromisoornone(row[column])
+            except ValueError:
+                errors.append(RowError("date", f"{column} {row[column]!r} isn't an iso 8601 date", column=column))
+
+    def check_specimen(row:dict) -> list:
+        errors = []
+        check_columns(row, errors)
+        get = row.get
+        category = get("category")
+        if category not in categories:
+            errors.append(RowError("category", f"category {category!r} isn't one of {', '.join(categories)}", column="category"))
+        # aliquotgroups don't come with sampleids
+        ids = None
+        if not (category == "ALIQUOTGROUP" and all(is_nullish(v) for v in schema.identifiers(row, "sidc_").values())):
+            ids = check_ids(row, "sidc_", errors)
+        check_patient(row, errors)
+        check_dates(row, errors)
+        for column in amount_columns:
+            value = row[column]
+            if value and value not in passed[column]:
+                try:
+                    float(value)
+                    remember(column, value)
+                except ValueError:
+                    errors.append(RowError("number", f"{column} {value!r} isn't a number", column=column))
+        for column in position_columns:
+            value = row[column]
+            if value not in passed[column]:
+                try:
+                    intornone(value)
+                    remember(column, value)
+                except ValueError:
+                    errors.append(RowError("position", f"{column} {value!r} isn't a number or a letter", column=column))
+        if not is_nullish(get("yxpos")):
+            try:
+                a01toxy(get("yxpos"))
+            except (KeyError, ValueError):
+                errors.append(RowError("position", f"yxpos {get('yxpos')!r} isn't a position like A01", column="yxpos"))
+        # the parent references of derived samples and aliquotgroups
+        if category == "DERIVED" or category == "ALIQUOTGROUP":
+            (pfhirid, pindex, psampleid, pidc) = (not is_nullish(get("parent_fhirid")), not is_nullish(get("parent_index")), not is_nullish(get("parent_sampleid")), not is_nullish(get("parent_idc")))
+        if category == "DERIVED":
+            if not (pfhirid or pindex or psampleid):
+                errors.append(RowError("parent", "a derived sample needs a parent_fhirid, parent_index or parent_sampleid"))
+            elif not (pfhirid or pindex or pidc):
+                errors.append(RowError("parent", "a parent_sampleid needs a parent_idc", column="parent_idc"))
+        elif category == "ALIQUOTGROUP":
+            if not (pfhirid or (psampleid and pidc)):
+                errors.append(RowError("parent", "an aliquotgroup needs a parent_sampleid with parent_idc, or a parent_fhirid"))
+            # the fhirid of an aliquotgroup is made from the parent sampleid and the material
+            elif is_nullish(get("fhirid")) and (not psampleid or get("type") is None):
+                errors.append(RowError("parent", "an aliquotgroup without fhirid needs a parent_sampleid and a type"))
+        if errors:
+            return errors
+        if isinstance(row, CheckedRow):
+            row.ids = ids
+        return None
+
+    def check_observation(row:dict) -> list:
+        errors = []
+        check_columns(row, errors)
+        # the observations reference their sample by SAMPLEID
+        sampleid = row.get("sidc_SAMPLEID")
+        if sampleid is None or sampleid == "":
+            errors.append(RowError("id", "no sample id sidc_SAMPLEID", column="sidc_SAMPLEID"))
+        # the fhirid of an observation is made from the sample id and the method
+        if is_nullish(row.get("method")):
+            errors.append(RowError("method", "no method", column="method"))
+        check_patient(row, errors)
+        check_dates(row, errors)
+        recs = {}
+        for code, (tcol, vcol) in schema.components.items():
+            value = (row[tcol], row[vcol])
+            known = passed_recs[code]
+            if value in known:
+                recs[code] = known[value]
+                continue
+            try:
+                rec = parse_component(value[0], value[1], delim_cmp)
+            except (ValueError, TypeError, AttributeError, KeyError) as e:
+                errors.append(RowError("component", f"{vcol} {row[vcol]!r} isn't a {row[tcol]}: {e}", column=vcol))
+                continue
+            recs[code] = rec
+            if len(known) < passed_size:
+                known[value] = rec
+        if errors:
+            return errors
+        if isinstance(row, CheckedRow):
+            row.recs = recs
+        return None
+
+    def check_patient_row(row:dict) -> list:
+        errors = []
+        check_columns(row, errors)
+        ids = check_ids(row, "pidc_", errors)
+        if errors:
+            return errors
+        if isinstance(row, CheckedRow):
+            row.ids = ids
+        return None
+
+    match type:
+        case "specimen":
+            return check_specimen
+        case "observation":
+            # imported here, components imports tram
+            from fhirbuild.components import parse_component
+            return check_observation
+        case "patient":
+            return check_patient_row
+        case _:
+            raise ValueError(f"unknown type: {type}")
+
+def checked_rows(rows, type:str, schema:Schema=None, mainidc:str=None, delim_cmp:str=","):
+    """checked_rows checks the csv rows of type and yields each row that passes as a CheckedRow, and a RejectedRow in the place of each row that doesn't. schema is the compiled header, looked up by the first row's keys if not given."""
+    check = None
+    for row in rows:
+        if check is None:
+            check = compile_checks(type, schema or schema_for(type, tuple(k for k in row.keys() if k is not None)), mainidc=mainidc, delim_cmp=delim_cmp)
+        checked = CheckedRow(row)
+        errors = check(checked)
+        yield checked if errors is None else RejectedRow(errors, row)
+
+class Rejects:
+    """Rejects takes the rejected rows of a run, counts their errors by kind and writes them to the csv at path, if given."""
+
+    def __init__(self, path:str=None, fieldnames:list=None, delimiter:str=";", encoding:str="utf-8", fail_fast:bool=False, on_reject=None, keep:int=0):
+        self.path = path
+        self.fieldnames = list(fieldnames or [])
+        self.delimiter = delimiter
+        self.encoding = encoding
+        # with fail_fast the first rejected row raises its first RowError
+        self.fail_fast = fail_fast
+        # called for each rejected row, e.g. manifest.Checkpoint.skip to count it as done
+        self.on_reject = on_reject
+        self.rows = 0
+        self.kinds = {}
+        self.file = None
+        self.writer = None
+        # a resumed run keeps the rejected rows among the keep rows done before, the rejects csv of an earlier run is removed else
+        if path is not None and os.path.exists(path):
+            with open(path, "r", encoding=encoding, newline="") as f:
+                kept = [values for values in list(csv.reader(f, delimiter=delimiter))[1:] if values and values[0].isdigit() and int(values[0]) <= keep]
+            os.remove(path)
+            for values in kept:
+                self._writer().writerow(values)
+
+    def take(self, entries, start:int=0):
+        """take passes the entries through and takes the rejected rows among them. the entries need to be one per csv row, start being the number of rows before the first, for the rejected rows to get their row numbers."""
+        for (i, entry) in enumerate(entries, start + 1):
+            if isinstance(entry, RejectedRow):
+                entry.number(i)
+                self.add(entry)
+            else:
+                yield entry
+
+    def add(self, rejected:RejectedRow):
+        """add takes a rejected row."""
+        if self.fail_fast:
+            raise rejected.errors[0]
+        self.rows += 1
+        for error in rejected.errors:
+            self.kinds[error.kind] = self.kinds.get(error.kind, 0) + 1
+        # the row number and the errors come in front of the row's values. the csv can be corrected and converted again, the row and errors columns are ignored then as unknown columns.
+        if self.path is not None:
+            values = rejected.values
+            self._writer().writerow([rejected.row, "; ".join(f"{e.kind}: {e.message}" for e in rejected.errors)] + [values.get(name) for name in self.fieldnames] + (values.get(None) or []))
+        if self.on_reject is not None:
+            self.on_reject()
+
+    def _writer(self):
+        """_writer returns the csv writer of the rejects csv, opening it with its header on first use, so it is only written if rows are rejected."""
+        if self.writer is None:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            self.file = open(self.path, "w", encoding=self.encoding, newline="")
+            self.writer = csv.writer(self.file, delimiter=self.delimiter)
+            self.writer.writerow(["row", "errors"] + self.fieldnames)
+        return self.writer
+
+    def report(self):
+        """report prints how many rows were rejected for which errors, if any."""
+        if self.rows == 0:
+            return
+        kinds = ", ".join(f"{n} {kind}" for (kind, n) in sorted(self.kinds.items(), key=lambda item: -item[1]))
+        where = f", see {self.path}" if self.path is not None else ""
+        print(f"warning: {self.rows} rows were rejected ({kinds}){where}")
+
+    def close(self):
+        """close closes the rejects csv."""
+        if self.file is not None:
+            self.file.close()
+            self.file = None
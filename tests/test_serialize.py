@@ -0,0 +1,45 @@
+# test_serialize.py checks that the size estimate of serialize.py is exact, so that --max-bytes is a hard cap
+
+# the values have characters that json escapes: quotes, backslashes, tabs,
+# newlines and other control characters, and characters that take more
+# than one byte in utf-8.
+
+import csv
+import io
+
+import pytest
+
+from fhirbuild import iter_bundles, sample_entries
+from fhirbuild.csvtofhir import iter_samples
+from fhirbuild.serialize import estimate_size, get_serializer, serializer_indent
+
+values = ['a "q" b', "back\\slash", "tab\tand\nnewline\r", "\x01\x1f\x7f", "grün \"€\"", ""]
+
+@pytest.mark.parametrize("serializer", ["pretty", "compact", "fast"])
+def test_estimate_size(serializer):
+    serialize = get_serializer(serializer)
+    indent = serializer_indent(serializer)
+    for value in values + [{key: [key, 1.5, None, True, {}]} for key in values] + [values]:
+        assert estimate_size(value, indent) == len(serialize(value))
+
+def _entries(rows:int) -> list:
+    """_entries returns the entries of a specimen csv of rows rows with location paths that need escaping."""
+    text = io.StringIO()
+    writer = csv.writer(text, delimiter=";")
+    writer.writerow(["category", "sidc_SAMPLEID", "pidc_LIMSPSN", "location_path", "organization_unit", "type"])
+    for i in range(rows):
+        writer.writerow(["MASTER", str(1000 + i), "lims_1", f'NUM --> "Freezer {i}" ' + '"\t\\' * (i % 97) + values[i % len(values)], "NUM_W", "CIT"])
+    text.seek(0)
+    return list(sample_entries(iter_samples(csv.DictReader(text, delimiter=";"))))
+
+@pytest.mark.parametrize("serializer", ["pretty", "compact"])
+@pytest.mark.parametrize("cxx", [3, 4])
+def test_max_bytes(serializer, cxx):
+    # the bundles with more than one entry aren't bigger than max_bytes serialized
+    serialize = get_serializer(serializer)
+    max_bytes = 20000
+    bundles = list(iter_bundles(_entries(300), None, restype="Specimen", cxx=cxx, max_bytes=max_bytes, serializer=serializer))
+    assert len(bundles) > 1
+    for bundle in bundles:
+        if len(bundle["entry"]) > 1:
+            assert len(serialize(bundle)) <= max_bytes
@@ -0,0 +1,128 @@
+# test_sinks.py checks that sinks.HttpSink uploads the pages to a stub fhir server
+
+# the stub server answers each POST with the next status of its script,
+# 200 when the script is used up, and keeps the requests it got.
+
+import gzip
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from fhirbuild import writeout
+from fhirbuild.sinks import HttpSink, WriteError
+
+class StubServer(ThreadingHTTPServer):
+    """StubServer is a fhir server that answers with the statuses of script, a list of (status, headers) tuples, one per request."""
+
+    def __init__(self, script:list=None):
+        super().__init__(("127.0.0.1", 0), StubHandler)
+        self.script = list(script or [])
+        self.requests = []
+        self.lock = threading.Lock()
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.server_address[1]}/fhir"
+
+class StubHandler(BaseHTTPRequestHandler):
+    """StubHandler keeps each POST in the server's requests and answers it by the server's script."""
+
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers["Content-Length"]))
+        with self.server.lock:
+            self.server.requests.append({"path": self.path, "headers": dict(self.headers), "body": body})
+            (status, headers) = self.server.script.pop(0) if self.server.script else (200, {})
+        content = json.dumps({"resourceType": "Bundle", "type": "transaction-response"}).encode()
+        self.send_response(status)
+        for (key, value) in headers.items():
+            self.send_header(key, value)
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format, *args):
+        pass
+
+@pytest.fixture
+def server():
+    servers = []
+    def start(script:list=None) -> StubServer:
+        s = StubServer(script)
+        threading.Thread(target=s.serve_forever, kwargs={"poll_interval": 0.05}, daemon=True).start()
+        servers.append(s)
+        return s
+    yield start
+    for s in servers:
+        s.shutdown()
+        s.server_close()
+
+def _records(path) -> list:
+    """_records returns the records of an upload log."""
+    with open(path, encoding="utf-8") as f:
+        return [json.loads(line) for line in f]
+
+def test_upload(server, tmp_path):
+    s = server()
+    log = tmp_path / "upload.ndjson"
+    sink = HttpSink(s.url, log=str(log), in_flight=2, headers={"Authorization": "Bearer t"})
+    pages = {f"page_{i}.json": json.dumps({"resourceType": "Bundle", "id": str(i)}).encode() for i in range(5)}
+    for (name, data) in pages.items():
+        sink.write(name, data)
+    sink.close()
+
+    assert sink.sent == 5 and sink.failures == []
+    assert sorted(r["body"] for r in s.requests) == sorted(pages.values())
+    for r in s.requests:
+        assert r["path"] == "/fhir"
+        assert r["headers"]["Content-Type"] == "application/fhir+json"
+        assert r["headers"]["Authorization"] == "Bearer t"
+    records = _records(log)
+    assert sorted(r["page"] for r in records) == sorted(pages)
+    assert all(r["ok"] and r["status"] == 200 and r["attempts"] == 1 for r in records)
+
+def test_gzip(server):
+    s = server()
+    sink = HttpSink(s.url, compress="gzip")
+    sink.write("page_0.json", b'{"resourceType": "Bundle"}')
+    sink.close()
+    assert s.requests[0]["headers"]["Content-Encoding"] == "gzip"
+    assert gzip.decompress(s.requests[0]["body"]) == b'{"resourceType": "Bundle"}'
+
+def test_retry(server, tmp_path):
+    s = server([(503, {"Retry-After": "0"}), (429, {})])
+    log = tmp_path / "upload.ndjson"
+    sink = HttpSink(s.url, log=str(log), in_flight=1, backoff=0)
+    sink.write("page_0.json", b"{}")
+    sink.close()
+    assert sink.sent == 1 and sink.failures == []
+    assert len(s.requests) == 3
+    assert [(r["status"], r["attempts"]) for r in _records(log)] == [(200, 3)]
+
+def test_fail(server, tmp_path):
+    # a client error isn't sent again, too many server errors fail the page
+    s = server([(400, {}), (500, {}), (500, {})])
+    log = tmp_path / "upload.ndjson"
+    sink = HttpSink(s.url, log=str(log), in_flight=1, retries=1, backoff=0)
+    sink.write("page_0.json", b"{}")
+    sink.write("page_1.json", b"{}")
+    sink.close()
+    assert sink.sent == 0
+    assert [name for (page, name, e) in sink.failures] == ["page_0.json", "page_1.json"]
+    assert [(r["status"], r["attempts"], r["ok"]) for r in _records(log)] == [(400, 1, False), (500, 2, False)]
+
+def test_fail_other_exception(server, tmp_path):
+    # a header that http.client doesn't take fails the page, it is recorded and raised by writeout
+    s = server()
+    log = tmp_path / "upload.ndjson"
+    sink = HttpSink(s.url, log=str(log), headers={"Authorization": "Bearer\nt"}, backoff=0)
+    with pytest.raises(WriteError) as raised:
+        writeout([{"resourceType": "Bundle"}], str(tmp_path), "Specimen", serializer="compact", sink=sink)
+    assert s.requests == []
+    [(page, name, e)] = raised.value.failures
+    assert isinstance(e, ValueError)
+    [record] = _records(log)
+    assert not record["ok"] and record["attempts"] == 1 and record["error"].startswith("ValueError")
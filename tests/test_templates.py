@@ -0,0 +1,109 @@
+# test_templates.py checks that the compiled builders of templates.py build the same entries as fhir_specimen and fhir_obs
+
+# the rows have the column sets of readme.md. each is built with
+# fhir_specimen or fhir_obs and with the compiled builder for cxx 3 and 4,
+# with update_with_overwrite off and on, and compared to the entries in
+# golden/, key order included. after an intended change of the entries,
+# write the golden files anew from fhir_specimen and fhir_obs with
+#
+#   python tests/test_templates.py --update
+
+import csv
+import io
+import json
+import os
+import sys
+
+import pytest
+
+from fhirbuild import fhir_specimen, fhir_obs, _fill_in_fhirids
+from fhirbuild.help import genfhirid
+from fhirbuild.csvtofhir import iter_samples, iter_findings
+from fhirbuild.templates import builder
+
+golden_dir = os.path.join(os.path.dirname(__file__), "golden")
+
+# the specimen columns of readme.md, for primary, derived and aliquotgroup samples. the positions come as xpos and ypos in the first csv and as yxpos in the second.
+specimen_csvs = ["""category;sidc_SAMPLEID;sidc_EXTSAMPLEID;mainidc;pidc_LIMSPSN;fhirid;collection_date;derival_date;received_date;reposition_date;initial_amount;initial_unit;rest_amount;rest_unit;location_path;organization_unit;receptacle;type;xpos;ypos;concentration;concentration_unit
+MASTER;1000;EXT1000;SAMPLEID;lims_1;;2020-12-22T10:09:00;;2020-12-22T11:11:51;2020-12-22T10:09:00;1;PC;0.5;PC;NUM --> Freezer;NUM_W;ORG;CIT;1;2;;
+MASTER;1001;;SAMPLEID;lims_1;f-1001;2020-12-22T10:09:00+02:00;;NULL;;2.5;ML;;;NUM --> Rack;NUM_W;ORG;EDTA;3;B;3.2;mg/l
+""", """category;sidc_SAMPLEID;sidc_EXTSAMPLEID;mainidc;pidc_LIMSPSN;fhirid;index;parent_fhirid;parent_index;parent_sampleid;parent_idc;collection_date;derival_date;received_date;reposition_date;initial_amount;initial_unit;rest_amount;rest_unit;location_path;organization_unit;receptacle;type;yxpos;concentration;concentration_unit
+ALIQUOTGROUP;;;;lims_1;;7;;;1000;SAMPLEID;;;2020-12-22T11:11:51;;;;;;;NUM_W;;CIT;;;
+DERIVED;1002;EXT1002;SAMPLEID;lims_1;;;;7;;;2020-12-22T10:09:00;2020-12-23T08:00:00;2020-12-22T11:11:51;2020-12-23T09:00:00;0.5;ML;0.25;ML;NUM --> Freezer --> Box;NUM_W;ORG;CIT;B07;1.1;mg/l
+DERIVED;1003;;;lims_1;;;f-ag;;;;;2020-12-23T08:00:00;;;;;;;;NUM_W;;CIT;A01;;
+"""]
+
+# the observation columns of readme.md, with a component of each type
+observation_csv = """sidc_SAMPLEID;pidc_LIMSPSN;effective_date_time;methodname;method;sender;cmp_t_A;cmp_v_A;cmp_t_B;cmp_v_B;cmp_t_C;cmp_v_C;cmp_t_D;cmp_v_D;cmp_t_E;cmp_v_E;cmp_t_F;cmp_v_F
+1000;lims_1;2021-01-01T08:00:00;Profile;PROF;SENDER1;NUMBER;1.5;STRING;hello;MULTI;x,y;BOOLEAN;true;CATALOG;a,b;DATE;2021-01-02T10:00:00
+1001;lims_1;2021-01-02T08:00:00+02:00;Profile;PROF;;NUMBER;;STRING;;MULTI;z;BOOLEAN;;CATALOG;c;DATE;
+"""
+
+def _rows(text:str):
+    """_rows returns a csv reader for the csv text."""
+    return csv.DictReader(io.StringIO(text), delimiter=";")
+
+def specimens() -> list:
+    """specimens returns the primary and derived samples of specimen_csvs with their fhirids filled in."""
+    samples = []
+    for text in specimen_csvs:
+        samples += list(iter_samples(_rows(text)))
+    _fill_in_fhirids(samples)
+    return [sample for sample in samples if sample.category in ["MASTER", "DERIVED"]]
+
+def findings() -> list:
+    """findings returns the findings of observation_csv with their fhirids, made like observation_entries makes them."""
+    return [(finding, genfhirid(finding.sample.id() + finding.method)) for finding in iter_findings(_rows(observation_csv), ",")]
+
+def reference(restype:str) -> dict:
+    """reference returns the entries for restype built with fhir_specimen or fhir_obs, by update_with_overwrite."""
+    entries = {}
+    for update in [False, True]:
+        if restype == "Specimen":
+            entries[str(update).lower()] = [fhir_specimen(sample, update_with_overwrite=update) for sample in specimens()]
+        else:
+            entries[str(update).lower()] = [fhir_obs(finding, fhirid=fhirid, update_with_overwrite=update) for (finding, fhirid) in findings()]
+    return entries
+
+def golden(restype:str) -> dict:
+    """golden returns the entries for restype from its golden file."""
+    with open(os.path.join(golden_dir, f"{restype.lower()}.json"), encoding="utf-8") as f:
+        return json.load(f)
+
+def _json(entries) -> str:
+    """_json returns the entries as json, the key order kept."""
+    return json.dumps(entries, indent=2)
+
+@pytest.mark.parametrize("restype", ["Specimen", "Observation"])
+def test_reference(restype):
+    assert _json(reference(restype)) == _json(golden(restype))
+
+@pytest.mark.parametrize("cxx", [3, 4])
+@pytest.mark.parametrize("update", [False, True])
+def test_specimen_builder(cxx, update):
+    build = builder("Specimen", cxx)
+    entries = [build(sample, update_with_overwrite=update) for sample in specimens()]
+    assert _json(entries) == _json(golden("Specimen")[str(update).lower()])
+
+@pytest.mark.parametrize("cxx", [3, 4])
+@pytest.mark.parametrize("update", [False, True])
+def test_obs_builder(cxx, update):
+    build = builder("Observation", cxx)
+    entries = [build(finding, fhirid=fhirid, update_with_overwrite=update) for (finding, fhirid) in findings()]
+    assert _json(entries) == _json(golden("Observation")[str(update).lower()])
+
+def test_entries_are_own():
+    # the compiled entries don't share dicts, so they can be changed afterwards
+    build = builder("Specimen")
+    (first, second) = [build(sample) for sample in specimens()[:2]]
+    first["resource"]["extension"][0]["valueBoolean"] = True
+    assert second["resource"]["extension"][0]["valueBoolean"] is False
+
+if __name__ == "__main__":
+    if sys.argv[1:] != ["--update"]:
+        print("usage: python tests/test_templates.py --update")
+        sys.exit(1)
+    os.makedirs(golden_dir, exist_ok=True)
+    for restype in ["Specimen", "Observation"]:
+        with open(os.path.join(golden_dir, f"{restype.lower()}.json"), "w", encoding="utf-8") as f:
+            f.write(_json(reference(restype)) + "\n")